@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures the merge of many coverage files, as saved by `run/batch --coverage`.
+
+    python -m benchmarks.coverage [--runs N] [--size KB] [--blocks N]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cemu.coverage import Coverage, merge_files
+
+
+def make_coverage(base, size, blocks, rng):
+    coverage = Coverage(base, size)
+    for i in range(blocks):
+        coverage.blocks.add( (base + rng.randrange(size), rng.randrange(1, 0x40)) )
+    coverage.end_run()
+    return coverage
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="coverage merge benchmark")
+    parser.add_argument("--runs", type=int, default=10000, help="number of coverage files")
+    parser.add_argument("--size", type=int, default=64, help="size of the covered area in KB")
+    parser.add_argument("--blocks", type=int, default=200, help="blocks hit by each run")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(0)
+    base, size = 0x40000, args.size << 10
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fpaths = []
+        t0 = time.perf_counter()
+        for i in range(args.runs):
+            fpath = os.path.join(tmpdir, "%d.cov" % i)
+            make_coverage(base, size, args.blocks, rng).save(fpath)
+            fpaths.append(fpath)
+        saving = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        merged = merge_files(fpaths)
+        merging = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        count = merged.save_drcov(os.path.join(tmpdir, "merged.drcov"))
+        exporting = time.perf_counter() - t0
+
+    summary = merged.summary()
+    print("flush+save: %.3fs (%d runs, %d blocks each)" % (saving, args.runs, args.blocks))
+    print("merge:      %.3fs (%.1f%% covered, %d blocks)" % (merging, summary["covered_percent"], summary["blocks"]))
+    print("drcov:      %.3fs (%d bbs)" % (exporting, count))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compares `cemu.utils.hexdump` with the original per-byte implementation.
+
+    python -m benchmarks.hexdump [--size MB] [--repeat N]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cemu.utils import hexdump
+
+
+def reference_hexdump(source, length=0x10, separator='.', show_raw=False, base=0x00):
+    result = []
+    for i in range(0, len(source), length):
+        s = source[i:i+length]
+
+        hexa = ' '.join(["%02X" % c for c in s])
+        text = ''.join( [chr(c) if 0x20 <= c < 0x7F else separator for c in s] )
+
+        if show_raw:
+            result.append(hexa)
+        else:
+            result.append( "%#-.*x   %-*s  %s" % (16, base+i, 3*length, hexa, text) )
+
+    return '\n'.join(result)
+
+
+def measure(func, data, repeat):
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = func(data)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="hexdump benchmark")
+    parser.add_argument("--size", type=int, default=16, help="buffer size in MB")
+    parser.add_argument("--repeat", type=int, default=3, help="keep the best of N runs")
+    args = parser.parse_args(argv)
+
+    data = os.urandom(args.size << 20)
+    reference, expected = measure(reference_hexdump, data, 1)
+    current, result = measure(hexdump, data, args.repeat)
+    if result != expected:
+        print("hexdump output differs from the reference implementation")
+        return 1
+
+    print("reference: %.3fs" % reference)
+    print("hexdump:   %.3fs (%.1fx faster, %.1f MB/s)" % (current, reference / current, args.size / current))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
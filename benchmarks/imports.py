@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Checks that the headless commands import neither Qt nor pygments: each command line
+runs `python -m cemu` in a fresh interpreter, which then lists the GUI modules found in
+`sys.modules`. Exits with 1 if any was imported.
+
+    python benchmarks/imports.py
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TEMPLATES = os.path.join(ROOT, "templates")
+
+# prefixes of the modules only the GUI may import
+GUI_MODULES = ("PyQt", "pygments")
+
+HEADLESS_COMMANDS = [
+    ["run", "--help"],
+    ["batch", "--help"],
+    ["run", os.path.join(TEMPLATES, "x86_32_sys_exec_bin_sh.asm"), "-S", "-s", "-o", os.devnull],
+]
+
+# runs `python -m cemu` with the given arguments, then reports the GUI modules imported
+PROBE = """
+import sys, json, runpy
+prefixes = tuple(json.loads(sys.argv[1]))
+sys.argv = ["cemu"] + sys.argv[2:]
+try:
+    runpy.run_module("cemu", run_name="__main__", alter_sys=True)
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps(sorted([m for m in sys.modules if m.startswith(prefixes)])))
+"""
+
+
+def get_gui_modules(argv):
+    p = subprocess.run([sys.executable, "-c", PROBE, json.dumps(GUI_MODULES)] + argv, cwd=ROOT,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    lines = p.stderr.decode().strip().splitlines()
+    if len(lines) == 0:
+        raise Exception("'cemu %s' did not report its modules" % " ".join(argv))
+    return json.loads(lines[-1])
+
+
+def main(argv=None):
+    failed = 0
+    for cmdline in HEADLESS_COMMANDS:
+        loaded = get_gui_modules(cmdline)
+        if len(loaded):
+            failed += 1
+        print("%-52s %s" % ("cemu " + " ".join([os.path.basename(arg) for arg in cmdline]),
+                            "IMPORTS %s" % ", ".join(loaded) if len(loaded) else "ok"))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
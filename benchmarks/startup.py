@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures the cold start of the command line, and checks it against the targets below.
+Also checks that the headless commands import neither Qt nor pygments, and that the
+engines they do not need are left unloaded. Exits with 1 on any regression.
+
+    python benchmarks/startup.py [--repeat N]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TEMPLATES = os.path.join(ROOT, "templates")
+
+GUI_MODULES = ["PyQt4", "PyQt5", "pygments"]
+
+# (name, command line, maximum median time in seconds, modules that must not be loaded)
+STARTUP_TARGETS = [
+    ("help", ["--help"], 0.15, GUI_MODULES + ["unicorn", "capstone", "keystone"]),
+    ("trace help", ["trace", "--help"], 0.15, GUI_MODULES + ["unicorn", "capstone", "keystone"]),
+    ("run raw", ["run", os.path.join(TEMPLATES, "x86_nops.raw"), "-o", os.devnull], 0.30, GUI_MODULES + ["capstone", "keystone"]),
+    ("run asm", ["run", os.path.join(TEMPLATES, "x86_32_sys_exec_bin_sh.asm"), "-o", os.devnull], 0.30, GUI_MODULES + ["capstone"]),
+]
+
+# runs the command line, then reports which of the given modules were imported
+PROBE = """
+import sys, json
+from cemu.__main__ import main
+try:
+    main(sys.argv[2:])
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps([m for m in json.loads(sys.argv[1]) if m in sys.modules]))
+"""
+
+
+def measure(argv, forbidden, repeat):
+    times, loaded = [], []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        p = subprocess.run([sys.executable, "-c", PROBE, json.dumps(forbidden)] + argv, cwd=ROOT,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        times.append(time.perf_counter() - t0)
+        loaded = json.loads(p.stderr.decode().strip().splitlines()[-1])
+    times.sort()
+    return times[len(times)//2], loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="startup time benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs of each command (the median is kept)")
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for name, cmdline, target, forbidden in STARTUP_TARGETS:
+        median, loaded = measure(cmdline, forbidden, args.repeat)
+        status = "ok"
+        if median > target:
+            status = "SLOW"
+        if len(loaded):
+            status = "IMPORTS %s" % ", ".join(loaded)
+        if status != "ok":
+            failed += 1
+        print("%-12s %.3fs (target %.2fs)  %s" % (name, median, target, status))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks assembly, disassembly and emulation over the payloads of `templates/`.
+
+    python benchmarks/suite.py [-o results.json] [--baseline baseline.json] [--threshold 10]
+
+Every result is a throughput (higher is better), written as JSON along with the versions
+of the engines. With `--baseline`, each result is compared to the one of a previous run,
+and the benchmark exits with 1 if any of them regressed by more than `--threshold` percent.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from cemu.batch import get_mode
+from cemu.disasm import disasm_lines
+from cemu.emulator import Emulator
+from cemu.trace import TRACE_LEVELS, TRACE_LEVEL_INSTRUCTIONS
+from cemu.utils import get_keystone_engine, get_capstone_engine, get_clean_code, parse_string_in_code, parse_mappings
+
+
+TEMPLATES = os.path.join(ROOT, "templates")
+
+# architecture of the templates, from the prefix of their name (the longest one matching)
+TEMPLATE_ARCHS = [("x86_64", "x86_64_intel"),
+                  ("x86_32", "x86_32_intel"),
+                  ("x86", "x86_32_intel"),
+                  ("arm", "arm_le"),
+                  ("mipsbe", "mips_be"),
+                  ("mips", "mips"),
+                  ("sparc64", "sparc64_be"),
+                  ("sparc", "sparc_be"),]
+
+# the nop sleds are repeated to fill this many bytes
+SLED_SIZE = 0x10000
+
+MAPPINGS = [".text   0x40000   0x%x   READ|EXEC" % (SLED_SIZE * 2),
+            ".data   0x60000   0x1000   READ|WRITE",
+            ".stack  0x800000  0x4000   READ|WRITE",
+            ".misc   0x1000000 0x1000   ALL"]
+
+# default minimum time (in seconds) spent measuring each result
+MIN_DURATION = 0.2
+
+
+def get_template_arch(fname):
+    for prefix, arch in TEMPLATE_ARCHS:
+        if fname.startswith(prefix):
+            return arch
+    return None
+
+
+def measure(func, min_duration):
+    """
+    Calls `func` until `min_duration` seconds elapsed, and returns the number of calls
+    per second.
+    """
+    calls, t0 = 0, time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_duration:
+            return calls / elapsed
+
+
+class Template:
+
+    def __init__(self, fpath, arch, *args, **kwargs):
+        self.fpath = fpath
+        self.name = os.path.splitext(os.path.basename(fpath))[0]
+        self.arch = arch
+        self.mode = get_mode(arch)
+        self.source = None
+        self.code = None
+        self.num_insns = 0
+        with open(fpath, "rb") as f:
+            data = f.read()
+
+        if fpath.endswith(".raw"):
+            # keeps the decodable part of the sled (the files end with a newline)
+            count = sum(1 for _ in get_capstone_engine(self.mode).disasm_lite(data, 0))
+            size = sum(insn[1] for insn in get_capstone_engine(self.mode).disasm_lite(data, 0))
+            if size:
+                self.code = data[:size] * (SLED_SIZE // size)
+                self.num_insns = count * (SLED_SIZE // size)
+        else:
+            lines = parse_string_in_code(get_clean_code(data.split(b"\n")), self.mode)
+            self.source = b" ; ".join(lines)
+            code, count = get_keystone_engine(self.mode).asm(self.source)
+            self.code, self.num_insns = bytes(code or b""), count
+        return
+
+
+def bench_assemble(template, min_duration):
+    # keystone is called directly, `cemu.utils.assemble` memoizing its results
+    ks = get_keystone_engine(template.mode)
+    calls = measure(lambda: ks.asm(template.source), min_duration)
+    return calls * template.num_insns
+
+
+def bench_disassemble(template, min_duration):
+    code = template.code
+    if len(code) < SLED_SIZE:
+        code = code * (SLED_SIZE // len(code))
+    count = [0]
+    def disassemble():
+        count[0] = sum(1 for _ in disasm_lines(code, template.mode))
+    calls = measure(disassemble, min_duration)
+    return calls * count[0]
+
+
+def bench_emulate(template, level, min_duration):
+    """
+    Returns the number of instructions emulated per second, VM setup excluded (each run
+    starts from a snapshot), or None if the payload cannot be emulated.
+    """
+    emu = Emulator(template.mode, verbose=False, trace_level=level)
+    emu.populate_memory(parse_mappings(MAPPINGS))
+    emu.load_raw_code(template.code)
+    emu.populate_registers({})
+    emu.map_code()
+    snap = emu.snapshot()
+
+    # the instruction count of a run, measured once with a code hook
+    emu.trace_level = TRACE_LEVEL_INSTRUCTIONS
+    if not emu.run() or emu.executed_insns == 0:
+        return None
+    executed = emu.executed_insns
+    emu.trace_level = level
+
+    def emulate():
+        emu.restore(snap)
+        emu.run()
+        emu.trace.clear()
+    calls = measure(emulate, min_duration)
+    return calls * executed
+
+
+def run_benchmarks(min_duration, pattern=None):
+    results = {}
+    fnames = sorted([f for f in os.listdir(TEMPLATES) if f.endswith((".asm", ".raw"))])
+    for fname in fnames:
+        arch = get_template_arch(fname)
+        if arch is None:
+            continue
+        try:
+            template = Template(os.path.join(TEMPLATES, fname), arch)
+        except Exception as e:
+            print("skipping %s (%s)" % (fname, e))
+            continue
+        if not template.code:
+            print("skipping %s (no code)" % fname)
+            continue
+
+        benchs = []
+        if template.source is not None:
+            benchs.append( ("assemble", "insns/s", lambda: bench_assemble(template, min_duration)) )
+        benchs.append( ("disassemble", "insns/s", lambda: bench_disassemble(template, min_duration)) )
+        for level_name, level in sorted(TRACE_LEVELS.items(), key=lambda x: x[1]):
+            benchs.append( ("emulate-%s" % level_name, "insns/s",
+                            lambda level=level: bench_emulate(template, level, min_duration)) )
+
+        for kind, unit, bench in benchs:
+            key = "%s/%s" % (kind, template.name)
+            if pattern is not None and pattern not in key:
+                continue
+            try:
+                value = bench()
+            except Exception as e:
+                print("%-50s failed (%s)" % (key, e))
+                continue
+            if value is None:
+                print("%-50s cannot be emulated" % key)
+                continue
+            results[key] = {"value": value, "unit": unit, "arch": arch}
+            print("%-50s %14.0f %s" % (key, value, unit))
+    return results
+
+
+def get_versions():
+    import unicorn, capstone, keystone
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "unicorn": unicorn.__version__,
+            "capstone": capstone.__version__,
+            "keystone": getattr(keystone, "__version__", None),}
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the ratio of each result to its baseline, and returns the keys of those that
+    regressed by more than `threshold` percent.
+    """
+    regressions = []
+    for key in sorted(results.keys()):
+        if key not in baseline:
+            continue
+        ratio = results[key]["value"] / baseline[key]["value"]
+        flag = ""
+        if ratio < 1 - threshold / 100.0:
+            flag = "REGRESSION"
+            regressions.append(key)
+        print("%-50s %6.2fx  %s" % (key, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="cemu benchmark suite")
+    parser.add_argument("-o", "--output", default=None, help="write the results as JSON to this file")
+    parser.add_argument("-b", "--baseline", default=None, help="compare the results to those of this JSON file")
+    parser.add_argument("-t", "--threshold", type=float, default=10, help="regression threshold, in percent")
+    parser.add_argument("-d", "--duration", type=float, default=MIN_DURATION, help="minimum time spent on each result")
+    parser.add_argument("-k", "--filter", default=None, help="only run the benchmarks whose name contains this")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.duration, args.filter)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"versions": get_versions(), "results": results}, f, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        print("")
+        regressions = compare(results, baseline, args.threshold)
+        if len(regressions):
+            print("%d regressions (threshold %g%%)" % (len(regressions), args.threshold))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
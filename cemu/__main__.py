@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import argparse
+
+
+def run_gui(args):
+    from .core import Cemu
+    Cemu()
+    return 0
+
+
+def run_batch(args):
+    from .batch import BatchRunner, collect_jobs, parse_registers
+    from .trace import TRACE_LEVELS, parse_trace_range
+    from .utils import parse_mappings
+    from .watch import parse_watchpoint
+    from .breakpoints import parse_breakpoint
+
+    mappings = None
+    if args.mappings is not None:
+        with open(args.mappings, "r") as f:
+            mappings = parse_mappings(f.read().split("\n"))
+
+    registers = parse_registers(args.register)
+    if args.registers is not None:
+        with open(args.registers, "r") as f:
+            registers.update(parse_registers(f.read().split("\n")))
+
+    guest_files = {}
+    for spec in args.guest_file:
+        if "=" not in spec:
+            raise Exception("Invalid guest file '%s' (expected GUEST_PATH=HOST_PATH)" % spec)
+        guest, host = spec.split("=", 1)
+        with open(host, "rb") as f:
+            guest_files[guest] = f.read()
+
+    watchpoints = [parse_watchpoint(spec) for spec in args.watch]
+    breakpoints = [parse_breakpoint(spec) for spec in args.breakpoint]
+
+    jobs = collect_jobs(args.inputs, args.arch)
+    runner = BatchRunner(mappings, registers,
+                         max_insns=args.max_insns,
+                         max_time_us=args.max_time_us,
+                         max_mem_accesses=args.max_mem_accesses,
+                         trace_level=TRACE_LEVELS[args.trace],
+                         trace_range=parse_trace_range(args.trace_range),
+                         binary_trace_dir=args.binary_trace,
+                         coverage_dir=args.coverage,
+                         stats=args.stats,
+                         profile=args.sample_us if args.profile else None,
+                         watchpoints=[(wp.start, wp.end, wp.access, wp.stop) for wp in watchpoints],
+                         access_stats=args.access_stats,
+                         breakpoints=[(bp.address, bp.text, bp.hit_count) for bp in breakpoints],
+                         syscalls=args.syscalls or len(guest_files) > 0,
+                         guest_files=guest_files)
+
+    if args.output is None:
+        runner.run_parallel(jobs, args.jobs)
+    else:
+        with open(args.output, "w") as f:
+            runner.run_parallel(jobs, args.jobs, f)
+    return 0
+
+
+def dump_trace(args):
+    from .bintrace import TraceReader
+
+    reader = TraceReader(args.trace)
+    try:
+        if args.pc is not None:
+            indexes = reader.find_pc(int(args.pc, 0x10))
+            print("%d instructions at %s" % (len(indexes), args.pc))
+            for i in indexes[:args.count]:
+                print(reader.format_record( next(reader.records(i, i+1)) ))
+            return 0
+
+        for record in reader.records(args.start, args.start + args.count):
+            print(reader.format_record(record))
+    finally:
+        reader.close()
+    return 0
+
+
+def merge_coverage(args):
+    import json
+    from .coverage import merge_files
+
+    coverage = merge_files(args.inputs)
+    if args.output is not None:
+        coverage.save(args.output)
+    if args.drcov is not None:
+        coverage.save_drcov(args.drcov, args.module)
+    print(json.dumps(coverage.summary(), sort_keys=True))
+    return 0
+
+
+def disassemble(args):
+    from .batch import get_mode
+    from .disasm import disassemble_to_file
+
+    mode = get_mode(args.arch)
+    address = int(args.base, 0x10)
+    if args.output is None:
+        disassemble_to_file(args.input, sys.stdout, mode, address, args.jobs)
+    else:
+        with open(args.output, "w") as f:
+            disassemble_to_file(args.input, f, mode, address, args.jobs)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="cemu", description="Cheap EMUlator")
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser("gui", help="start the graphical interface (default)")
+
+    for name, help in (("run", "emulate the given files"),
+                       ("batch", "emulate every payload of the given directories or @manifests")):
+        p = subparsers.add_parser(name, help=help)
+        p.add_argument("inputs", nargs="+", metavar="INPUT",
+                       help=".asm/.raw file, directory, or @manifest with one 'file [arch]' per line")
+        p.add_argument("-a", "--arch", default="x86_32_intel",
+                       help="default architecture (e.g. x86_64_intel, arm_le, mips_be)")
+        p.add_argument("-m", "--mappings", default=None,
+                       help="file with one 'name address size permission [input_file [offset]]' mapping per line")
+        p.add_argument("-R", "--registers", default=None,
+                       help="file with one 'REG=value' per line")
+        p.add_argument("-r", "--register", action="append", default=[], metavar="REG=VALUE",
+                       help="initial register value (can be repeated)")
+        p.add_argument("--max-insns", type=int, default=0,
+                       help="stop each run after this many instructions (0 for unlimited)")
+        p.add_argument("--max-time-us", type=int, default=0,
+                       help="stop each run after this many microseconds (0 for unlimited)")
+        p.add_argument("--max-mem-accesses", type=int, default=0,
+                       help="stop each run after this many memory reads and writes (0 for unlimited)")
+        p.add_argument("-t", "--trace", default="none",
+                       choices=["none", "blocks", "instructions", "memory"],
+                       help="hooks to install: 'none' runs at native speed, 'blocks' also counts executed instructions")
+        p.add_argument("--trace-range", default="", metavar="START-END",
+                       help="restrict the trace hooks to this (hexadecimal) address range")
+        p.add_argument("-j", "--jobs", type=int, default=1 if name == "run" else 0,
+                       help="number of worker processes (0 for one per core)")
+        p.add_argument("-b", "--binary-trace", default=None, metavar="DIR",
+                       help="record a binary execution trace of each input in this directory")
+        p.add_argument("-c", "--coverage", default=None, metavar="DIR",
+                       help="save the block coverage of each input in this directory")
+        p.add_argument("-s", "--stats", action="store_true",
+                       help="add the time of each phase and hook, and the access counts, to the results")
+        p.add_argument("-p", "--profile", action="store_true",
+                       help="add the most executed instructions and blocks of .text to the results")
+        p.add_argument("--sample-us", type=int, default=0, metavar="N",
+                       help="with --profile, sample the PC every N microseconds instead of counting every block")
+        p.add_argument("-w", "--watch", action="append", default=[], metavar="START-END[:ACCESS][:stop]",
+                       help="watch the reads (r) and/or writes (w) of this (hexadecimal) address range, stopping on a hit with 'stop' (can be repeated)")
+        p.add_argument("-B", "--break", dest="breakpoint", action="append", default=[], metavar="'ADDRESS [after N] [if CONDITION]'",
+                       help="stop before the instruction at this (hexadecimal) address, on the Nth hit where the condition "
+                            "on the registers holds (e.g. '40010 after 3 if EAX == 0xb and ECX != 0'; can be repeated)")
+        p.add_argument("--access-stats", default=None, choices=["page", "area"],
+                       help="count the memory reads and writes per page or per mapped area")
+        p.add_argument("-S", "--syscalls", action="store_true",
+                       help="emulate the Linux syscalls (open, read, write, execve, exit, mmap...) against an in-memory "
+                            "sandbox, and add the calls and the behaviours they show to the results")
+        p.add_argument("-f", "--guest-file", action="append", default=[], metavar="GUEST_PATH=HOST_PATH",
+                       help="with --syscalls, put the content of a host file in the sandbox at this path (can be repeated)")
+        p.add_argument("-o", "--output", default=None,
+                       help="write the JSON lines to this file instead of stdout")
+
+    p = subparsers.add_parser("trace", help="print the records of a binary trace")
+    p.add_argument("trace", metavar="TRACE", help="binary trace file")
+    p.add_argument("-s", "--start", type=int, default=0, help="index of the first record to print")
+    p.add_argument("-n", "--count", type=int, default=100, help="number of records to print")
+    p.add_argument("--pc", default=None, help="only print the instructions at this (hexadecimal) address")
+
+    p = subparsers.add_parser("coverage", help="merge coverage files, and export them")
+    p.add_argument("inputs", nargs="+", metavar="COVERAGE", help="coverage file saved by run/batch --coverage")
+    p.add_argument("-o", "--output", default=None, help="save the merged coverage to this file")
+    p.add_argument("--drcov", default=None, help="export the merged coverage to this drcov file")
+    p.add_argument("--module", default=None, help="module name in the drcov file (the area name by default)")
+
+    p = subparsers.add_parser("disasm", help="disassemble a raw file")
+    p.add_argument("input", metavar="INPUT", help="raw file")
+    p.add_argument("-a", "--arch", default="x86_32_intel", help="architecture (e.g. x86_64_intel, arm_le, mips_be)")
+    p.add_argument("--base", default="4000", help="(hexadecimal) address of the first byte")
+    p.add_argument("-j", "--jobs", type=int, default=1,
+                   help="number of worker processes for large files (0 for one per core)")
+    p.add_argument("-o", "--output", default=None, help="write the disassembly to this file instead of stdout")
+
+    args = parser.parse_args(argv)
+    if args.command in (None, "gui"):
+        return run_gui(args)
+    if args.command == "trace":
+        return dump_trace(args)
+    if args.command == "disasm":
+        return disassemble(args)
+    if args.command == "coverage":
+        return merge_coverage(args)
+    return run_batch(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
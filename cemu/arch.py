@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import enum
+import importlib
 from enum import Enum
 class Architecture(Enum):
 	X86_16_INTEL = 0
@@ -80,6 +81,150 @@ modes = {"x86":[ (Architecture.X86_16_INTEL, "16bit, Intel syntax", X86_16_REGS,
 }
 
 
+# (keystone, capstone, unicorn) (arch, mode) constant suffixes, None standing for 0,
+# then the endianness, assembly syntax and word size (in bits) of each architecture
+ENGINE_MODES = {
+    Architecture.X86_16_INTEL: (("X86", "16"), ("X86", "16"), ("X86", "16"), "little", "intel", 16),
+    Architecture.X86_32_INTEL: (("X86", "32"), ("X86", "32"), ("X86", "32"), "little", "intel", 32),
+    Architecture.X86_64_INTEL: (("X86", "64"), ("X86", "64"), ("X86", "64"), "little", "intel", 64),
+    Architecture.X86_16_ATT:   (("X86", "16"), ("X86", "16"), ("X86", "16"), "little", "att", 16),
+    Architecture.X86_32_ATT:   (("X86", "32"), ("X86", "32"), ("X86", "32"), "little", "att", 32),
+    Architecture.X86_64_ATT:   (("X86", "64"), ("X86", "64"), ("X86", "64"), "little", "att", 64),
+    Architecture.ARM_LE:       (("ARM", "ARM"), ("ARM", "ARM"), ("ARM", "ARM"), "little", None, 32),
+    Architecture.ARM_BE:       (("ARM", "ARM"), ("ARM", "ARM"), ("ARM", "ARM"), "big", None, 32),
+    Architecture.ARM_THUMB_LE: (("ARM", "THUMB"), ("ARM", "THUMB"), ("ARM", "THUMB"), "little", None, 32),
+    Architecture.ARM_THUMB_BE: (("ARM", "THUMB"), ("ARM", "THUMB"), ("ARM", "THUMB"), "big", None, 32),
+    Architecture.ARM_AARCH64:  (("ARM64", None), ("ARM64", "ARM"), ("ARM64", "ARM"), "little", None, 64),
+    Architecture.MIPS:         (("MIPS", "MIPS32"), ("MIPS", "MIPS32"), ("MIPS", "MIPS32"), "little", None, 32),
+    Architecture.MIPS_BE:      (("MIPS", "MIPS32"), ("MIPS", "MIPS32"), ("MIPS", "MIPS32"), "big", None, 32),
+    Architecture.MIPS64:       (("MIPS", "MIPS64"), ("MIPS", "MIPS64"), ("MIPS", "MIPS64"), "little", None, 64),
+    Architecture.MIPS64_BE:    (("MIPS", "MIPS64"), ("MIPS", "MIPS64"), ("MIPS", "MIPS64"), "big", None, 64),
+    Architecture.PPC:          (("PPC", "PPC32"), ("PPC", None), ("PPC", "PPC32"), "big", None, 32),
+    Architecture.PPC64:        (("PPC", "PPC64"), ("PPC", None), ("PPC", "PPC64"), "big", None, 64),
+    Architecture.SPARC:        (("SPARC", "SPARC32"), ("SPARC", None), ("SPARC", "SPARC32"), "little", None, 32),
+    Architecture.SPARC_BE:     (("SPARC", "SPARC32"), ("SPARC", None), ("SPARC", "SPARC32"), "big", None, 32),
+    Architecture.SPARC64:      (("SPARC", "SPARC64"), ("SPARC", None), ("SPARC", "SPARC64"), "little", None, 64),
+    Architecture.SPARC64_BE:   (("SPARC", "SPARC64"), ("SPARC", None), ("SPARC", "SPARC64"), "big", None, 64),
+}
+
+# alignment used to display addresses and size immediate strings
+MEMORY_ALIGNMENTS = dict([(arch, 32) for arch in Architecture])
+MEMORY_ALIGNMENTS.update({Architecture.X86_16_INTEL: 16,
+                          Architecture.ARM_THUMB_LE: 16,
+                          Architecture.ARM_THUMB_BE: 16,
+                          Architecture.X86_64_INTEL: 64,
+                          Architecture.X86_64_ATT: 64,
+                          Architecture.ARM_AARCH64: 64,})
+
+# (title, registers, pc, sp) of the selectable modes
+_selectable_modes = {}
+for _family in modes.keys():
+    for _mode in modes[_family]:
+        _selectable_modes[_mode[0]] = _mode
+
+_descriptors = {}
+
+
+def _engine_constants(lib, prefix, arch_name, mode_name, endianness):
+    mode = getattr(lib, "%s_MODE_%s" % (prefix, mode_name)) if mode_name is not None else 0
+    endian = getattr(lib, "%s_MODE_%s_ENDIAN" % (prefix, endianness.upper()))
+    return (getattr(lib, "%s_ARCH_%s" % (prefix, arch_name)), mode, endian)
+
+
+class ArchDescriptor:
+    """
+    Immutable description of an architecture for the three engines: built once from
+    `ENGINE_MODES`, and looked up with `get_arch_descriptor`. The keystone and capstone
+    constants are only resolved (and the engine imported) on first access.
+    """
+    __slots__ = ("arch", "title", "registers", "pc", "sp", "unicorn", "endianness", "syntax",
+                 "word_size", "memory_alignment", "register_ids", "register_id_list", "pc_id",
+                 "sp_id", "register_module", "register_prefix", "_engine_modes", "_keystone", "_capstone",)
+
+    def __init__(self, arch, *args, **kwargs):
+        import unicorn
+
+        engine_modes = ENGINE_MODES[arch]
+        (uc_arch, uc_mode), endianness, syntax, word_size = engine_modes[2:]
+        title, registers, pc, sp = _selectable_modes.get(arch, (arch, arch.name, [], "PC", "SP"))[1:]
+
+        fields = {"arch": arch,
+                  "title": title,
+                  "registers": tuple(registers),
+                  "pc": pc,
+                  "sp": sp,
+                  "unicorn": _engine_constants(unicorn, "UC", uc_arch, uc_mode, endianness),
+                  "endianness": endianness,
+                  "syntax": syntax,
+                  "word_size": word_size,
+                  "memory_alignment": MEMORY_ALIGNMENTS[arch],
+                  "register_module": importlib.import_module("unicorn.%s_const" % uc_arch.lower()),
+                  "register_prefix": "UC_%s_REG_" % uc_arch,
+                  "_engine_modes": engine_modes,
+                  "_keystone": None,
+                  "_capstone": None,}
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+
+        ids = {}
+        for reg in set(registers) | set([pc, sp]):
+            uc_id = getattr(self.register_module, self.register_prefix + reg.upper(), None)
+            if uc_id is not None:
+                ids[reg] = uc_id
+        object.__setattr__(self, "register_ids", ids)
+        object.__setattr__(self, "register_id_list", tuple([ids.get(r) for r in registers]))
+        object.__setattr__(self, "pc_id", ids.get(pc))
+        object.__setattr__(self, "sp_id", ids.get(sp))
+        return
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Architecture descriptors are immutable")
+
+    def __repr__(self):
+        return "<ArchDescriptor %s>" % self.arch.name
+
+    @property
+    def keystone(self):
+        if self._keystone is None:
+            import keystone
+            ks_arch, ks_mode = self._engine_modes[0]
+            object.__setattr__(self, "_keystone", _engine_constants(keystone, "KS", ks_arch, ks_mode, self.endianness))
+        return self._keystone
+
+    @property
+    def capstone(self):
+        if self._capstone is None:
+            import capstone
+            cs_arch, cs_mode = self._engine_modes[1]
+            object.__setattr__(self, "_capstone", _engine_constants(capstone, "CS", cs_arch, cs_mode, self.endianness))
+        return self._capstone
+
+    def unicorn_register(self, reg):
+        """
+        Returns the unicorn id of a register (of the mode, or any other one known by unicorn).
+        """
+        uc_id = self.register_ids.get(reg)
+        if uc_id is None:
+            uc_id = getattr(self.register_module, self.register_prefix + str(reg).upper(), None)
+        if uc_id is None:
+            raise Exception("Cannot find register '%s' for arch '%s'" % (str(reg), self.arch.name))
+        return uc_id
+
+
+def get_arch_descriptor(arch):
+    """
+    Returns the descriptor of an `Architecture` (or of the architecture of a `Mode`); the
+    engines are only imported when the first descriptor is built.
+    """
+    if isinstance(arch, Mode):
+        arch = arch.get_id()
+    descriptor = _descriptors.get(arch)
+    if descriptor is None:
+        descriptor = ArchDescriptor(arch)
+        _descriptors[arch] = descriptor
+    return descriptor
+
+
 class Mode:
 
     def __init__(self, *args, **kwargs):
@@ -91,13 +236,10 @@ class Mode:
         return self.__selected
 
     def set_new_mode(self, i):
-        for arch in modes.keys():
-            for mode in modes[arch]:
-                if mode[0]==i:
-                    self.__selected = mode
-                    return
-
-        raise Exception("Invalid arch/mode")
+        if i not in _selectable_modes:
+            raise Exception("Invalid arch/mode")
+        self.__selected = _selectable_modes[i]
+        return
 
     def get_id(self):
         return self.__selected[0]
@@ -114,18 +256,11 @@ class Mode:
     def get_sp(self):
         return self.__selected[4]
 
+    def get_descriptor(self):
+        return get_arch_descriptor(self.__selected[0])
+
     def __eq__(self, x):
         return x==self.get_id()
 
     def get_memory_alignment(self):
-        if self.get_id() in (Architecture.X86_16_INTEL,
-                               Architecture.ARM_THUMB_LE,
-                               Architecture.ARM_THUMB_BE):
-            return 16
-
-        if self.get_id() in (Architecture.X86_64_INTEL,
-                               Architecture.X86_64_ATT,
-                               Architecture.ARM_AARCH64):
-            return 64
-
-        return 32
+        return MEMORY_ALIGNMENTS[self.get_id()]
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headless batch runner: emulates many assembly (.asm) or raw (.raw) payloads without Qt,
+and writes one JSON result line per input.
+"""
+
+import os
+import sys
+import json
+import time
+import multiprocessing
+
+from .arch import Architecture, Mode
+from .emulator import Emulator, STOP_END
+from .syscalls import STOP_EXIT
+from .trace import TRACE_LEVEL_NONE
+from .watch import hit_as_dict
+from .utils import DEFAULT_MEMORY_LAYOUT, parse_mappings, get_clean_code, parse_string_in_code
+
+
+SUPPORTED_EXTENSIONS = (".asm", ".raw")
+
+# number of jobs handed at once to a worker process
+JOBS_CHUNK_SIZE = 4
+
+
+def get_mode(name):
+    """
+    Returns a new `Mode` for the architecture name (case insensitive, e.g. `x86_32_intel`).
+    """
+    try:
+        arch = Architecture[name.upper()]
+    except KeyError:
+        raise Exception("Unknown architecture '%s'" % name)
+    mode = Mode()
+    mode.set_new_mode(arch)
+    return mode
+
+
+def parse_registers(specs):
+    """
+    Parses register values of the form `REG=value`, value being an integer in any base.
+    """
+    regs = {}
+    for spec in specs:
+        spec = spec.strip()
+        if len(spec)==0 or spec.startswith("#"):
+            continue
+        reg, value = spec.split("=", 1)
+        regs[reg.strip().upper()] = int(value.strip(), 0)
+    return regs
+
+
+def collect_jobs(paths, default_arch):
+    """
+    Returns the list of (file, arch) to emulate from files, directories and manifests.
+    A manifest is given as `@path` and holds one `file [arch]` per line.
+    """
+    jobs = []
+    for path in paths:
+        if path.startswith("@"):
+            manifest = path[1:]
+            basedir = os.path.dirname(manifest)
+            with open(manifest, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if len(line)==0 or line.startswith("#"):
+                        continue
+                    parts = line.split()
+                    fpath = os.path.join(basedir, parts[0])
+                    arch = parts[1] if len(parts)>1 else default_arch
+                    jobs.append( (fpath, arch) )
+
+        elif os.path.isdir(path):
+            for fname in sorted(os.listdir(path)):
+                if fname.endswith(SUPPORTED_EXTENSIONS):
+                    jobs.append( (os.path.join(path, fname), default_arch) )
+
+        else:
+            jobs.append( (path, default_arch) )
+
+    return jobs
+
+
+class BatchRunner:
+
+    def __init__(self, mappings=None, registers=None, *args, **kwargs):
+        self.mappings = mappings if mappings is not None else parse_mappings(DEFAULT_MEMORY_LAYOUT)
+        self.registers = registers if registers is not None else {}
+        self.options = {"max_insns": kwargs.get("max_insns", 0),
+                        "max_time_us": kwargs.get("max_time_us", 0),
+                        "max_mem_accesses": kwargs.get("max_mem_accesses", 0),
+                        "trace_level": kwargs.get("trace_level", TRACE_LEVEL_NONE),
+                        "trace_range": kwargs.get("trace_range", None),
+                        "binary_trace_dir": kwargs.get("binary_trace_dir", None),
+                        "coverage_dir": kwargs.get("coverage_dir", None),
+                        "stats": kwargs.get("stats", False),
+                        "profile": kwargs.get("profile", None),
+                        "watchpoints": kwargs.get("watchpoints", []),
+                        "access_stats": kwargs.get("access_stats", None),
+                        "breakpoints": kwargs.get("breakpoints", []),
+                        "syscalls": kwargs.get("syscalls", False),
+                        "guest_files": kwargs.get("guest_files", {}),}
+        self.emulators = {}
+        self.snapshots = {}
+        return
+
+
+    def get_emulator(self, arch):
+        """
+        Returns the emulator for the architecture, keeping one instance per architecture alive.
+        """
+        arch = arch.upper()
+        if arch not in self.emulators:
+            self.emulators[arch] = Emulator(get_mode(arch), verbose=False, **self.options)
+        return self.emulators[arch]
+
+
+    def load_base_image(self, emu, mappings):
+        """
+        Maps the memory areas on the first run of an emulator and snapshots them, later
+        runs with the same mappings only rewind the VM to that snapshot.
+        """
+        key = repr(mappings)
+        key_and_snap = self.snapshots.get(id(emu))
+        if key_and_snap is not None and key_and_snap[0] == key:
+            emu.restore(key_and_snap[1])
+            return True
+
+        emu.reinit()
+        if not emu.populate_memory(mappings):
+            return False
+        self.snapshots[id(emu)] = (key, emu.snapshot())
+        return True
+
+
+    def load_code(self, emu, fpath):
+        with open(fpath, "rb") as f:
+            data = f.read()
+
+        if fpath.endswith(".raw"):
+            return emu.load_raw_code(data)
+
+        code = get_clean_code(data.split(b"\n"))
+        code = parse_string_in_code(code, emu.mode)
+        return emu.compile_code(code)
+
+
+    def get_binary_trace_path(self, fpath, index):
+        tracedir = self.options["binary_trace_dir"]
+        if tracedir is None:
+            return None
+        return os.path.join(tracedir, "%d-%s.trace" % (index, os.path.basename(fpath)))
+
+
+    def get_coverage_path(self, fpath, index):
+        coveragedir = self.options["coverage_dir"]
+        if coveragedir is None:
+            return None
+        return os.path.join(coveragedir, "%d-%s.cov" % (index, os.path.basename(fpath)))
+
+
+    def run_one(self, fpath, arch, mappings=None, registers=None, index=0):
+        """
+        Emulates one file, with the runner mappings and registers unless given, and
+        returns its result as a dict.
+        """
+        mappings = mappings if mappings is not None else self.mappings
+        registers = registers if registers is not None else self.registers
+        result = {"file": fpath, "arch": arch, "status": None}
+        t0 = time.time()
+        try:
+            emu = self.get_emulator(arch)
+            if not self.load_base_image(emu, mappings):
+                result["status"] = "mapping_error"
+            elif not self.load_code(emu, fpath):
+                result["status"] = "compile_error"
+            elif not emu.populate_registers(registers):
+                result["status"] = "register_error"
+            elif not emu.map_code():
+                result["status"] = "mapping_error"
+            else:
+                tracepath = self.get_binary_trace_path(fpath, index)
+                if tracepath is not None:
+                    emu.start_binary_trace(tracepath)
+                    result["binary_trace"] = tracepath
+                coveragepath = self.get_coverage_path(fpath, index)
+                if coveragepath is not None:
+                    emu.start_coverage()
+                try:
+                    success = emu.run()
+                finally:
+                    emu.stop_binary_trace()
+                    coverage = emu.stop_coverage()
+
+                if coverage is not None:
+                    coverage.save(coveragepath)
+                    result["coverage"] = coveragepath
+                    result["covered_blocks"] = coverage.summary()["blocks"]
+
+                if not success:
+                    result["status"] = "emulation_error"
+                    result["error"] = emu.last_error
+                else:
+                    # a payload calling exit is done as well
+                    result["status"] = "finished" if emu.stop_reason in (STOP_END, STOP_EXIT) else "stopped"
+
+            if emu.stop_reason is not None:
+                result["stop_reason"] = emu.stop_reason
+                result["stop_pc"] = emu.stop_pc
+                if emu.run_insns > 0:
+                    result["executed_insns"] = emu.run_insns
+                    if emu.run_elapsed > 0:
+                        result["insns_per_sec"] = int(emu.run_insns / emu.run_elapsed)
+                if emu.max_mem_accesses:
+                    result["mem_accesses"] = emu.mem_accesses
+
+            if emu.code is not None:
+                result["code_size"] = len(emu.code)
+                result["num_insns"] = emu.num_insns
+
+            if result["status"] in ("finished", "stopped", "emulation_error"):
+                result["registers"] = self.dump_registers(emu)
+
+            if emu.stats.enabled:
+                result["stats"] = emu.stats.as_dict()
+
+            if emu.profiler is not None:
+                result["profile"] = emu.get_profile()
+
+            if len(emu.watch_index):
+                result["watchpoints"] = [wp.as_dict() for wp in emu.watch_index.watchpoints]
+                result["watch_hits"] = [hit_as_dict(hit) for hit in emu.watch_hits]
+
+            if emu.access_stats is not None:
+                result["memory_accesses"] = emu.get_access_report()
+
+            if len(emu.breakpoints):
+                result["breakpoints"] = [bp.as_dict() for bp in emu.breakpoints]
+
+            if emu.syscalls is not None:
+                result["syscalls"] = emu.syscalls.as_dict()
+
+        except Exception as e:
+            result["status"] = "error"
+            result["error"] = str(e)
+            # start the next run from a fresh VM
+            self.snapshots.pop(id(self.emulators.get(arch.upper())), None)
+
+        result["elapsed"] = time.time() - t0
+        return result
+
+
+    def dump_registers(self, emu):
+        return emu.get_registers_values()
+
+
+    def run(self, jobs, output=sys.stdout):
+        """
+        Runs the jobs, each one being (file, arch) or (file, arch, mappings, registers),
+        and writes their results in order. Returns the number of jobs run.
+        """
+        count = 0
+        for index, job in enumerate(jobs):
+            result = self.run_one(*self.expand_job(job), index=index)
+            result["index"] = index
+            output.write(json.dumps(result, sort_keys=True) + "\n")
+            count += 1
+        output.flush()
+        return count
+
+
+    def expand_job(self, job):
+        if len(job) == 2:
+            return (job[0], job[1], None, None)
+        return job
+
+
+    def run_parallel(self, jobs, processes=None, output=sys.stdout):
+        """
+        Fans the jobs out over a pool of processes (one per core by default), each one
+        keeping its own warm emulators, and writes the results as they complete. The
+        `index` field of each result gives the position of its job in `jobs`.
+        """
+        processes = processes or multiprocessing.cpu_count()
+        if processes == 1:
+            return self.run(jobs, output)
+
+        count = 0
+        pool = multiprocessing.Pool(processes, _init_worker, (self.mappings, self.registers, self.options))
+        try:
+            for result in pool.imap_unordered(_run_job, enumerate(jobs), JOBS_CHUNK_SIZE):
+                output.write(json.dumps(result, sort_keys=True) + "\n")
+                count += 1
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        output.flush()
+        return count
+
+
+_worker_runner = None
+
+
+def _init_worker(mappings, registers, options):
+    global _worker_runner
+    _worker_runner = BatchRunner(mappings, registers, **options)
+    return
+
+
+def _run_job(indexed_job):
+    index, job = indexed_job
+    result = _worker_runner.run_one(*_worker_runner.expand_job(job), index=index)
+    result["index"] = index
+    return result
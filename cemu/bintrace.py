@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact binary execution trace.
+
+A trace file is a header followed by fixed-width 64-bit little endian records:
+
+    bits  0-3    kind
+    bits  4-7    size (of the instruction, or of the memory access)
+    bits  8-15   register index (REG records)
+    bits 16-63   48-bit payload
+
+INSN records hold the PC, REG records the new value of a register changed by the
+previous instruction, MEM_READ/MEM_WRITE records the accessed address (a MEM_WRITE
+being followed by a VALUE record). Payloads wider than 48 bits are completed by an
+EXT record holding their upper 16 bits, so that every record can be decoded on its own.
+"""
+
+import sys
+import mmap
+import array
+import struct
+
+
+TRACE_MAGIC = b"CEMUTRC\x00"
+TRACE_VERSION = 1
+
+# magic, version, architecture, number of registers, header size
+HEADER_FORMAT = "<8sHHHH"
+
+REC_INSN = 0
+REC_REG = 1
+REC_MEM_READ = 2
+REC_MEM_WRITE = 3
+REC_VALUE = 4
+REC_EXT = 5
+
+RECORD_NAMES = {REC_INSN: "insn", REC_REG: "reg", REC_MEM_READ: "mem_read",
+                REC_MEM_WRITE: "mem_write", REC_VALUE: "value", REC_EXT: "ext",}
+
+PAYLOAD_BITS = 48
+PAYLOAD_MASK = (1 << PAYLOAD_BITS) - 1
+
+# number of records buffered by the writer before being written to disk
+WRITER_BUFFER_SIZE = 1 << 16
+
+
+def encode(kind, size, aux, payload):
+    return (payload & PAYLOAD_MASK) << 16 | (aux & 0xff) << 8 | (size & 0xf) << 4 | kind
+
+
+def decode(word):
+    """
+    Returns the (kind, size, aux, payload) tuple of a record.
+    """
+    return (word & 0xf, (word >> 4) & 0xf, (word >> 8) & 0xff, word >> 16)
+
+
+class TraceWriter:
+    """
+    Streams trace records to a file, buffering them in an array of 64-bit words.
+    """
+
+    def __init__(self, fpath, mode, registers, *args, **kwargs):
+        if sys.byteorder != "little":
+            raise Exception("Binary traces can only be written on little endian hosts")
+        self.fpath = fpath
+        self.registers = list(registers)
+        self.fd = open(fpath, "wb")
+        self.buffer = array.array("Q")
+        self.count = 0
+        self.write_header(mode)
+        return
+
+    def write_header(self, mode):
+        names = b"\x00".join([r.encode("ascii") for r in self.registers]) + b"\x00"
+        size = struct.calcsize(HEADER_FORMAT) + len(names)
+        size += -size % 8
+        header = struct.pack(HEADER_FORMAT, TRACE_MAGIC, TRACE_VERSION, mode.get_id().value, len(self.registers), size)
+        self.fd.write( (header + names).ljust(size, b"\x00") )
+        return
+
+    def push(self, kind, size, aux, payload):
+        buf = self.buffer
+        buf.append( encode(kind, size, aux, payload) )
+        if payload > PAYLOAD_MASK:
+            buf.append( encode(REC_EXT, 0, 0, payload >> PAYLOAD_BITS) )
+        if len(buf) >= WRITER_BUFFER_SIZE:
+            self.flush()
+        return
+
+    def insn(self, pc, size):
+        self.push(REC_INSN, size, 0, pc)
+        return
+
+    def reg(self, index, value):
+        self.push(REC_REG, 0, index, value)
+        return
+
+    def mem_read(self, address, size):
+        self.push(REC_MEM_READ, size, 0, address)
+        return
+
+    def mem_write(self, address, size, value):
+        self.push(REC_MEM_WRITE, size, 0, address)
+        self.push(REC_VALUE, size, 0, value & 0xFFFFFFFFFFFFFFFF)
+        return
+
+    def flush(self):
+        self.count += len(self.buffer)
+        self.buffer.tofile(self.fd)
+        del self.buffer[:]
+        self.fd.flush()
+        return
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.flush()
+        self.fd.close()
+        self.fd = None
+        return
+
+
+class TraceReader:
+    """
+    Memory-maps a trace file for random access: records are decoded only when accessed.
+    """
+
+    def __init__(self, fpath, *args, **kwargs):
+        self.fpath = fpath
+        self.fd = open(fpath, "rb")
+        self.mm = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, arch, nregs, size = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise Exception("'%s' is not a cemu trace file" % fpath)
+        names = self.mm[struct.calcsize(HEADER_FORMAT):size].split(b"\x00")[:nregs]
+        self.arch = arch
+        self.registers = [n.decode("ascii") for n in names]
+        self.header_size = size
+        self.words = memoryview(self.mm)[size:].cast("Q")
+        return
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, i):
+        """
+        Returns the decoded record at index i, or a view (not a copy) of the raw
+        64-bit words for a slice.
+        """
+        if isinstance(i, slice):
+            return self.words[i]
+        return decode(self.words[i])
+
+    def value(self, i):
+        """
+        Returns the full payload of record i, including its EXT record if any.
+        """
+        payload = self.words[i] >> 16
+        if i + 1 < len(self.words) and self.words[i+1] & 0xf == REC_EXT:
+            payload |= (self.words[i+1] >> 16) << PAYLOAD_BITS
+        return payload
+
+    def records(self, start=0, stop=None):
+        """
+        Yields (index, kind, size, aux, value) for the records in [start, stop), EXT
+        records being folded in the record they complete.
+        """
+        stop = len(self.words) if stop is None else min(stop, len(self.words))
+        for i in range(start, stop):
+            kind, size, aux, payload = decode(self.words[i])
+            if kind == REC_EXT:
+                continue
+            yield (i, kind, size, aux, self.value(i))
+
+    def find_pc(self, pc):
+        """
+        Returns the sorted indexes of the INSN records at the given PC, searching the
+        raw file in a single pass rather than decoding every record.
+        """
+        indexes = []
+        words, find, base = self.words, self.mm.find, self.header_size + 1
+        last = len(words) - 1
+        # every byte but the first (kind and size) of the record
+        needle = struct.pack("<Q", encode(REC_INSN, 0, 0, pc))[1:]
+        pos = find(needle, base)
+        while pos != -1:
+            i, misaligned = divmod(pos - base, 8)
+            if not misaligned and words[i] & 0xf == REC_INSN:
+                # the payload holds the whole PC unless an EXT record completes it
+                whole = pc <= PAYLOAD_MASK and (i == last or words[i+1] & 0xf != REC_EXT)
+                if whole or self.value(i) == pc:
+                    indexes.append(i)
+            pos = find(needle, pos + 1)
+        return indexes
+
+    def count(self, kind):
+        """
+        Returns the number of records of the given kind, from the first byte of every
+        record rather than from the decoded records.
+        """
+        others = bytes([b for b in range(0x100) if b & 0xf != kind])
+        return len(self.mm[self.header_size::8].translate(None, others))
+
+    def format_record(self, record):
+        i, kind, size, aux, value = record
+        if kind == REC_INSN:
+            return "%d: insn %#x (size=%d)" % (i, value, size)
+        if kind == REC_REG:
+            name = self.registers[aux] if aux < len(self.registers) else "#%d" % aux
+            return "%d: reg %s = %#x" % (i, name, value)
+        return "%d: %s %#x (size=%d)" % (i, RECORD_NAMES.get(kind, "?"), value, size)
+
+    def close(self):
+        self.words.release()
+        self.mm.close()
+        self.fd.close()
+        return
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+Address breakpoints, with optional conditions on the register values and hit counts.
+
+The breakpoints are kept in a dict keyed by address, and the emulator installs one code
+hook per address, covering that single address: unicorn runs the rest of the code
+without calling back, and a hit is dispatched with a dict lookup.
+
+A condition is a disjunction (`or`, `||`) of conjunctions (`and`, `&&`) of comparisons
+between registers and integers (in any base), e.g. `EAX == 0xb and ECX != 0 or EBX > ESI`.
+"""
+
+import re
+import operator
+
+
+OPERATORS = {"==": operator.eq, "!=": operator.ne,
+             "<=": operator.le, ">=": operator.ge,
+             "<": operator.lt, ">": operator.gt,}
+
+COMPARISON = re.compile(r"^\s*(\w+)\s*(==|!=|<=|>=|<|>)\s*(\w+)\s*$")
+OR_SEPARATOR = re.compile(r"\s+or\s+|\|\|")
+AND_SEPARATOR = re.compile(r"\s+and\s+|&&")
+
+
+def parse_operand(text):
+    """
+    Returns an integer, or the upper case name of a register.
+    """
+    try:
+        return int(text, 0)
+    except ValueError:
+        return text.upper()
+
+
+def parse_condition(text):
+    """
+    Returns a condition as a list of conjunctions, each one being a list of
+    (left, operator, right) comparisons.
+    """
+    condition = []
+    for conjunction in OR_SEPARATOR.split(text.strip()):
+        comparisons = []
+        for comparison in AND_SEPARATOR.split(conjunction):
+            match = COMPARISON.match(comparison)
+            if match is None:
+                raise Exception("Invalid condition '%s'" % comparison.strip())
+            left, op, right = match.groups()
+            comparisons.append( (parse_operand(left), OPERATORS[op], parse_operand(right)) )
+        condition.append(comparisons)
+    return condition
+
+
+def get_condition_registers(condition):
+    return sorted(set([operand for conjunction in condition for comparison in conjunction
+                       for operand in (comparison[0], comparison[2]) if isinstance(operand, str)]))
+
+
+class Breakpoint:
+    """
+    Stops the emulation before the instruction at `address`, from its `hit_count`-th
+    hit on. A hit is only counted when `condition` (see `parse_condition`) holds.
+    """
+
+    def __init__(self, address, condition=None, hit_count=1, *args, **kwargs):
+        self.address = address
+        self.text = condition
+        self.condition = parse_condition(condition) if condition else None
+        self.registers = get_condition_registers(self.condition) if self.condition else []
+        # ids of `registers` for the register reads, see `resolve`
+        self.register_ids = None
+        self.hit_count = hit_count
+        self.hits = 0
+        return
+
+
+    def resolve(self, unicorn_register):
+        """
+        Looks the registers of the condition up once, with `unicorn_register(name)`
+        returning their id (and raising for an unknown one).
+        """
+        self.register_ids = [unicorn_register(reg) for reg in self.registers]
+        return
+
+
+    def __str__(self):
+        text = "%#x" % self.address
+        if self.hit_count > 1:
+            text += " after %d" % self.hit_count
+        if self.text:
+            text += " if %s" % self.text
+        return text
+
+
+    def as_dict(self):
+        return {"address": self.address, "condition": self.text, "hit_count": self.hit_count, "hits": self.hits}
+
+
+    def evaluate(self, reg_read):
+        """
+        Returns True if the condition holds, reading each of its registers once with
+        `reg_read(id)`.
+        """
+        if self.condition is None:
+            return True
+        values = dict(zip(self.registers, [reg_read(i) for i in self.register_ids]))
+        for conjunction in self.condition:
+            for left, op, right in conjunction:
+                if not op(values.get(left, left), values.get(right, right)):
+                    break
+            else:
+                return True
+        return False
+
+
+    def hit(self, reg_read):
+        """
+        Counts a hit if the condition holds, and returns True if the emulation must stop.
+        """
+        if not self.evaluate(reg_read):
+            return False
+        self.hits += 1
+        return self.hits >= self.hit_count
+
+
+def parse_breakpoint(text):
+    """
+    Parses a breakpoint of the form `address [after N] [if CONDITION]` (hexadecimal
+    address), stopping on the Nth hit where the condition holds.
+    """
+    text = text.strip()
+    condition = None
+    if " if " in " %s " % text:
+        text, condition = re.split(r"\s*\bif\b\s*", text, 1)
+    parts = text.split()
+    if len(parts) not in (1, 3) or (len(parts) == 3 and parts[1] != "after"):
+        raise Exception("Invalid breakpoint '%s'" % text)
+    hit_count = int(parts[2], 0) if len(parts) == 3 else 1
+    return Breakpoint(int(parts[0], 0x10), condition or None, hit_count)
+
+
+class BreakpointSet:
+
+    def __init__(self, *args, **kwargs):
+        # address -> breakpoints at that address
+        self.breakpoints = {}
+        return
+
+
+    def __len__(self):
+        return len(self.breakpoints)
+
+
+    def __iter__(self):
+        for address in sorted(self.breakpoints.keys()):
+            for bp in self.breakpoints[address]:
+                yield bp
+        return
+
+
+    def add(self, breakpoint):
+        self.breakpoints.setdefault(breakpoint.address, []).append(breakpoint)
+        return breakpoint
+
+
+    def remove(self, breakpoint):
+        bps = self.breakpoints[breakpoint.address]
+        bps.remove(breakpoint)
+        if len(bps) == 0:
+            del self.breakpoints[breakpoint.address]
+        return
+
+
+    def clear(self):
+        self.breakpoints.clear()
+        return
+
+
+    def get(self, address):
+        return self.breakpoints.get(address, [])
+
+
+    def addresses(self):
+        return sorted(self.breakpoints.keys())
@@ -5,7 +5,8 @@ import os
 import functools
 import time
 import tempfile
-import binascii
+import array
+import itertools
 
 import unicorn
 
@@ -20,20 +21,38 @@ except ImportError:
     #   For IDA 6.9 and newer using PyQt5
     from PyQt5 import QtGui, QtWidgets, QtCore
     from PyQt5.QtCore import Qt
+    from PyQt5.QtGui import *
+    from PyQt5.QtWidgets import *
 
 
-from pygments import highlight
-from pygments.lexers import *
+from pygments.lexers import get_lexer_by_name
+from pygments.lexer import RegexLexer
 from pygments.formatter import Formatter
+from pygments.token import Token, Whitespace, Error
 
 from .arch import Architecture, modes, Mode
 from .emulator import Emulator
 from .utils import *
+from .disasm import disasm_lines
+from .profiler import PROFILE_SAMPLE_INTERVAL
+from .watch import AccessStats, parse_watchpoint, ACCESS_STATS_PAGE, ACCESS_STATS_AREA
+from .breakpoints import parse_breakpoint
+from .syscalls import SyscallLayer
+from .trace import format_record, parse_trace_range, TRACE_LEVELS, TRACE_LEVEL_MEMORY
 
 
 WINDOW_SIZE = (1600, 800)
 ICON = os.path.dirname(os.path.realpath(__file__)) + "/icon.png"
 TITLE = "Cheap EMUlator"
+TRACE_FLUSH_INTERVAL = 200 # ms
+TRACE_VISIBLE_LINES = 1000
+HIGHLIGHT_CACHE_SIZE = 8192
+MEMORY_VIEW_ROW_SIZE = 0x10
+MEMORY_VIEW_PAGE_SIZE = 0x1000
+MEMORY_VIEW_CACHE_PAGES = 16
+MEMORY_VIEW_DEBOUNCE = 250 # ms
+DISASM_FEED_INTERVAL = 20 # ms
+DISASM_FEED_LINES = 5000
 
 
 class QFormatter(Formatter):
@@ -66,35 +85,159 @@ class QFormatter(Formatter):
         return QColor(r,g,b)
 
 
+    def get_style(self, ttype):
+        """
+        Returns the format of a token type, falling back on its closest styled parent.
+        """
+        t = str(ttype)
+        qtf = self.styles.get(t)
+        if qtf is None:
+            parent = ttype.parent
+            qtf = self.get_style(parent) if parent is not None else QTextCharFormat()
+            self.styles[t] = qtf
+        return qtf
+
+
     def format(self, tokensource, outfile):
         self.data=[]
         for ttype, value in tokensource:
             l=len(value)
-            t=str(ttype)
-            self.data.extend([self.styles[t],]*l)
+            self.data.extend([self.get_style(ttype),]*l)
         return
 
 
+def lex_block(lexer, text, stack):
+    """
+    Tokenizes one block of text starting from the given lexer state stack, and returns
+    the list of (position, token type) along with the state stack at the end of the
+    block. This is the algorithm of pygments' RegexLexer.get_tokens_unprocessed, which
+    does not give its final state back: it walks the compiled states of the lexer, and
+    the highlighter falls back to `get_tokens` if they are missing or do not fit.
+    """
+    pos = 0
+    tokens = []
+    tokendefs = lexer._tokens
+    statestack = list(stack)
+    statetokens = tokendefs[statestack[-1]]
+    while True:
+        for rexmatch, action, new_state in statetokens:
+            m = rexmatch(text, pos)
+            if not m:
+                continue
+            if action is not None:
+                if action in Token:
+                    tokens.append( (pos, action) )
+                else:
+                    tokens.extend( [(i, t) for i, t, v in action(lexer, m)] )
+            pos = m.end()
+            if new_state is not None:
+                if isinstance(new_state, tuple):
+                    for state in new_state:
+                        if state == '#pop':
+                            if len(statestack) > 1:
+                                statestack.pop()
+                        elif state == '#push':
+                            statestack.append(statestack[-1])
+                        else:
+                            statestack.append(state)
+                elif isinstance(new_state, int):
+                    if abs(new_state) >= len(statestack):
+                        del statestack[1:]
+                    else:
+                        del statestack[new_state:]
+                elif new_state == '#push':
+                    statestack.append(statestack[-1])
+                statetokens = tokendefs[statestack[-1]]
+            break
+        else:
+            if pos >= len(text):
+                break
+            if text[pos] == '\n':
+                statestack = ['root']
+                statetokens = tokendefs['root']
+                tokens.append( (pos, Whitespace) )
+            else:
+                tokens.append( (pos, Error) )
+            pos += 1
+
+    return tokens, tuple(statestack)
+
+
 class Highlighter(QSyntaxHighlighter):
+    """
+    Incremental highlighter: Qt only asks for the blocks that changed (and the following
+    ones while their starting state changes), each block is lexed alone from the lexer
+    state left by the previous one, and the format runs are cached by (state, text).
+    """
+
     def __init__(self, parent, mode):
         QSyntaxHighlighter.__init__(self, parent)
-        self.tstamp=time.time()
         self.formatter=QFormatter()
         self.lexer=get_lexer_by_name(mode)
+        # blocks are lexed from the state of the previous one when the lexer exposes its
+        # compiled states (see `lex_block`), each one on its own otherwise
+        self.incremental = isinstance(self.lexer, RegexLexer) and isinstance(getattr(self.lexer, "_tokens", None), dict)
+        # lexer state stacks are stored in the blocks as indexes in this list
+        self.states = [("root",),]
+        self.state_ids = {("root",): 0}
+        self.cache = LRUCache(HIGHLIGHT_CACHE_SIZE)
         return
 
 
-    def highlightBlock(self, text):
-        cb = self.currentBlock()
-        p = cb.position()
-        text = self.document().toPlainText() +'\n'
-        highlight(str(text),self.lexer,self.formatter)
-        for i in range(len(str(text))):
+    def get_state_id(self, stack):
+        i = self.state_ids.get(stack)
+        if i is None:
+            i = len(self.states)
+            self.states.append(stack)
+            self.state_ids[stack] = i
+        return i
+
+
+    def lex(self, text, state):
+        """
+        Returns the list of (start, length, format) runs of a block, and the lexer
+        state at its end.
+        """
+        text = text + '\n'
+        if self.incremental:
             try:
-                self.setFormat(i,1,self.formatter.data[p+i])
-            except IndexError:
-                pass
-        self.tstamp = time.time()
+                tokens, stack = lex_block(self.lexer, text, self.states[state])
+                state = self.get_state_id(stack)
+            except Exception:
+                # the internals of this pygments version differ, stop relying on them
+                self.incremental = False
+                self.cache.clear()
+        if not self.incremental:
+            state = 0
+            tokens, pos = [], 0
+            for ttype, value in self.lexer.get_tokens(text):
+                tokens.append( (pos, ttype) )
+                pos += len(value)
+
+        runs = []
+        for i, (pos, ttype) in enumerate(tokens):
+            end = tokens[i+1][0] if i+1 < len(tokens) else len(text)
+            fmt = self.formatter.get_style(ttype)
+            if runs and runs[-1][2] is fmt and runs[-1][0] + runs[-1][1] == pos:
+                runs[-1] = (runs[-1][0], runs[-1][1] + end - pos, fmt)
+            else:
+                runs.append( (pos, end - pos, fmt) )
+        return runs, state
+
+
+    def highlightBlock(self, text):
+        text = str(text)
+        state = max(self.previousBlockState(), 0)
+        key = (state, text)
+        cached = self.cache.get(key)
+        if cached is None:
+            cached = self.lex(text, state)
+            self.cache.put(key, cached)
+
+        runs, state = cached
+        for start, length, fmt in runs:
+            self.setFormat(start, length, fmt)
+        self.setCurrentBlockState(state)
         return
 
 
@@ -145,19 +288,7 @@ class CodeWidget(QWidget):
         """
         Returns the code pane content cleaned of all comments.
         """
-        comment_tags = ["#", ";", "--",]
-        clean = []
-        for line in code:
-            line = line.strip()
-            if len(line)==0:
-                continue
-            c = line[0]
-            if sys.version_info.major == 3:
-                c = chr(line[0])
-            if c in comment_tags:
-                continue
-            clean.append(line)
-
+        clean = get_clean_code(code)
         if as_string:
             return b"\n".join(clean)
 
@@ -169,30 +300,7 @@ class CodeWidget(QWidget):
         This function will search for every line of assembly for quote(")
         pattern and convert it as a hexadecimal number.
         """
-        parsed = []
-        for line in code:
-            i = line.find(b'"')
-            if i==-1:
-                # no string
-                parsed.append(line)
-                continue
-
-            j = line[i+1:].find(b'"')
-            if j==-1:
-                # unfinished string
-                parsed.append(line)
-                continue
-
-            if (j*8) != self.parent.parent.emulator.mode.get_memory_alignment():
-                # incorrect size
-                parsed.append(line)
-                continue
-
-            origstr = line[i+1:i+j+1]
-            hexstr  = binascii.hexlify(origstr)
-            newline = line.replace(b'"%s"'%origstr, b'0x%s'%hexstr)
-            parsed.append(newline)
-
+        parsed = parse_string_in_code(code, self.parent.parent.emulator.mode)
         if as_string:
             return b'\n'.join(parsed)
 
@@ -203,7 +311,7 @@ class MemoryMappingWidget(QWidget):
     def __init__(self, *args, **kwargs):
         super(MemoryMappingWidget, self).__init__()
         layout = QVBoxLayout()
-        label = QLabel("Memory Mapping (name   address  size   permission   [input_file])")
+        label = QLabel("Memory Mapping (name   address  size   permission   [input_file [offset]])")
         self.editor = QTextEdit()
         self.editor.setFont(QFont('Courier', 11))
         self.editor.setFrameStyle(QFrame.Panel | QFrame.Plain)
@@ -214,31 +322,12 @@ class MemoryMappingWidget(QWidget):
         return
 
     def setDefaultMemoryLayout(self):
-        txt = [".text   0x40000   0x1000   READ|EXEC",
-               ".data   0x60000   0x1000   READ|WRITE",
-               ".stack  0x800000  0x4000   READ|WRITE",
-               ".misc   0x1000000 0x1000   ALL"]
-        self.editor.insertPlainText("\n".join(txt))
+        self.editor.insertPlainText("\n".join(DEFAULT_MEMORY_LAYOUT))
         return
 
     def getMappings(self):
-        maps = []
         lines = self.editor.toPlainText().split("\n")
-        for line in lines:
-            line = str(line).strip()
-            if line.startswith("#"):
-                continue
-
-            parts = line.split()
-            read_from_file = None
-            if len(parts)==5:
-                read_from_file = parts[4]
-
-            name, address, size, permission = parts[0:4]
-            address = int(address, 0x10)
-            size = int(size, 0x10)
-            maps.append( [name, address, size, permission, read_from_file] )
-        return maps
+        return parse_mappings(lines)
 
 
 class EmulatorWidget(QWidget):
@@ -251,6 +340,7 @@ class EmulatorWidget(QWidget):
         self.editor.setFont(QFont('Courier', 11))
         self.editor.setFrameStyle(QFrame.Panel | QFrame.Plain)
         self.editor.setReadOnly(True)
+        self.editor.document().setMaximumBlockCount(TRACE_VISIBLE_LINES)
         layout.addWidget(label)
         layout.addWidget(self.editor)
         self.setLayout(layout)
@@ -287,6 +377,33 @@ class CommandWidget(QWidget):
         self.stopButton.clicked.connect( self.parent.stopCode )
         self.checkAsmButton = QPushButton("Check assembly code")
         self.checkAsmButton.clicked.connect( self.parent.checkAsmCode )
+        self.traceLevel = QComboBox()
+        for name, level in sorted(TRACE_LEVELS.items(), key=lambda x: x[1]):
+            self.traceLevel.addItem("Trace: %s" % name, level)
+        self.traceLevel.setCurrentIndex(TRACE_LEVEL_MEMORY)
+        self.traceRange = QLineEdit()
+        self.traceRange.setPlaceholderText("trace range (start-end)")
+        self.breakpoints = QLineEdit()
+        self.breakpoints.setPlaceholderText("breakpoints (address [after N] [if REG == value]; ...)")
+        self.watchpoints = QLineEdit()
+        self.watchpoints.setPlaceholderText("watchpoints (start-end[:rw][:stop] ...)")
+        self.accessStats = QComboBox()
+        self.accessStats.addItem("Accesses: off", None)
+        self.accessStats.addItem("Accesses: per page", ACCESS_STATS_PAGE)
+        self.accessStats.addItem("Accesses: per area", ACCESS_STATS_AREA)
+        self.stats = QComboBox()
+        self.stats.addItem("Stats: off", False)
+        self.stats.addItem("Stats: on", True)
+        self.syscalls = QComboBox()
+        self.syscalls.addItem("Syscalls: off", False)
+        self.syscalls.addItem("Syscalls: Linux", True)
+        layout.addWidget(self.traceLevel)
+        layout.addWidget(self.traceRange)
+        layout.addWidget(self.breakpoints)
+        layout.addWidget(self.watchpoints)
+        layout.addWidget(self.accessStats)
+        layout.addWidget(self.stats)
+        layout.addWidget(self.syscalls)
         layout.addWidget(self.runButton)
         layout.addWidget(self.stepButton)
         layout.addWidget(self.stopButton)
@@ -295,57 +412,124 @@ class CommandWidget(QWidget):
         return
 
 
+class RegistersModel(QtCore.QAbstractTableModel):
+    """
+    Register names and values of the current mode: on each update, only the rows whose
+    value changed are signaled to the view, and drawn in red.
+    """
+    columns = ["Register", "Value"]
+
+    def __init__(self, mode, *args, **kwargs):
+        super(RegistersModel, self).__init__()
+        self.mode = mode
+        self.reset()
+        return
+
+
+    def reset(self):
+        self.beginResetModel()
+        self.registers = list(self.mode.get_registers())
+        self.values = array.array("Q", [0] * len(self.registers))
+        self.changed = set()
+        self.endResetModel()
+        return
+
+
+    def update(self, values):
+        """
+        Takes the new values (in the order of the mode registers), and signals the rows
+        that differ from the previous ones, or that were drawn as changed.
+        """
+        if len(values) != len(self.values):
+            self.reset()
+        changed = set([i for i, (old, new) in enumerate(zip(self.values, values)) if old != new])
+        self.values[:] = array.array("Q", values)
+        rows = changed | self.changed
+        self.changed = changed
+        for row in sorted(rows):
+            index = self.index(row, 1)
+            self.dataChanged.emit(index, index)
+        return
+
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return len(self.registers)
+
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self.columns)
+
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.columns[section]
+        return None
+
+
+    def flags(self, index):
+        if index.column() == 1:
+            return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+        return Qt.NoItemFlags
+
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, col = index.row(), index.column()
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            if col == 0:
+                return self.registers[row]
+            return format_address(self.values[row], self.mode)
+        if role == Qt.ForegroundRole and col == 1 and row in self.changed:
+            return QColor(Qt.red)
+        return None
+
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or index.column() != 1:
+            return False
+        try:
+            self.values[index.row()] = int(str(value), 16)
+        except (ValueError, OverflowError):
+            return False
+        self.dataChanged.emit(index, index)
+        return True
+
+
 class RegistersWidget(QWidget):
     def __init__(self, parent, *args, **kwargs):
         super(RegistersWidget, self).__init__()
         self.parent = parent
-        self.old_register_values = {}
         layout = QVBoxLayout()
         label = QLabel("Registers")
-        self.values = QTableWidget(10, 2)
+        self.model = RegistersModel(self.parent.parent.mode)
+        self.values = QTableView()
+        self.values.setModel(self.model)
+        self.values.verticalHeader().hide()
         self.values.horizontalHeader().setStretchLastSection(True)
-        self.values.setHorizontalHeaderLabels(["Register", "Value"])
         layout.addWidget(label)
         layout.addWidget(self.values)
         self.setLayout(layout)
         self.updateGrid()
         return
 
-    def updateGrid(self):
+    def updateGrid(self, values=None):
+        """
+        Refreshes the values from the ones given (see `Emulator.read_registers`), or
+        read from the VM.
+        """
         emu = self.parent.parent.emulator
-        current_mode = self.parent.parent.mode
-        registers = current_mode.get_registers()
-        self.values.setRowCount(len(registers))
-        for i, reg in enumerate(registers):
-            name = QTableWidgetItem(reg)
-            name.setFlags(Qt.NoItemFlags)
+        if self.model.registers != self.parent.parent.mode.get_registers():
+            self.model.reset()
+        if values is None:
             if emu.vm is None:
-                val = 0
-            else:
-                val = emu.get_register_value(reg)
-            old_val = self.old_register_values.get(reg, 0)
-            if val.__class__.__name__ == "int":
-                value = format_address(val, current_mode)
-            else:
-                value = str(val)
-            value = QTableWidgetItem( value )
-            if old_val != val:
-                self.old_register_values[reg] = val
-                value.setForeground(QColor(Qt.red))
-            value.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable)
-            self.values.setItem(i, 0, name)
-            self.values.setItem(i, 1, value)
+                return
+            values = emu.read_registers()
+        self.model.update(values)
         return
 
     def getRegisters(self):
-        regs = {}
-        current_mode = self.parent.parent.mode
-        registers = current_mode.get_registers()
-        for i, reg in enumerate(registers):
-            name = self.values.item(i, 0).text()
-            value = str(self.values.item(i, 1).text())
-            regs[name] = int(value, 16)
-        return regs
+        return dict( zip(self.model.registers, self.model.values) )
 
 
 class ScratchboardWidget(QWidget):
@@ -364,6 +548,87 @@ class ScratchboardWidget(QWidget):
         return
 
 
+class MemoryModel(QtCore.QAbstractTableModel):
+    """
+    Hex view of one mapped area, 16 bytes per row: only the rows Qt asks for are
+    rendered, from pages read from the VM on demand and kept in a small cache.
+    """
+    columns = ["Address", "Hex", "ASCII"]
+
+    def __init__(self, emu, *args, **kwargs):
+        super(MemoryModel, self).__init__()
+        self.emu = emu
+        self.base = 0
+        self.size = 0
+        self.pages = LRUCache(MEMORY_VIEW_CACHE_PAGES)
+        # set while the emulation thread owns the VM: unicorn is not thread-safe, so only
+        # the cached pages are shown until the run ends
+        self.frozen = False
+        return
+
+
+    def setArea(self, base, size):
+        self.beginResetModel()
+        self.base, self.size = base, size
+        self.pages.clear()
+        self.endResetModel()
+        return
+
+
+    def refresh(self):
+        """
+        Drops the cached pages, and has the view re-fetch the rows it displays.
+        """
+        self.pages.clear()
+        if self.size > 0:
+            self.dataChanged.emit(self.index(0, 0), self.index(self.rowCount()-1, len(self.columns)-1))
+        return
+
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return (self.size + MEMORY_VIEW_ROW_SIZE - 1) // MEMORY_VIEW_ROW_SIZE
+
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self.columns)
+
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.columns[section]
+        return None
+
+
+    def readRow(self, row):
+        offset = row * MEMORY_VIEW_ROW_SIZE
+        page_offset = offset - offset % MEMORY_VIEW_PAGE_SIZE
+        page = self.pages.get(page_offset)
+        if page is None:
+            if self.frozen:
+                return b""
+            length = min(MEMORY_VIEW_PAGE_SIZE, self.size - page_offset)
+            try:
+                page = bytes(self.emu.vm.mem_read(self.base + page_offset, length))
+            except unicorn.unicorn.UcError:
+                page = b""
+            self.pages.put(page_offset, page)
+        start = offset - page_offset
+        return page[start:start + MEMORY_VIEW_ROW_SIZE]
+
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid() or self.emu.vm is None:
+            return None
+        row, col = index.row(), index.column()
+        addr = self.base + row * MEMORY_VIEW_ROW_SIZE
+        if col == 0:
+            return format_address(addr, self.emu.mode)
+        data = self.readRow(row)
+        if col == 1:
+            return hexdump(data, show_raw=True)
+        return ''.join( [chr(c) if 0x20 <= c < 0x7F else '.' for c in data] )
+
+
 class MemoryWidget(QWidget):
     def __init__(self, parent, *args, **kwargs):
         super(MemoryWidget, self).__init__()
@@ -371,61 +636,141 @@ class MemoryWidget(QWidget):
         layout = QVBoxLayout()
         label = QLabel("Memory viewer")
         self.address = QLineEdit()
-        self.address.textChanged.connect( self.updateEditor )
-        self.editor = QTextEdit()
+        self.address.setPlaceholderText("address or @area")
+        # only jump once the user stopped typing
+        self.addressTimer = QtCore.QTimer(self)
+        self.addressTimer.setSingleShot(True)
+        self.addressTimer.setInterval(MEMORY_VIEW_DEBOUNCE)
+        self.addressTimer.timeout.connect( self.gotoAddress )
+        self.address.textChanged.connect( self.addressTimer.start )
+        self.status = QLabel("")
+        self.model = MemoryModel(self.parent.parent.emulator)
+        self.editor = QTableView()
+        self.editor.setModel(self.model)
         self.editor.setFrameStyle(QFrame.Panel | QFrame.Plain)
         self.editor.setFont(QFont('Courier', 10))
-        self.editor.setReadOnly(True)
+        self.editor.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.editor.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.editor.verticalHeader().hide()
+        self.editor.verticalHeader().setDefaultSectionSize(QFontMetrics(self.editor.font()).height() + 2)
+        self.editor.horizontalHeader().setStretchLastSection(True)
         layout.addWidget(label)
         layout.addWidget(self.address)
+        layout.addWidget(self.status)
         layout.addWidget(self.editor)
         self.setLayout(layout)
         return
 
-    def updateEditor(self):
+    def parseAddress(self):
+        emu = self.parent.parent.emulator
+        addr = str(self.address.text()).strip()
+        if addr.startswith("@"):
+            return emu.lookup_map(addr[1:])
+        try:
+            return int(addr, 16)
+        except ValueError:
+            return None
+
+    def gotoAddress(self):
         emu = self.parent.parent.emulator
         if emu.vm is None:
-            self.editor.setText("VM not running")
+            self.status.setText("VM not running")
             return
 
-        addr = str(self.address.text())
-        if addr.startswith("0x") or addr.startswith("0X"):
-            addr = addr[2:]
+        addr = self.parseAddress()
+        if addr is None:
+            return
 
-        if addr.startswith("@"):
-            addr = emu.lookup_map(addr[1:])
-            if addr is None:
-                return
-        else:
-            if not addr.isdigit():
-                return
-            addr = int(addr, 16)
+        area = emu.find_area(addr)
+        if area is None:
+            self.status.setText("Cannot read at address %x" % addr)
+            return
 
-        try:
-            l = 256
-            data = emu.vm.mem_read(addr, l)
-        except unicorn.unicorn.UcError:
-            self.editor.setText("Cannot read at address %x" % addr)
+        name, base, size = area
+        if (self.model.base, self.model.size) != (base, size):
+            self.model.setArea(base, size)
+        self.status.setText("%s: %#x-%#x" % (name, base, base + size))
+        row = (addr - base) // MEMORY_VIEW_ROW_SIZE
+        self.editor.scrollTo(self.model.index(row, 0), QAbstractItemView.PositionAtTop)
+        self.editor.selectRow(row)
+        return
+
+    def updateEditor(self):
+        emu = self.parent.parent.emulator
+        if emu.vm is None:
+            self.model.setArea(0, 0)
+            self.status.setText("VM not running")
             return
 
-        text = hexdump(data, base=addr)
-        self.editor.setText(text)
+        if self.model.size == 0:
+            self.gotoAddress()
+            return
+
+        self.model.refresh()
+        return
+
+
+class EmulationThread(QtCore.QThread):
+    """
+    Runs the emulator off the UI thread, so that the window stays responsive and the
+    emulation can be interrupted.
+    """
+
+    def __init__(self, emu, *args, **kwargs):
+        super(EmulationThread, self).__init__()
+        self.emu = emu
+        return
+
+
+    def run(self):
+        self.emu.run()
         return
 
 
 class CanvasWidget(QWidget):
+    logMessage = QtCore.pyqtSignal(str)
+    traceMessage = QtCore.pyqtSignal(str)
+    emulationProgress = QtCore.pyqtSignal(object, object, object, object)
 
     def __init__(self, parent, *args, **kwargs):
         super(CanvasWidget, self).__init__()
         self.parent = parent
         self.emu = self.parent.emulator
         self.emu.widget = self
+        self.emu.progress_callback = self.emulationProgress.emit
+        self.emuThread = None
+        self.baseSnapshot = None
+        self.baseImageKey = None
+        # breakpoints and watchpoints currently set in the emulator
+        self.breakText = ""
+        self.watchText = ""
         self.setCanvasWidgetLayout()
+        self.logMessage.connect( self.logWidget.editor.append )
+        self.traceMessage.connect( self.emuWidget.editor.append )
+        self.emulationProgress.connect( self.updateProgress )
         self.commandWidget.stopButton.setDisabled(True)
+        self.traceTimer = QtCore.QTimer(self)
+        self.traceTimer.timeout.connect( self.flushTrace )
+        self.traceTimer.start(TRACE_FLUSH_INTERVAL)
         self.show()
         return
 
 
+    def flushTrace(self):
+        """
+        Renders in one go the tail of the trace records pushed since the last flush.
+        """
+        count, records = self.emu.trace.drain(TRACE_VISIBLE_LINES)
+        if count == 0:
+            return
+        lines = []
+        if count > len(records):
+            lines.append(">>> [%d trace records not shown, use 'Save Trace' to get them]" % (count - len(records)))
+        lines.extend( [format_record(r) for r in records] )
+        self.emuWidget.editor.append("\n".join(lines))
+        return
+
+
     def setCanvasWidgetLayout(self):
         self.codeWidget = CodeWidget(self)
         self.mapWidget = MemoryMappingWidget(self)
@@ -464,13 +809,34 @@ class CanvasWidget(QWidget):
         return
 
 
+    def getBaseImageKey(self, maps):
+        """
+        Identifies the base image built from the mappings, input files included.
+        """
+        key = [self.emu.mode.get_id(),]
+        for name, address, size, permission, input_file, offset in maps:
+            mtime = None
+            if input_file is not None and os.access(input_file, os.R_OK):
+                mtime = os.path.getmtime(input_file)
+            key.append( (name, address, size, permission, input_file, offset, mtime) )
+        return key
+
+
     def loadContext(self):
         self.logWidget.editor.append("Starting new emulation")
-        self.emu.reinit()
-        self.emuWidget.editor.clear()
         maps = self.mapWidget.getMappings()
-        if not self.emu.populate_memory(maps):
-            return False
+        key = self.getBaseImageKey(maps)
+        if self.emu.vm is not None and self.baseSnapshot is not None and key == self.baseImageKey:
+            # same mappings as the previous run: only rewind the VM
+            self.emu.restore(self.baseSnapshot)
+        else:
+            self.emu.reinit()
+            self.baseSnapshot = None
+            if not self.emu.populate_memory(maps):
+                return False
+            self.baseSnapshot = self.emu.snapshot()
+            self.baseImageKey = key
+        self.emuWidget.editor.clear()
         code = self.codeWidget.getCleanCodeAsByte(as_string=False, parse_string=True)
         if not self.emu.compile_code(code):
             return False
@@ -483,10 +849,15 @@ class CanvasWidget(QWidget):
 
 
     def stopCode(self):
+        if self.isEmulating():
+            self.emu.request_stop()
+            self.logWidget.editor.append("Stopping emulation")
+            return
         if not self.emu.is_running:
             self.logWidget.editor.append("No emulation context loaded.")
             return
-        self.emu.stop()
+        # the VM is kept, and rewound from the base snapshot on the next run
+        self.emu.is_running = False
         self.regWidget.updateGrid()
         self.logWidget.editor.append("Emulation context reset")
         self.commandWidget.stopButton.setDisabled(True)
@@ -517,13 +888,130 @@ class CanvasWidget(QWidget):
             self.emu.is_running = True
             self.commandWidget.stopButton.setDisabled(False)
 
-        self.emu.run()
+        try:
+            self.emu.trace_range = parse_trace_range(str(self.commandWidget.traceRange.text()))
+        except Exception:
+            self.logWidget.editor.append("Invalid trace range, tracing the whole address space")
+            self.emu.trace_range = None
+        self.emu.trace_level = self.commandWidget.traceLevel.currentIndex()
+        self.updateBreakpoints()
+        self.updateWatchpoints()
+        self.updateInstrumentation()
+
+        self.commandWidget.runButton.setDisabled(True)
+        self.commandWidget.stepButton.setDisabled(True)
+        self.memWidget.model.frozen = True
+        self.emuThread = EmulationThread(self.emu)
+        self.emuThread.finished.connect( self.onEmulationFinished )
+        self.emuThread.start()
+        return
+
+
+    def updateBreakpoints(self):
+        """
+        Applies the breakpoints to the next run: their hooks follow without rebuilding
+        the VM, and the hit counts are kept while the text is unchanged.
+        """
+        text = str(self.commandWidget.breakpoints.text())
+        if text == self.breakText:
+            return
+        self.emu.breakpoints.clear()
+        try:
+            for spec in text.split(";"):
+                if len(spec.strip()):
+                    bp = parse_breakpoint(spec)
+                    self.emu.add_breakpoint(bp.address, bp.text, bp.hit_count)
+            self.breakText = text
+        except Exception as e:
+            self.logWidget.editor.append("Invalid breakpoints: %s" % e)
+            self.emu.breakpoints.clear()
+            self.breakText = None
+        return
+
+
+    def updateWatchpoints(self):
+        """
+        Applies the watchpoints and access statistics settings to the next run; the
+        hooks follow without rebuilding the VM.
+        """
+        text = str(self.commandWidget.watchpoints.text())
+        if text != self.watchText:
+            self.emu.watch_index.clear()
+            try:
+                for spec in text.replace(",", " ").split():
+                    self.emu.watch_index.add(parse_watchpoint(spec))
+                self.watchText = text
+            except Exception as e:
+                self.logWidget.editor.append("Invalid watchpoints: %s" % e)
+                self.emu.watch_index.clear()
+                self.watchText = None
+
+        granularity = self.commandWidget.accessStats.itemData(self.commandWidget.accessStats.currentIndex())
+        current = self.emu.access_stats.granularity if self.emu.access_stats is not None else None
+        if granularity != current:
+            self.emu.access_stats = AccessStats(granularity) if granularity is not None else None
+        return
+
+
+    def updateInstrumentation(self):
+        """
+        Applies the stats and syscall settings to the next run.
+        """
+        # the hooks are wrapped or unwrapped on the next run
+        self.emu.stats.enabled = self.commandWidget.stats.itemData(self.commandWidget.stats.currentIndex())
+        syscalls = self.commandWidget.syscalls.itemData(self.commandWidget.syscalls.currentIndex())
+        if syscalls and self.emu.syscalls is None:
+            self.emu.syscalls = SyscallLayer()
+        elif not syscalls and self.emu.syscalls is not None:
+            # the memory mapped by the guest goes away with the layer
+            self.emu.syscalls.reset(self.emu.vm)
+            self.emu.syscalls = None
+        return
+
+
+    def isEmulating(self):
+        return self.emuThread is not None and self.emuThread.isRunning()
+
+
+    def updateProgress(self, count, pc, elapsed, registers):
+        """
+        Called (at a capped rate) with the progress of the emulation thread.
+        """
+        if not self.isEmulating():
+            return
+        msg = "Running: %d instructions executed, pc=%s, %.2fs elapsed" % (count, format_address(pc, self.emu.mode), elapsed)
+        self.parent.statusBar().showMessage(msg)
+        self.regWidget.updateGrid(registers)
+        # the memory is refreshed once the run ends, as reading it now would race with the
+        # emulation thread
+        return
+
+
+    def onEmulationFinished(self):
+        self.emuThread = None
+        self.flushTrace()
+        msg = "%d instructions executed" % self.emu.executed_insns
+        if self.emu.run_start is not None:
+            msg += " in %.2fs" % (time.time() - self.emu.run_start)
+        if self.emu.stop_reason is not None:
+            msg += ", stopped by: %s" % self.emu.stop_reason
+        self.parent.statusBar().showMessage(msg)
+
+        finished = self.emu.last_error is None and self.emu.is_finished()
+        if finished:
+            self.emuWidget.editor.append(">>> End of emulation")
+        self.commandWidget.runButton.setDisabled(finished)
+        self.commandWidget.stepButton.setDisabled(finished)
         self.regWidget.updateGrid()
+        self.memWidget.model.frozen = False
         self.memWidget.updateEditor()
         return
 
 
     def checkAsmCode(self):
+        if self.isEmulating():
+            self.logWidget.editor.append("Emulation in progress")
+            return
         code = self.codeWidget.getCleanCodeAsByte()
         self.emu.compile_code(code, False)
         return
@@ -580,6 +1068,25 @@ class EmulatorWindow(QMainWindow):
         saveBinAction.triggered.connect( self.saveCodeBin )
         saveBinAction.setStatusTip("Save the content of the raw binary pane in a file.")
 
+        saveTraceAction = QAction(QIcon(), "Save Trace", self)
+        saveTraceAction.triggered.connect( self.saveTrace )
+        saveTraceAction.setStatusTip("Save the buffered emulation trace in a file.")
+
+        binaryTraceAction = QAction(QIcon(), "Record Binary Trace", self)
+        binaryTraceAction.setCheckable(True)
+        binaryTraceAction.toggled.connect( self.toggleBinaryTrace )
+        binaryTraceAction.setStatusTip("Record the next runs in a compact binary trace file.")
+
+        self.profileAction = QAction(QIcon(), "Profile Hot Spots", self)
+        self.profileAction.setCheckable(True)
+        self.profileAction.toggled.connect( self.toggleProfile )
+        self.profileAction.setStatusTip("Count the executions of each block of .text, and show the hot spots in the log after each run.")
+
+        self.sampleAction = QAction(QIcon(), "Sample Hot Spots", self)
+        self.sampleAction.setCheckable(True)
+        self.sampleAction.toggled.connect( self.toggleSampling )
+        self.sampleAction.setStatusTip("Sample the PC every %dus instead of counting every block (nearly native speed)." % PROFILE_SAMPLE_INTERVAL)
+
         saveCAction = QAction(QIcon(), "Generate C code", self)
         saveCAction.triggered.connect( self.saveAsCFile )
         saveCAction.setStatusTip("Save the content as a compilable C file.")
@@ -601,14 +1108,27 @@ class EmulatorWindow(QMainWindow):
         fileMenu.addAction(loadBinAction)
         fileMenu.addAction(saveAsmAction)
         fileMenu.addAction(saveBinAction)
+        fileMenu.addAction(saveTraceAction)
+        fileMenu.addAction(binaryTraceAction)
+        fileMenu.addAction(self.profileAction)
+        fileMenu.addAction(self.sampleAction)
         fileMenu.addAction(saveCAction)
         fileMenu.addAction(saveAsAsmAction)
         fileMenu.addAction(quitAction)
 
-        archMenu = menubar.addMenu("&Architecture")
+        # the architecture actions are only created when the menu is first opened
+        self.archMenu = menubar.addMenu("&Architecture")
+        self.archMenu.aboutToShow.connect( self.populateArchMenu )
+        self.currentAction = None
+        return
+
+
+    def populateArchMenu(self):
+        if self.currentAction is not None:
+            return
 
         for arch in modes.keys():
-            archSubMenu = archMenu.addMenu(arch)
+            archSubMenu = self.archMenu.addMenu(arch)
             for idx, title, _, _, _ in modes[arch]:
                 archAction = QAction(QIcon(), title, self)
                 if self.mode.get_id() == idx:
@@ -629,16 +1149,54 @@ class EmulatorWindow(QMainWindow):
             return
 
         if run_disassembler:
-            body = disassemble_file(qFile, self.mode)
-        else:
-            with open(qFile, 'r') as f:
-                body = f.read()
+            self.loadDisassembly(qFile)
+            return
+
+        self.stopDisassembly()
+        with open(qFile, 'r') as f:
+            body = f.read()
 
         self.canvas.codeWidget.editor.setPlainText( body )
         self.canvas.logWidget.editor.append("Loaded '%s'" % qFile)
         return
 
 
+    def loadDisassembly(self, fpath):
+        """
+        Streams the disassembly of a raw file to the Code editor, DISASM_FEED_LINES lines
+        at a time from a timer, so that the window stays responsive with large files.
+        """
+        self.stopDisassembly()
+        self.canvas.codeWidget.editor.clear()
+        self.disasmFile = open(fpath, "rb")
+        self.disasmLines = disasm_lines(self.disasmFile, self.mode)
+        self.disasmCount = 0
+        self.disasmTimer = QtCore.QTimer(self)
+        self.disasmTimer.timeout.connect( self.feedDisassembly )
+        self.disasmTimer.start(DISASM_FEED_INTERVAL)
+        return
+
+
+    def feedDisassembly(self):
+        lines = list(itertools.islice(self.disasmLines, DISASM_FEED_LINES))
+        if len(lines):
+            self.canvas.codeWidget.editor.append( "\n".join(lines) )
+            self.disasmCount += len(lines)
+            return
+        self.canvas.logWidget.editor.append("Loaded '%s' (%d instructions)" % (self.disasmFile.name, self.disasmCount))
+        self.stopDisassembly()
+        return
+
+
+    def stopDisassembly(self):
+        if getattr(self, "disasmTimer", None) is None:
+            return
+        self.disasmTimer.stop()
+        self.disasmFile.close()
+        self.disasmTimer = self.disasmFile = self.disasmLines = None
+        return
+
+
     def loadCodeText(self):
         return self.loadCode("Open Assembly file", "Assembly files (*.asm)", False)
 
@@ -676,6 +1234,57 @@ class EmulatorWindow(QMainWindow):
         return self.saveCode("Save Raw Binary Pane As", "*.raw", True)
 
 
+    def saveTrace(self):
+        qFile, qFilter = QFileDialog().getSaveFileName(self, "Save Trace As", ".", filter="*.txt")
+        if qFile is None or len(qFile)==0 or qFile=="":
+            return
+
+        count = self.emulator.trace.dump(qFile)
+        self.canvas.logWidget.editor.append("Saved %d trace records as '%s'" % (count, qFile))
+        return
+
+
+    def toggleProfile(self, checked):
+        if checked:
+            self.sampleAction.setChecked(False)
+        self.updateProfile()
+        return
+
+
+    def toggleSampling(self, checked):
+        if checked:
+            self.profileAction.setChecked(False)
+        self.updateProfile()
+        return
+
+
+    def updateProfile(self):
+        if self.profileAction.isChecked():
+            self.emulator.profile = 0
+        elif self.sampleAction.isChecked():
+            self.emulator.profile = PROFILE_SAMPLE_INTERVAL
+        else:
+            self.emulator.profile = None
+        # the counts start over on the next run
+        self.emulator.profiler = None
+        return
+
+
+    def toggleBinaryTrace(self, checked):
+        if not checked:
+            self.emulator.stop_binary_trace()
+            return
+
+        qFile, qFilter = QFileDialog().getSaveFileName(self, "Record Binary Trace As", ".", filter="*.trace")
+        if qFile is None or len(qFile)==0 or qFile=="":
+            self.sender().setChecked(False)
+            return
+
+        self.emulator.start_binary_trace(str(qFile))
+        self.canvas.logWidget.editor.append("Recording binary trace in '%s'" % qFile)
+        return
+
+
     def saveAsCFile(self):
 
         template = b"""/**
@@ -776,6 +1385,9 @@ _start:
 
 
     def updateMode(self, idx, newAction):
+        if self.canvas.isEmulating():
+            self.canvas.logWidget.editor.append("Cannot switch architecture during emulation")
+            return
         self.currentAction.setEnabled(True)
         self.mode.set_new_mode(idx)
         self.canvas.regWidget.updateGrid()
@@ -785,6 +1397,14 @@ _start:
         return
 
 
+    def closeEvent(self, event):
+        if self.canvas.isEmulating():
+            self.emulator.request_stop()
+            self.canvas.emuThread.wait()
+        event.accept()
+        return
+
+
     def updateTitle(self):
         self.setWindowTitle("%s (%s)" % (TITLE, self.mode.get_title()))
         return
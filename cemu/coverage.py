@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""
+Basic block coverage of an area (`.text`).
+
+The blocks executed during a run are collected in a set by a block hook restricted to
+the area, then folded in two bitmaps with one bit per byte of the area: the bytes where
+a block starts, and the bytes covered by a block. Bitmaps are held as Python integers,
+so that merging the coverage of many runs is a bitwise or.
+
+A coverage file is a header followed by the two bitmaps, zlib compressed:
+
+    magic, version, base address, size, number of runs, length of the area name
+    area name (utf-8)
+    zlib(start bitmap + covered bitmap), each one being (size + 7) // 8 bytes
+
+The merged coverage can be exported in the drcov format, read by the coverage plugins
+of the disassemblers (e.g. lighthouse).
+"""
+
+import zlib
+import struct
+
+
+COVERAGE_MAGIC = b"CEMUCOV\x00"
+COVERAGE_VERSION = 1
+
+# magic, version, base address, size, number of runs, length of the name
+HEADER_FORMAT = "<8sHQQIH"
+
+# drcov blocks are (start offset, size, module id)
+DRCOV_BLOCK_FORMAT = "<IHH"
+DRCOV_MAX_BLOCK_SIZE = 0xffff
+
+
+class Coverage:
+
+    def __init__(self, base, size, name=".text", *args, **kwargs):
+        self.base = base
+        self.size = size
+        self.name = name
+        self.starts = 0
+        self.covered = 0
+        self.runs = 0
+        # (address, size) of the blocks hit since the last flush
+        self.blocks = set()
+        return
+
+
+    def hook_block(self, uc, address, size, user_data):
+        self.blocks.add((address, size))
+        return
+
+
+    def end_run(self):
+        self.runs += 1
+        return
+
+
+    def flush(self):
+        """
+        Folds the blocks hit since the last flush in the bitmaps.
+        """
+        if len(self.blocks) == 0:
+            return
+        length = self.bitmap_size()
+        starts = bytearray(self.starts.to_bytes(length, "little"))
+        covered = bytearray(self.covered.to_bytes(length, "little"))
+        for address, size in self.blocks:
+            offset = address - self.base
+            if not 0 <= offset < self.size:
+                continue
+            starts[offset >> 3] |= 1 << (offset & 7)
+            # the bits of the block, aligned on the byte holding its first one
+            size = min(size, self.size - offset)
+            shift = offset & 7
+            mask = (((1 << size) - 1) << shift).to_bytes((shift + size + 7) >> 3, "little")
+            first = offset >> 3
+            for i, byte in enumerate(mask):
+                covered[first + i] |= byte
+        self.starts = int.from_bytes(starts, "little")
+        self.covered = int.from_bytes(covered, "little")
+        self.blocks.clear()
+        return
+
+
+    def bitmap_size(self):
+        return (self.size + 7) // 8
+
+
+    def check_compatible(self, other):
+        if (self.base, self.size, self.name) != (other.base, other.size, other.name):
+            raise Exception("Cannot merge the coverage of %s@%#x (size=%#x) and %s@%#x (size=%#x)" % (self.name, self.base, self.size,
+                                                                                                      other.name, other.base, other.size))
+        return
+
+
+    def merge(self, other):
+        self.check_compatible(other)
+        self.flush()
+        other.flush()
+        self.starts |= other.starts
+        self.covered |= other.covered
+        self.runs += other.runs
+        return
+
+
+    def get_block_offsets(self):
+        """
+        Returns the offsets of the block starts, in increasing order.
+        """
+        self.flush()
+        offsets = []
+        data = self.starts.to_bytes(self.bitmap_size(), "little")
+        for index, byte in enumerate(data):
+            if byte == 0:
+                continue
+            for bit in range(8):
+                if byte & (1 << bit):
+                    offsets.append(index * 8 + bit)
+        return offsets
+
+
+    def get_blocks(self):
+        """
+        Returns the covered blocks as (offset, size), a block spanning the covered bytes
+        from its start to the next block start.
+        """
+        offsets = self.get_block_offsets()
+        covered = self.covered.to_bytes(self.bitmap_size(), "little")
+        blocks = []
+        for i, offset in enumerate(offsets):
+            limit = offsets[i + 1] if i + 1 < len(offsets) else self.size
+            end = offset
+            while end < limit and covered[end >> 3] & (1 << (end & 7)):
+                end += 1
+            blocks.append( (offset, max(1, end - offset)) )
+        return blocks
+
+
+    def summary(self):
+        self.flush()
+        covered = bin(self.covered).count("1")
+        return {"runs": self.runs,
+                "blocks": bin(self.starts).count("1"),
+                "covered_bytes": covered,
+                "covered_percent": 100.0 * covered / self.size if self.size else 0.0,}
+
+
+    def save(self, fpath):
+        self.flush()
+        name = self.name.encode("utf-8")
+        length = self.bitmap_size()
+        data = self.starts.to_bytes(length, "little") + self.covered.to_bytes(length, "little")
+        with open(fpath, "wb") as f:
+            f.write(struct.pack(HEADER_FORMAT, COVERAGE_MAGIC, COVERAGE_VERSION, self.base, self.size, self.runs, len(name)))
+            f.write(name)
+            f.write(zlib.compress(data))
+        return
+
+
+    @staticmethod
+    def load(fpath):
+        with open(fpath, "rb") as f:
+            data = f.read()
+
+        header_size = struct.calcsize(HEADER_FORMAT)
+        magic, version, base, size, runs, name_size = struct.unpack_from(HEADER_FORMAT, data)
+        if magic != COVERAGE_MAGIC or version != COVERAGE_VERSION:
+            raise Exception("'%s' is not a coverage file" % fpath)
+
+        name = data[header_size:header_size + name_size].decode("utf-8")
+        coverage = Coverage(base, size, name)
+        coverage.runs = runs
+        bitmaps = zlib.decompress(data[header_size + name_size:])
+        length = coverage.bitmap_size()
+        coverage.starts = int.from_bytes(bitmaps[:length], "little")
+        coverage.covered = int.from_bytes(bitmaps[length:], "little")
+        return coverage
+
+
+    def save_drcov(self, fpath, module=None):
+        """
+        Writes the coverage in the drcov (version 2) format, the area being its only module,
+        named `module` (the area name by default) to match the file loaded in the disassembler.
+        """
+        blocks = []
+        for offset, size in self.get_blocks():
+            # blocks are split to fit in the 16-bit size field
+            while size > 0:
+                chunk = min(size, DRCOV_MAX_BLOCK_SIZE)
+                blocks.append(struct.pack(DRCOV_BLOCK_FORMAT, offset, chunk, 0))
+                offset += chunk
+                size -= chunk
+
+        header = ["DRCOV VERSION: 2",
+                  "DRCOV FLAVOR: cemu",
+                  "Module Table: version 2, count 1",
+                  "Columns: id, base, end, entry, checksum, timestamp, path",
+                  " 0, %#018x, %#018x, 0x0000000000000000, 0x00000000, 0x00000000, %s" % (self.base, self.base + self.size, module or self.name),
+                  "BB Table: %d bbs" % len(blocks),]
+        with open(fpath, "wb") as f:
+            f.write(("\n".join(header) + "\n").encode("utf-8"))
+            f.write(b"".join(blocks))
+        return len(blocks)
+
+
+def merge_files(fpaths):
+    """
+    Returns the coverage merged from the given coverage files.
+    """
+    merged = None
+    for fpath in fpaths:
+        coverage = Coverage.load(fpath)
+        if merged is None:
+            merged = coverage
+        else:
+            merged.merge(coverage)
+    return merged
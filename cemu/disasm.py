@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming disassembler for large raw files.
+
+Instructions are decoded with capstone's lightweight path (`disasm_lite`, no detail
+objects) chunk by chunk, an instruction crossing the end of a chunk being decoded
+again at the start of the next one. Like `cemu.utils.disassemble`, decoding stops at
+the first invalid instruction.
+
+Large files can also be split in segments decoded by a pool of processes. Each segment
+is decoded a bit past its end, and stitched to the next one at the first instruction
+boundary both agree on: with variable length instructions (x86), decoding from an
+arbitrary offset resynchronizes on the real instruction stream within a few instructions.
+"""
+
+import os
+import collections
+import multiprocessing
+
+from .arch import Mode
+from .utils import get_capstone_engine
+
+
+# default address of the first byte, as in `cemu.utils.disassemble`
+DISASM_BASE_ADDRESS = 0x4000
+
+# number of bytes decoded at once
+DISASM_CHUNK_SIZE = 1 << 20
+
+# longest instruction among the supported architectures (x86)
+MAX_INSN_SIZE = 15
+
+# in Thumb, an IT instruction makes the decoding of the (up to 4) next ones depend on it:
+# decoding is resumed this many instructions back, and segments are only joined after
+# this many common instructions
+DISASM_CONTEXT_INSNS = 4
+
+# size of the segments handed to the worker processes, and how far past its end each
+# segment is decoded to find where the next one synchronizes
+DISASM_SEGMENT_SIZE = 1 << 20
+DISASM_SEGMENT_OVERLAP = 0x1000
+
+
+def format_insn(insn):
+    return "{:s} {:s}".format(insn[2], insn[3])
+
+
+def iter_chunks(source, chunk_size=DISASM_CHUNK_SIZE):
+    """
+    Yields `source`, a bytes-like object or a binary file object, `chunk_size` bytes at a time.
+    """
+    if hasattr(source, "read"):
+        while True:
+            data = source.read(chunk_size)
+            if len(data) == 0:
+                return
+            yield data
+
+    view = memoryview(source).cast("B")
+    for offset in range(0, len(view), chunk_size):
+        yield view[offset:offset+chunk_size]
+    return
+
+
+def iter_disasm(source, mode, address=DISASM_BASE_ADDRESS, chunk_size=DISASM_CHUNK_SIZE):
+    """
+    Yields the (address, size, mnemonic, op_str) of the instructions of `source`, a
+    bytes-like object or a binary file object, decoded `chunk_size` bytes at a time.
+    """
+    cs = get_capstone_engine(mode)
+    chunk = b""
+    # instructions before this address were already yielded
+    resume = address
+    chunks = iter_chunks(source, chunk_size)
+    data = next(chunks, None)
+    while data is not None:
+        chunk += bytes(data)
+        data = next(chunks, None)
+        # an instruction starting this close to the end of the chunk may be truncated
+        limit = len(chunk) if data is None else len(chunk) - MAX_INSN_SIZE
+        consumed = 0
+        context = collections.deque([0], maxlen=DISASM_CONTEXT_INSNS)
+        for insn in cs.disasm_lite(chunk, address):
+            offset = insn[0] - address
+            if offset >= limit:
+                break
+            if insn[0] >= resume:
+                yield insn
+            context.append(offset)
+            consumed = offset + insn[1]
+
+        if consumed < limit:
+            # invalid instruction
+            return
+        resume = address + consumed
+        chunk = chunk[context[0]:]
+        address += context[0]
+    return
+
+
+def disasm_lines(source, mode, address=DISASM_BASE_ADDRESS, chunk_size=DISASM_CHUNK_SIZE):
+    for insn in iter_disasm(source, mode, address, chunk_size):
+        yield format_insn(insn)
+    return
+
+
+def disassemble_to_file(fpath, fd, mode, address=DISASM_BASE_ADDRESS, processes=1):
+    """
+    Disassembles the raw file `fpath` straight to the text file object `fd`, with as
+    many processes (one per core if 0 or None). Returns the number of instructions.
+    """
+    if processes == 1 or os.path.getsize(fpath) <= DISASM_SEGMENT_SIZE:
+        count = 0
+        with open(fpath, "rb") as f:
+            for line in disasm_lines(f, mode, address):
+                fd.write(line + "\n")
+                count += 1
+        return count
+
+    count = 0
+    for lines in iter_disasm_parallel(fpath, mode, address, processes):
+        if len(lines):
+            fd.write("\n".join(lines) + "\n")
+            count += len(lines)
+    return count
+
+
+def decode_segment(fpath, arch, address, start, end):
+    """
+    Decodes the instructions of `fpath` from offset `start`, and returns a tuple with the
+    range, the offsets and the lines of the instructions starting before the end of the
+    range plus `DISASM_SEGMENT_OVERLAP`, and the offset at which an invalid instruction
+    stopped decoding within that window (None otherwise).
+    """
+    size = end + DISASM_SEGMENT_OVERLAP - start
+    with open(fpath, "rb") as f:
+        f.seek(start)
+        data = f.read(size)
+
+    offsets, lines = [], []
+    decoded = 0
+    for insn in iter_disasm(data, arch, address + start):
+        offsets.append(insn[0] - address)
+        lines.append(format_insn(insn))
+        decoded = insn[0] - address - start + insn[1]
+
+    stopped = None
+    # when the window does not reach the end of the file, its last instruction may be truncated
+    if decoded < len(data) and (len(data) < size or decoded < len(data) - MAX_INSN_SIZE):
+        stopped = start + decoded
+    return (start, end, offsets, lines, stopped)
+
+
+def _decode_segment(job):
+    return decode_segment(*job)
+
+
+def iter_disasm_parallel(fpath, mode, address=DISASM_BASE_ADDRESS, processes=None):
+    """
+    Disassembles the raw file `fpath` over a pool of processes, and yields the lines in
+    order, a list at a time.
+    """
+    arch = mode.get_id() if isinstance(mode, Mode) else mode
+    filesize = os.path.getsize(fpath)
+    jobs = [(fpath, arch, address, start, min(start + DISASM_SEGMENT_SIZE, filesize))
+            for start in range(0, filesize, DISASM_SEGMENT_SIZE)]
+    if len(jobs) == 0:
+        return
+
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    try:
+        segments = pool.imap(_decode_segment, jobs)
+        current = next(segments)
+        for segment in segments:
+            current, lines = stitch_segments(current, segment, fpath, arch, address)
+            yield lines
+            if current is None:
+                break
+        else:
+            yield current[3]
+    finally:
+        # also drops the segments past an invalid instruction
+        pool.terminate()
+        pool.join()
+    return
+
+
+def stitch_segments(current, segment, fpath, arch, address):
+    """
+    Joins two consecutive decoded segments at the first instruction boundary they agree
+    on. Returns the lines of `current` to output, along with the joined next segment, or
+    None if the instruction stream ends with an invalid instruction before.
+    """
+    start, end, offsets, lines, stopped = current
+    heads = dict([(offset, i) for i, offset in enumerate(segment[2])])
+    common = 0
+    for i, offset in enumerate(offsets):
+        common = common + 1 if offset in heads else 0
+        if offset >= end and common > DISASM_CONTEXT_INSNS:
+            j = heads[offset]
+            return (offset, segment[1], segment[2][j:], segment[3][j:], segment[4]), lines[:i]
+
+    if stopped is not None:
+        # `current` follows the real instruction stream, which ends there
+        return None, lines
+
+    # no common boundary: decode the next segment again from where this one ends
+    restart = next((o for o in offsets if o >= end), end)
+    output = [line for o, line in zip(offsets, lines) if o < restart]
+    return decode_segment(fpath, arch, address, restart, segment[1]), output
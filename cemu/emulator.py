@@ -1,11 +1,83 @@
 import os
+import mmap
+import time
+import array
+import ctypes
+import collections
 
 import unicorn
-import keystone
-import capstone
 
-from .arch import Architecture
-from .utils import get_arch_mode, assemble
+from .utils import assemble, get_capstone_engine, LRUCache
+from .trace import TraceSink, format_record, TRACE_INSN, TRACE_BLOCK, TRACE_INTERRUPT, TRACE_MEM_READ, TRACE_MEM_WRITE
+from .bintrace import TraceWriter
+from .coverage import Coverage
+from .profiler import Profiler, format_report
+from .watch import Watchpoint, WatchIndex, AccessStats, WATCH_HITS_SIZE, format_hit
+from .watch import format_report as format_access_report
+from .breakpoints import Breakpoint, BreakpointSet
+from .stats import EmulatorStats, measured_phase
+from .syscalls import SyscallLayer, SYSCALL_INSN, get_syscall_abis, format_call
+from .trace import TRACE_LEVEL_NONE, TRACE_LEVEL_BLOCKS, TRACE_LEVEL_INSTRUCTIONS, TRACE_LEVEL_MEMORY
+
+
+# maximum number of decoded instructions kept by the emulator
+INSN_CACHE_SIZE = 4096
+
+# minimum delay (in seconds) between two progress reports, checked every 1024 instructions
+PROGRESS_INTERVAL = 0.1
+PROGRESS_CHECK_MASK = 0x3ff
+# length (in microseconds) of the slices a run is cut in, to report its progress when
+# no hook is called on every block
+PROGRESS_SLICE_US = int(PROGRESS_INTERVAL * 1e6)
+
+# granularity at which `Emulator.restore` compares and rewrites memory
+PAGE_SIZE = 0x1000
+
+# reasons for which `Emulator.run` returned
+STOP_END = "end"
+STOP_ERROR = "error"
+STOP_STEP = "step"
+STOP_USER = "user"
+STOP_MAX_INSNS = "max_insns"
+STOP_TIMEOUT = "timeout"
+STOP_MAX_MEM_ACCESSES = "max_mem_accesses"
+STOP_WATCHPOINT = "watchpoint"
+STOP_BREAKPOINT = "breakpoint"
+# (and STOP_EXIT, STOP_EXECVE of `cemu.syscalls`, when the guest ends its process)
+
+
+class Snapshot:
+    """
+    Register context and memory content of an emulator, see `Emulator.snapshot`.
+    """
+
+    def __init__(self, mode, context, memory, start_addr, end_addr, versions, *args, **kwargs):
+        self.mode = mode
+        self.context = context
+        self.memory = memory
+        self.start_addr = start_addr
+        self.end_addr = end_addr
+        # {name: version} of the areas written by the host, see `Emulator.write_memory`
+        self.versions = versions
+        return
+
+
+class FileArea:
+    """
+    Area of the VM memory mapped copy-on-write from a file, see `Emulator.map_file`. The
+    area is clean while it is known to hold the content of the file.
+    """
+
+    def __init__(self, name, address, size, perm, fpath, offset, *args, **kwargs):
+        self.name = name
+        self.address = address
+        self.size = size
+        self.perm = perm
+        self.fpath = fpath
+        self.offset = offset
+        self.host = self.live = self.pristine = None
+        self.clean = False
+        return
 
 
 class Emulator:
@@ -14,67 +86,148 @@ class Emulator:
         self.mode = mode
         self.use_step_mode = False
         self.widget = None
+        self.verbose = kwargs.get("verbose", True)
+        self.insn_cache = LRUCache(kwargs.get("insn_cache_size", INSN_CACHE_SIZE))
+        self.trace = TraceSink()
+        self.progress_callback = None
+        # per-run budgets, 0 meaning unlimited
+        self.max_insns = kwargs.get("max_insns", 0)
+        self.max_time_us = kwargs.get("max_time_us", 0)
+        self.max_mem_accesses = kwargs.get("max_mem_accesses", 0)
+        # which hooks to install for the next run, and on which (start, end) addresses
+        self.trace_level = kwargs.get("trace_level", TRACE_LEVEL_MEMORY if self.verbose else TRACE_LEVEL_NONE)
+        self.trace_range = kwargs.get("trace_range", None)
+        self.binary_trace = None
+        self.coverage = None
+        # None, or the sampling interval of the profiler (0 to count every block)
+        self.profile = kwargs.get("profile", None)
+        # (start, end, access, stop) of the initial watchpoints, see `cemu.watch`
+        self.watch_index = WatchIndex()
+        for spec in kwargs.get("watchpoints", []):
+            self.watch_index.add(Watchpoint(*spec))
+        self.watch_hits = collections.deque(maxlen=WATCH_HITS_SIZE)
+        # (address, condition, hit_count) of the initial breakpoints, see `cemu.breakpoints`
+        self.breakpoints = BreakpointSet()
+        for spec in kwargs.get("breakpoints", []):
+            self.add_breakpoint(*spec)
+        self.skip_breakpoint = None
+        # None, or the granularity of the memory access counts
+        granularity = kwargs.get("access_stats", None)
+        self.access_stats = AccessStats(granularity) if granularity is not None else None
+        self.stats = EmulatorStats(kwargs.get("stats", False))
+        # None, or the Linux syscall layer with the initial {path: content} of its sandbox
+        self.syscalls = SyscallLayer(kwargs.get("guest_files", {})) if kwargs.get("syscalls", False) else None
         self.reinit()
         return
 
 
     def reinit(self):
         self.vm = None
+        # released after the VM using their memory
+        self.file_areas = {}
+        self.hooks = {}
+        # whether the code hook counts the instructions, see `setup_hooks`
+        self.count_per_insn = False
+        self.areas = {}
+        # {name: version} of the areas written by the host, see `write_memory`
+        self.area_versions = {}
+        self.last_version = 0
+        self.registers = {}
+        self.reset_state()
+        self.create_new_vm()
+        return
+
+
+    def reset_state(self):
+        """
+        Resets everything about the code and its execution, but the VM and its mappings.
+        """
         self.code = None
         self.is_running = False
         self.stop_now = False
         self.num_insns = -1
-        self.areas = {}
-        self.registers = {}
-        self.create_new_vm()
+        self.last_error = None
+        self.executed_insns = 0
+        self.current_pc = None
+        self.run_start = None
+        self.run_elapsed = 0
+        self.run_insns = 0
+        self.last_progress = 0
+        self.stop_reason = None
+        self.stop_pc = None
+        self.mem_accesses = 0
+        self.block_insns = {}
+        self.last_block = None
+        self.profiler = None
+        self.watch_hits.clear()
+        for wp in self.watch_index.watchpoints:
+            wp.hits = 0
+        for bp in self.breakpoints:
+            bp.hits = 0
+        if self.access_stats is not None:
+            self.access_stats.clear()
+        if self.syscalls is not None:
+            self.syscalls.reset(self.vm)
+        self.insn_cache.clear()
+        self.trace.clear()
+        self.stats.reset()
         return
 
 
     def pprint(self, x):
         if self.widget is None:
-            print(x)
+            if self.verbose:
+                print(x)
         else:
-            self.widget.emuWidget.editor.append(x)
+            # signals are queued to the UI thread when emitted from the emulation thread
+            self.widget.traceMessage.emit(x)
         return
 
 
     def log(self, x):
         if self.widget is None:
-            print(x)
+            if self.verbose:
+                print(x)
         else:
-            self.widget.logWidget.editor.append(x)
+            self.widget.logMessage.emit(x)
         return
 
 
     def unicorn_register(self, reg):
-        if self.mode in (Architecture.X86_16_INTEL, Architecture.X86_16_ATT,
-                         Architecture.X86_32_INTEL, Architecture.X86_32_ATT,
-                         Architecture.X86_64_INTEL, Architecture.X86_64_ATT):
-            return getattr(unicorn.x86_const, "UC_X86_REG_%s"%str(reg).upper())
+        return self.mode.get_descriptor().unicorn_register(reg)
 
-        if self.mode in (Architecture.ARM_LE, Architecture.ARM_BE,
-                         Architecture.ARM_THUMB_LE, Architecture.ARM_THUMB_BE):
-            return getattr(unicorn.arm_const, "UC_ARM_REG_%s"%str(reg).upper())
 
-        if self.mode==Architecture.ARM_AARCH64:
-            return getattr(unicorn.arm64_const, "UC_ARM64_REG_%s"%str(reg).upper())
+    def get_register_ids(self):
+        """
+        Returns the unicorn ids of the registers of the current mode, in the order of
+        `Mode.get_registers()`.
+        """
+        return self.mode.get_descriptor().register_id_list
 
-        if self.mode in (Architecture.PPC, Architecture.PPC64):
-            return getattr(unicorn.ppc_const, "UC_PPC_REG_%s" % str(reg).upper())
 
-        if self.mode in (Architecture.MIPS, Architecture.MIPS_BE,
-                         Architecture.MIPS64, Architecture.MIPS64_BE):
-            return getattr(unicorn.mips_const, "UC_MIPS_REG_%s" % str(reg).upper())
+    def get_register_value(self, r):
+        return self.vm.reg_read(self.unicorn_register(r))
 
-        if self.mode in (Architecture.SPARC, Architecture.SPARC_BE, Architecture.SPARC64):
-            return getattr(unicorn.sparc_const, "UC_SPARC_REG_%s" %str(reg).upper())
 
-        raise Exception("Cannot find register '%s' for arch '%s'" % (str(reg), self.mode))
+    def get_pc_value(self):
+        return self.vm.reg_read(self.mode.get_descriptor().pc_id)
 
 
-    def get_register_value(self, r):
-        ur = self.unicorn_register(r)
-        return self.vm.reg_read(ur)
+    def read_registers(self):
+        """
+        Reads the whole register file in one call, and returns the values as an array in
+        the order of `Mode.get_registers()`.
+        """
+        ids = self.get_register_ids()
+        if hasattr(self.vm, "reg_read_batch"):
+            values = self.vm.reg_read_batch(ids)
+        else:
+            values = [self.vm.reg_read(ur) for ur in ids]
+        return array.array("Q", values)
+
+
+    def get_registers_values(self):
+        return dict( zip(self.mode.get_registers(), self.read_registers()) )
 
 
     def unicorn_permissions(self, perms):
@@ -85,28 +238,98 @@ class Emulator:
 
 
     def create_new_vm(self):
-        arch, mode, endian = get_arch_mode("unicorn", self.mode)
+        arch, mode, endian = self.mode.get_descriptor().unicorn
         self.vm = unicorn.Uc(arch, mode | endian)
-        self.vm.hook_add(unicorn.UC_HOOK_BLOCK, self.hook_block)
-        self.vm.hook_add(unicorn.UC_HOOK_CODE, self.hook_code)
-        self.vm.hook_add(unicorn.UC_HOOK_INTR, self.hook_interrupt)
-        self.vm.hook_add(unicorn.UC_HOOK_MEM_WRITE, self.hook_mem_access)
-        self.vm.hook_add(unicorn.UC_HOOK_MEM_READ, self.hook_mem_access)
         return
 
 
+    def get_wanted_hooks(self):
+        """
+        Returns the hooks needed by the next run as {name: (type, callback, begin, end[, arg])}:
+        with the trace level none and no memory budget, unicorn runs without any
+        Python callback but the interrupt one.
+        """
+        begin, end = self.trace_range if self.trace_range is not None else (1, 0)
+        hooks = {"interrupt": (unicorn.UC_HOOK_INTR, self.hook_interrupt, 1, 0)}
+        if self.trace_level >= TRACE_LEVEL_BLOCKS:
+            hooks["block"] = (unicorn.UC_HOOK_BLOCK, self.hook_block, begin, end)
+        if self.trace_level >= TRACE_LEVEL_INSTRUCTIONS:
+            hooks["code"] = (unicorn.UC_HOOK_CODE, self.hook_code, begin, end)
+        if self.use_step_mode:
+            # stepping must stop on the next instruction wherever it is
+            hooks["code"] = (unicorn.UC_HOOK_CODE, self.hook_code, 1, 0)
+        if self.trace_level >= TRACE_LEVEL_MEMORY:
+            hooks["memory"] = (unicorn.UC_HOOK_MEM_READ | unicorn.UC_HOOK_MEM_WRITE, self.hook_mem_access, begin, end)
+        if self.binary_trace is not None:
+            hooks["bintrace_code"] = (unicorn.UC_HOOK_CODE, self.hook_bintrace_code, begin, end)
+            hooks["bintrace_memory"] = (unicorn.UC_HOOK_MEM_READ | unicorn.UC_HOOK_MEM_WRITE, self.hook_bintrace_mem_access, begin, end)
+        if self.coverage is not None:
+            # only the blocks of the covered area call back
+            cov = self.coverage
+            hooks["coverage"] = (unicorn.UC_HOOK_BLOCK, cov.hook_block, cov.base, cov.base + cov.size - 1)
+        for address in self.breakpoints.addresses():
+            hooks["breakpoint_%x" % address] = (unicorn.UC_HOOK_CODE, self.hook_breakpoint, address, address)
+        if self.profiler is not None and not self.is_sampling():
+            prof = self.profiler
+            hooks["profiler"] = (unicorn.UC_HOOK_BLOCK, prof.hook_block, prof.base, prof.base + prof.size - 1)
+        for kind, htype in (("r", unicorn.UC_HOOK_MEM_READ), ("w", unicorn.UC_HOOK_MEM_WRITE)):
+            for i, (start, end) in enumerate(self.watch_index.get_ranges(kind)):
+                hooks["watch_%s%d" % (kind, i)] = (htype, self.hook_watch, start, end)
+        if self.access_stats is not None:
+            hooks["access_reads"] = (unicorn.UC_HOOK_MEM_READ, self.access_stats.hook_read, 1, 0)
+            hooks["access_writes"] = (unicorn.UC_HOOK_MEM_WRITE, self.access_stats.hook_write, 1, 0)
+        if self.stats.enabled and ("block" not in hooks or self.trace_range is not None):
+            # the stats count the instructions and blocks of the whole run, whatever the tracing
+            hooks["stats_block"] = (unicorn.UC_HOOK_BLOCK, self.hook_count_block, 1, 0)
+        if self.max_mem_accesses or self.stats.enabled:
+            # also counts the memory accesses for the stats, without a budget
+            hooks["mem_budget"] = (unicorn.UC_HOOK_MEM_READ | unicorn.UC_HOOK_MEM_WRITE, self.hook_mem_budget, 1, 0)
+        if self.syscalls is not None and SYSCALL_INSN in get_syscall_abis(self.mode.get_id()):
+            # the x86-64 `syscall` instruction does not raise an interrupt
+            hooks["syscall"] = (unicorn.UC_HOOK_INSN, self.hook_syscall, 1, 0, unicorn.x86_const.UC_X86_INS_SYSCALL)
+        return hooks
+
+
+    def setup_hooks(self):
+        """
+        Installs the hooks needed by the next run and removes the ones that are not.
+        """
+        wanted = self.get_wanted_hooks()
+        # the hooks are wrapped to be measured while the stats are enabled
+        measured = self.stats.enabled
+        for name in list(self.hooks.keys()):
+            handle, spec, wrapped = self.hooks[name]
+            if wanted.get(name) != spec or wrapped != measured:
+                self.vm.hook_del(handle)
+                del self.hooks[name]
+
+        for name, spec in wanted.items():
+            if name in self.hooks:
+                continue
+            htype, callback, begin, end = spec[:4]
+            if measured:
+                callback = self.stats.wrap_hook(name, callback, htype & unicorn.UC_HOOK_MEM_READ != 0)
+            handle = self.vm.hook_add(htype, callback, None, begin, end, *spec[4:])
+            self.hooks[name] = (handle, spec, measured)
+        self.stats.installed_hooks = set(self.hooks.keys())
+        # the instructions are counted one by one by the code hook, unless it only covers
+        # the trace range while the stats block hook sees every block
+        code = self.hooks.get("code")
+        self.count_per_insn = code is not None and (code[1][2:4] == (1, 0) or "stats_block" not in self.hooks)
+        return
+
+
+    @measured_phase("populate_memory")
     def populate_memory(self, areas):
-        for name, address, size, permission, input_file in areas:
+        for name, address, size, permission, input_file, offset in areas:
             perm = self.unicorn_permissions(permission)
-            self.vm.mem_map(address, size, perm)
-            self.areas[name] = [address, size, permission,]
-
             msg = ">>> map %s @%x (size=%d,perm=%s)" % (name, address, size, permission)
             if input_file is not None and os.access(input_file, os.R_OK):
-                code = open(input_file, 'rb').read()
-                self.vm.mem_write(address, bytes(code[:size]))
-                msg += " and content from '%s'" % input_file
-
+                zero_copy = self.map_file(name, address, size, perm, input_file, offset)
+                msg += " and content from '%s' (offset=%#x%s)" % (input_file, offset, ", mmapped" if zero_copy else "")
+            else:
+                self.vm.mem_map(address, size, perm)
+            self.areas[name] = [address, size, permission,]
             self.log(msg)
 
         self.start_addr = self.areas[".text"][0]
@@ -114,22 +337,97 @@ class Emulator:
         return True
 
 
+    def map_file(self, name, address, size, perm, fpath, offset=0):
+        """
+        Maps an area with the content of a file from `offset`. If the file covers the whole
+        area, the VM memory is a private copy-on-write mapping of the file: nothing is read
+        before being accessed, and writes never reach the file. Otherwise the available
+        bytes are copied in. Returns True for a zero-copy mapping.
+        """
+        with open(fpath, "rb") as f:
+            length = min(size, max(0, os.fstat(f.fileno()).st_size - offset))
+
+        if length == size and hasattr(self.vm, "mem_map_ptr"):
+            self.map_file_area(FileArea(name, address, size, perm, fpath, offset))
+            return True
+
+        self.vm.mem_map(address, size, perm)
+        if length > 0:
+            with open(fpath, "rb") as f:
+                f.seek(offset)
+                self.vm.mem_write(address, f.read(length))
+        return False
+
+
+    def map_file_area(self, area):
+        # mmap offsets must be aligned on the allocation granularity
+        delta = area.offset % mmap.ALLOCATIONGRANULARITY
+        with open(area.fpath, "rb") as f:
+            live = mmap.mmap(f.fileno(), delta + area.size, access=mmap.ACCESS_COPY, offset=area.offset - delta)
+            pristine = mmap.mmap(f.fileno(), delta + area.size, access=mmap.ACCESS_READ, offset=area.offset - delta)
+
+        area.host = ctypes.c_char.from_buffer(live, delta)
+        area.live = memoryview(live)[delta:delta + area.size]
+        if area.pristine is None:
+            # kept when the area is mapped again, as snapshots refer to it
+            area.pristine = memoryview(pristine)[delta:delta + area.size]
+        else:
+            pristine.close()
+        area.clean = True
+        self.vm.mem_map_ptr(area.address, area.size, area.perm, ctypes.addressof(area.host))
+        self.file_areas[area.name] = area
+        return
+
+
+    def read_area(self, name):
+        """
+        Returns the content of a mapped area, as a view on the host memory (not a copy)
+        for the file-backed ones.
+        """
+        if name in self.file_areas:
+            return self.file_areas[name].live
+        address, size, permission = self.areas[name]
+        return self.vm.mem_read(address, size)
+
+
+    def write_memory(self, address, data):
+        """
+        Writes to the VM memory on behalf of the host, which unicorn lets write the
+        read-only areas as well: the areas written get a new version, for `restore`
+        to know which of the read-only ones changed.
+        """
+        self.vm.mem_write(address, data)
+        for name, (start, size, permission) in self.areas.items():
+            if start < address + len(data) and address < start + size:
+                self.last_version += 1
+                self.area_versions[name] = self.last_version
+        return
+
+
+    def mark_dirty(self):
+        """
+        Notes that the file-backed areas may not hold the content of their file anymore.
+        """
+        for area in self.file_areas.values():
+            area.clean = False
+        return
+
+
+    @measured_phase("populate_registers")
     def populate_registers(self, registers):
         for r in registers.keys():
             ur = self.unicorn_register(r)
             self.vm.reg_write(ur, registers[r])
             self.log(">>> register %s = %x" % (r, registers[r]))
 
-        # fix $PC
-        ur = self.unicorn_register(self.mode.get_pc())
-        self.vm.reg_write(ur, self.areas[".text"][0])
-
-        # fix $SP
-        ur = self.unicorn_register(self.mode.get_sp())
-        self.vm.reg_write(ur, self.areas[".stack"][0])
+        # fix $PC and $SP
+        descriptor = self.mode.get_descriptor()
+        self.vm.reg_write(descriptor.pc_id, self.areas[".text"][0])
+        self.vm.reg_write(descriptor.sp_id, self.areas[".stack"][0])
         return True
 
 
+    @measured_phase("compile_code")
     def compile_code(self, code, update_end_addr=True):
         code = b" ; ".join(code)
         self.log(">>> Assembly using keystone for '%s': %s" % (self.mode.get_title(), code))
@@ -146,6 +444,17 @@ class Emulator:
         return True
 
 
+    @measured_phase("load_raw_code")
+    def load_raw_code(self, code, update_end_addr=True):
+        self.code = bytes(code)
+        self.num_insns = 0
+        self.log(">>> %d bytes of raw code loaded" % len(self.code))
+        if update_end_addr:
+            self.end_addr = self.start_addr + len(self.code)
+        return True
+
+
+    @measured_phase("map_code")
     def map_code(self):
         if ".text" not in self.areas.keys():
             self.log("Missing text area (add a .text section in the Mapping tab)")
@@ -157,16 +466,24 @@ class Emulator:
 
         addr = self.areas[".text"][0]
         self.log(">>> mapping .text at %#x" % addr)
-        self.vm.mem_write(addr, bytes(self.code))
+        self.write_memory(addr, bytes(self.code))
+        self.mark_dirty()
+        self.insn_cache.clear()
+        self.block_insns.clear()
         return True
 
 
     def disassemble_one_instruction(self, code, addr):
-        arch, mode, endian = get_arch_mode("capstone", self.mode)
-        cs = capstone.Cs(arch, mode | endian)
-        if self.mode in (Architecture.X86_16_ATT, Architecture.X86_32_ATT, Architecture.X86_64_ATT):
-            cs.syntax = capstone.CS_OPT_SYNTAX_ATT
-        for i in cs.disasm(bytes(code), addr):
+        # keyed on the bytes as well: rewritten code misses the cache, whatever the trace
+        # level, and the entries it replaced age out
+        key = (addr, bytes(code))
+        insn = self.insn_cache.get(key)
+        if insn is not None:
+            return insn
+
+        cs = get_capstone_engine(self.mode)
+        for i in cs.disasm(key[1], addr):
+            self.insn_cache.put(key, i)
             return i
 
 
@@ -175,51 +492,485 @@ class Emulator:
         insn = self.disassemble_one_instruction(code, address)
 
         if self.stop_now:
-            self.start_addr = self.get_register_value(self.mode.get_pc())
+            self.start_addr = self.get_pc_value()
+            self.stop_reason = STOP_STEP
             emu.emu_stop()
             return
 
-        self.log(">> Executing instruction at 0x{:x}".format(address))
-        self.pprint(">>> 0x{:x}: {:s} {:s}".format(insn.address, insn.mnemonic, insn.op_str))
+        if insn is None:
+            self.trace.push(TRACE_INSN, address, "(bad)", "")
+        else:
+            self.trace.push(TRACE_INSN, insn.address, insn.mnemonic, insn.op_str)
+        if self.count_per_insn:
+            self.executed_insns += 1
+            self.current_pc = address
+            if self.progress_callback is not None and self.executed_insns & PROGRESS_CHECK_MASK == 0:
+                self.report_progress()
 
         if self.use_step_mode:
             self.stop_now = True
         return
 
 
+    def count_block_insns(self, addr, size):
+        count = self.block_insns.get((addr, size))
+        if count is None:
+            code = bytes(self.vm.mem_read(addr, size))
+            count = sum(1 for _ in get_capstone_engine(self.mode).disasm_lite(code, addr))
+            self.block_insns[(addr, size)] = count
+        return count
+
+
     def hook_block(self, emu, addr, size, misc):
-        self.pprint(">>> Entering new block at 0x{:x}".format(addr))
+        self.trace.push(TRACE_BLOCK, addr, size)
+        if not self.count_per_insn and "stats_block" not in self.hooks:
+            # instructions are not counted one by one, count them per block
+            self.count_block(addr, size)
+        return
+
+
+    def hook_count_block(self, emu, addr, size, misc):
+        if not self.count_per_insn:
+            self.count_block(addr, size)
+        return
+
+
+    def count_block(self, addr, size):
+        before = self.executed_insns
+        self.executed_insns += self.count_block_insns(addr, size)
+        self.current_pc = addr
+        self.last_block = (addr, size)
+        # the clock is checked every 1024 instructions, as in `hook_code`
+        if self.progress_callback is not None and (before ^ self.executed_insns) > PROGRESS_CHECK_MASK:
+            self.report_progress()
         return
 
 
     def hook_interrupt(self, emu, intno, data):
-        self.pprint(">>> Triggering interrupt #{:d}".format(intno))
+        self.trace.push(TRACE_INTERRUPT, intno)
+        if self.syscalls is not None:
+            abi = get_syscall_abis(self.mode.get_id()).get(intno)
+            if abi is not None:
+                self.handle_syscall(emu, abi)
+        return
+
+
+    def hook_syscall(self, emu, user_data):
+        self.handle_syscall(emu, get_syscall_abis(self.mode.get_id())[SYSCALL_INSN])
+        return
+
+
+    def handle_syscall(self, emu, abi):
+        """
+        Emulates the Linux syscall requested by the registers (see `cemu.syscalls`), stopping
+        the run on the ones ending the process (exit, execve).
+        """
+        call = self.syscalls.dispatch(self, abi)
+        self.log(format_call(call))
+        if self.syscalls.stop_reason is not None:
+            self.stop_reason = self.syscalls.stop_reason
+            emu.emu_stop()
         return
 
 
     def hook_mem_access(self, emu, access, address, size, value, user_data):
         if access == unicorn.UC_MEM_WRITE:
-            self.pprint(">>> MEM_WRITE : *%#x = %#x (size = %u)"% (address, value, size))
+            self.trace.push(TRACE_MEM_WRITE, address, value, size)
         elif access == unicorn.UC_MEM_READ:
-            self.pprint(">>> MEM_READ : reg = *%#x (size = %u)" % (address, size))
+            self.trace.push(TRACE_MEM_READ, address, size)
+        return
+
+
+    def report_progress(self):
+        """
+        Hands the instruction count, current PC, elapsed time and register values (see
+        `read_registers`) to `progress_callback`, at most once every PROGRESS_INTERVAL seconds.
+        """
+        now = time.time()
+        if now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        self.progress_callback(self.executed_insns, self.current_pc, now - self.run_start, self.read_registers())
+        return
+
+
+    def request_stop(self):
+        """
+        Interrupts a running emulation; can be called from another thread than the one
+        running `run()`.
+        """
+        if self.vm is not None:
+            self.stop_reason = STOP_USER
+            self.vm.emu_stop()
+        return
+
+
+    def start_binary_trace(self, fpath):
+        """
+        Streams the next runs into a binary trace file (see `cemu.bintrace`).
+        """
+        self.stop_binary_trace()
+        registers = self.mode.get_registers()
+        self.binary_trace = TraceWriter(fpath, self.mode, registers)
+        # $pc is already held by the instruction records
+        ids = self.get_register_ids()
+        self.bintrace_regs = [(i, ids[i]) for i, r in enumerate(registers) if r != self.mode.get_pc()]
+        self.bintrace_values = {}
+        return
+
+
+    def stop_binary_trace(self):
+        if self.binary_trace is None:
+            return
+        self.binary_trace.close()
+        self.log(">>> %d records written to binary trace '%s'" % (self.binary_trace.count, self.binary_trace.fpath))
+        self.binary_trace = None
         return
 
 
+    def start_coverage(self, name=".text"):
+        """
+        Collects the blocks of the area `name` executed by the next runs (see `cemu.coverage`).
+        """
+        address, size, permission = self.areas[name]
+        self.coverage = Coverage(address, size, name)
+        return self.coverage
+
+
+    def stop_coverage(self):
+        """
+        Stops collecting the coverage, and returns it.
+        """
+        coverage, self.coverage = self.coverage, None
+        if coverage is not None:
+            coverage.flush()
+        return coverage
+
+
+    def record_register_deltas(self):
+        reg_read, last = self.vm.reg_read, self.bintrace_values
+        for i, ur in self.bintrace_regs:
+            value = reg_read(ur)
+            if value != last.get(i):
+                last[i] = value
+                self.binary_trace.reg(i, value)
+        return
+
+
+    def hook_bintrace_code(self, emu, address, size, user_data):
+        # register changes are attributed to the previous instruction
+        self.record_register_deltas()
+        self.binary_trace.insn(address, size)
+        return
+
+
+    def hook_bintrace_mem_access(self, emu, access, address, size, value, user_data):
+        if access == unicorn.UC_MEM_WRITE:
+            self.binary_trace.mem_write(address, size, value)
+        else:
+            self.binary_trace.mem_read(address, size)
+        return
+
+
+    def add_watchpoint(self, start, end, access="rw", stop=False):
+        """
+        Watches an address range from the next run on (see `cemu.watch.Watchpoint`).
+        """
+        return self.watch_index.add(Watchpoint(start, end, access, stop))
+
+
+    def remove_watchpoint(self, watchpoint):
+        self.watch_index.remove(watchpoint)
+        return
+
+
+    def hook_watch(self, emu, access, address, size, value, user_data):
+        kind = "w" if access == unicorn.UC_MEM_WRITE else "r"
+        for wp in self.watch_index.lookup(address, size):
+            if kind not in wp.access:
+                continue
+            wp.hits += 1
+            self.watch_hits.append( (self.get_pc_value(), kind, address, size, value if kind == "w" else None, wp) )
+            if wp.stop:
+                self.stop_reason = STOP_WATCHPOINT
+                emu.emu_stop()
+        return
+
+
+    def get_access_report(self):
+        """
+        Returns the aggregated memory access counts of the runs since the code was loaded
+        (see `AccessStats.report`), or None when not counting.
+        """
+        if self.access_stats is None:
+            return None
+        return self.access_stats.report(self.areas)
+
+
+    def add_breakpoint(self, address, condition=None, hit_count=1):
+        """
+        Stops the next runs before the instruction at `address` (see `cemu.breakpoints.Breakpoint`).
+        """
+        bp = Breakpoint(address, condition, hit_count)
+        # unknown registers are reported now rather than when hit
+        bp.resolve(self.unicorn_register)
+        return self.breakpoints.add(bp)
+
+
+    def remove_breakpoint(self, breakpoint):
+        self.breakpoints.remove(breakpoint)
+        return
+
+
+    def hook_breakpoint(self, emu, address, size, user_data):
+        if address == self.skip_breakpoint:
+            self.skip_breakpoint = None
+            return
+
+        fired = False
+        for bp in self.breakpoints.get(address):
+            if bp.hit(emu.reg_read):
+                self.log(">>> Breakpoint %s hit (%d hits)" % (bp, bp.hits))
+                fired = True
+        if fired:
+            self.stop_reason = STOP_BREAKPOINT
+            emu.emu_stop()
+        return
+
+
+    def hook_mem_budget(self, emu, access, address, size, value, user_data):
+        self.mem_accesses += 1
+        # never equal to an unlimited (0) budget
+        if self.mem_accesses == self.max_mem_accesses:
+            self.stop_reason = STOP_MAX_MEM_ACCESSES
+            emu.emu_stop()
+        return
+
+
+    def get_stop_reason(self):
+        if self.stop_reason is not None:
+            return self.stop_reason
+        if self.is_finished():
+            return STOP_END
+        if self.max_time_us and self.vm.query(unicorn.UC_QUERY_TIMEOUT):
+            return STOP_TIMEOUT
+        if self.max_insns:
+            return STOP_MAX_INSNS
+        return STOP_USER
+
+
     def run(self):
+        self.last_error = None
+        self.stop_reason = None
+        self.mem_accesses = 0
+        self.stats.begin_run()
+        # the hits of the last run are logged, the watchpoints counting them all
+        self.watch_hits.clear()
+        # resuming from a stop must not break again before the instruction it stopped at
+        self.skip_breakpoint = self.start_addr if self.stop_pc == self.start_addr else None
+        if self.profile is not None and self.profiler is None:
+            address, size, permission = self.areas[".text"]
+            self.profiler = Profiler(address, size, self.profile)
+        # instruction and time budgets are enforced by unicorn itself, only the memory
+        # access budget needs a hook
+        self.setup_hooks()
+        self.mark_dirty()
+        self.last_block = None
+        insns_before = self.executed_insns
+        self.run_start = time.time()
         try:
-            self.vm.emu_start(self.start_addr, self.end_addr)
+            self.emulate()
         except unicorn.unicorn.UcError as e:
+            self.run_elapsed = time.time() - self.run_start
             self.vm.emu_stop()
-            self.log("An error occured during emulation")
-            return
+            self.last_error = str(e)
+            self.stop_reason = STOP_ERROR
+            self.stop_pc = self.get_pc_value()
+            self.run_insns = self.count_run_insns(insns_before)
+            self.flush_trace()
+            self.log("An error occured during emulation: %s" % self.last_error)
+            self.stats.end_run(self.run_insns, self.run_elapsed)
+            if self.coverage is not None:
+                self.coverage.end_run()
+            self.log_stats()
+            return False
+
+        self.run_elapsed = time.time() - self.run_start
+        if self.binary_trace is not None:
+            self.record_register_deltas()
+            self.binary_trace.flush()
+        self.stop_reason = self.get_stop_reason()
+        self.stop_pc = self.get_pc_value()
+        self.run_insns = self.count_run_insns(insns_before)
+        if self.stop_reason not in (STOP_END, STOP_STEP):
+            # resume from where the budget or the user stopped the run
+            self.start_addr = self.stop_pc
+            self.log(">>> Emulation stopped (%s) at %#x" % (self.stop_reason, self.stop_pc))
 
-        if self.get_register_value( self.mode.get_pc() )==self.end_addr:
+        self.flush_trace()
+        self.stats.end_run(self.run_insns, self.run_elapsed)
+        if self.coverage is not None:
+            self.coverage.end_run()
+        self.log_stats()
+
+        # the UI renders the end of the run itself, once the emulation thread is done
+        if self.widget is None and self.is_finished():
             self.pprint(">>> End of emulation")
-            self.widget.commandWidget.runButton.setDisabled(True)
-            self.widget.commandWidget.stepButton.setDisabled(True)
+        return True
+
+
+    def count_run_insns(self, insns_before):
+        """
+        Returns the number of instructions executed by the run that just stopped at
+        `stop_pc`. The blocks being counted whole when entered, the instructions of the
+        last block from the stop PC on are taken back (a run stopped at the start of a
+        block only entered it if an instruction budget or an error stopped it there).
+        """
+        if not self.count_per_insn and self.last_block is not None:
+            addr, size = self.last_block
+            pc = self.stop_pc
+            if addr < pc < addr + size or (pc == addr and self.stop_reason in (STOP_MAX_INSNS, STOP_ERROR)):
+                code = bytes(self.vm.mem_read(addr, size))
+                for insn in get_capstone_engine(self.mode).disasm_lite(code, addr):
+                    if insn[0] >= pc:
+                        self.executed_insns -= 1
+            self.last_block = None
+
+        if self.stop_reason == STOP_MAX_INSNS:
+            # unicorn ran exactly the budget, even with no hook counting the instructions
+            self.executed_insns = insns_before + self.max_insns
+        return self.executed_insns - insns_before
+
+
+    def emulate(self):
+        if self.is_sampling():
+            timed_out = self.run_slices(self.profiler.sample_interval, self.profiler.sample)
+        elif self.progress_callback is not None and not self.max_insns and not self.has_progress_hook():
+            timed_out = self.run_slices(PROGRESS_SLICE_US)
+        else:
+            self.vm.emu_start(self.start_addr, self.end_addr, timeout=self.max_time_us, count=self.max_insns)
+            return
+
+        if timed_out:
+            self.stop_reason = STOP_TIMEOUT
+        return
+
+
+    def has_progress_hook(self):
+        """
+        Returns True if a hook called on every instruction or block reports the progress.
+        """
+        for name in ("code", "block", "stats_block"):
+            if name in self.hooks and self.hooks[name][1][2:4] == (1, 0):
+                return True
+        return False
+
+
+    def run_slices(self, interval, on_slice=None):
+        """
+        Runs from the start address in slices of `interval` microseconds, until the end
+        address, an error, or a stop; unicorn interrupts a slice on a block boundary.
+        Between two slices, `on_slice(pc)` is called and the progress is reported. The
+        time budget applies to the whole run: returns True if it was exhausted.
+        """
+        deadline = time.time() + self.max_time_us / 1e6 if self.max_time_us else None
+        address = self.start_addr
+        while True:
+            timeout = interval
+            if deadline is not None:
+                remaining = int((deadline - time.time()) * 1e6)
+                if remaining <= 0:
+                    return True
+                timeout = min(timeout, remaining)
+
+            self.vm.emu_start(address, self.end_addr, timeout=timeout)
+            address = self.get_pc_value()
+            if self.stop_reason is not None or address == self.end_addr:
+                return False
+            if not self.vm.query(unicorn.UC_QUERY_TIMEOUT):
+                # stopped by a hook
+                return False
+            if on_slice is not None:
+                on_slice(address)
+            if self.progress_callback is not None:
+                self.current_pc = address
+                self.report_progress()
+        return False
+
+
+    def is_sampling(self):
+        # unicorn cannot tell how many instructions a slice executed, so an instruction
+        # budget falls back to counting (and to reporting the progress from the hooks only)
+        return self.profiler is not None and self.profiler.sample_interval > 0 and not self.max_insns
+
+
+    def get_profile(self, limit=None):
+        """
+        Returns the hot spots of the runs since the code was loaded (see `Profiler.report`),
+        or None when not profiling.
+        """
+        if self.profiler is None:
+            return None
+        if limit is None:
+            return self.profiler.report(self.vm, self.mode)
+        return self.profiler.report(self.vm, self.mode, limit)
+
+
+    def flush_trace(self):
+        """
+        Renders the trace records pushed by the hooks since the last flush.
+        """
+        if self.widget is not None:
+            # flushed by the UI timer
+            return
+
+        count, records = self.trace.drain()
+        if not self.verbose:
+            return
+        if count > len(records):
+            print(">>> %d trace records dropped" % (count - len(records)))
+        for record in records:
+            print(format_record(record))
         return
 
 
+    def log_stats(self):
+        if self.run_insns > 0 and self.run_elapsed > 0:
+            self.log(">>> %d instructions executed in %.3fs (%d instructions/s)" % (self.run_insns, self.run_elapsed, self.run_insns / self.run_elapsed))
+        elif self.trace_level == TRACE_LEVEL_NONE:
+            # counting them would take the block hook the trace level none does without
+            self.log(">>> Emulation took %.3fs (instructions are only counted with tracing, the stats or an instruction budget)" % self.run_elapsed)
+
+        cache = self.insn_cache
+        if cache.hits + cache.misses > 0:
+            self.log(">>> Decoded instruction cache: %d hits, %d misses (%.1f%% hit rate, %d entries)" % (cache.hits, cache.misses, cache.hit_rate(), len(cache)))
+
+        if self.stats.enabled:
+            for line in self.stats.format():
+                self.log(line)
+
+        if self.profiler is not None:
+            for line in format_report(self.get_profile()):
+                self.log(line)
+
+        for hit in self.watch_hits:
+            self.log(format_hit(hit))
+        for wp in self.watch_index.watchpoints:
+            self.log(">>> Watchpoint %s: %d hits" % (wp, wp.hits))
+
+        if self.access_stats is not None:
+            for line in format_access_report(self.get_access_report()):
+                self.log(line)
+
+        if self.syscalls is not None and len(self.syscalls.calls):
+            self.log(">>> %d syscalls, behaviours: %s" % (len(self.syscalls.calls), ", ".join(self.syscalls.get_behaviours()) or "none"))
+        return
+
+
+    def is_finished(self):
+        return self.get_pc_value()==self.end_addr
+
+
     def stop(self):
         for area in self.areas.keys():
             addr, size = self.areas[area][0:2]
@@ -231,6 +982,87 @@ class Emulator:
         return
 
 
+    @measured_phase("snapshot")
+    def snapshot(self):
+        """
+        Captures the register context and the content of every mapped area.
+        """
+        memory = {}
+        for name, (address, size, permission) in self.areas.items():
+            content = self.read_area(name)
+            area = self.file_areas.get(name)
+            if area is not None and (area.clean or content == area.pristine):
+                # still identical to the file, which is referenced rather than copied
+                area.clean = True
+                content = area.pristine
+            else:
+                content = bytes(content)
+            memory[name] = (address, size, content)
+        return Snapshot(self.mode.get_id(), self.vm.context_save(), memory,
+                        getattr(self, "start_addr", None), getattr(self, "end_addr", None), dict(self.area_versions))
+
+
+    @measured_phase("restore")
+    def restore(self, snap):
+        """
+        Brings the VM back to the state of a snapshot taken from it, rewriting only the
+        pages modified since then. Only the writable areas, and the read-only ones the
+        host wrote (see `write_memory`), are compared. Returns the number of pages rewritten.
+        """
+        if snap.mode != self.mode.get_id() or sorted(snap.memory.keys()) != sorted(self.areas.keys()):
+            raise Exception("Snapshot does not match the current mappings")
+
+        if hasattr(self.vm, "ctl_flush_tb"):
+            # unicorn can keep translated blocks of the code being rewound
+            self.vm.ctl_flush_tb()
+
+        self.reset_state()
+        self.vm.context_restore(snap.context)
+        self.start_addr, self.end_addr = snap.start_addr, snap.end_addr
+
+        pages = remapped = 0
+        for name, (address, size, content) in snap.memory.items():
+            permission = self.areas[name][2]
+            if not self.unicorn_permissions(permission) & unicorn.UC_PROT_WRITE and self.area_versions.get(name) == snap.versions.get(name):
+                # the guest cannot write it, and the host did not since the snapshot
+                continue
+
+            area = self.file_areas.get(name)
+            if area is not None and content is area.pristine:
+                if not area.clean:
+                    # mapping the file again is cheaper than comparing it
+                    self.vm.mem_unmap(area.address, area.size)
+                    self.map_file_area(area)
+                    remapped += 1
+                continue
+
+            current = self.read_area(name)
+            if current == content:
+                continue
+            current, content = memoryview(current), memoryview(content)
+            for offset in range(0, size, PAGE_SIZE):
+                page = content[offset:offset+PAGE_SIZE]
+                if current[offset:offset+PAGE_SIZE] != page:
+                    self.vm.mem_write(address + offset, page.tobytes())
+                    pages += 1
+            if area is not None:
+                area.clean = False
+
+        self.area_versions = dict(snap.versions)
+        self.log(">>> Snapshot restored (%d pages rewritten, %d file-backed areas mapped again)" % (pages, remapped))
+        return pages
+
+
+    def find_area(self, address):
+        """
+        Returns (name, address, size) of the mapped area holding the address, or None.
+        """
+        for name, (start, size, permission) in self.areas.items():
+            if start <= address < start + size:
+                return (name, start, size)
+        return None
+
+
     def lookup_map(self, mapname):
         for area in self.areas.keys():
             if area == mapname:
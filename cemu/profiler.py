@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Execution hot spots of an area (`.text`), per instruction and per basic block.
+
+In counting mode, a block hook restricted to the area counts the executions of each
+block in an array indexed by the offset of the block; the instructions of a block are
+only decoded when the report is built, each one being credited with the count of its
+block. In sampling mode, no hook is installed: the emulation runs in slices of a few
+milliseconds (see `Emulator.run_slices`) and the PC is sampled between two slices,
+which unicorn interrupts on a block boundary.
+"""
+
+import array
+
+from .utils import get_capstone_engine
+
+
+PROFILE_COUNT = "count"
+PROFILE_SAMPLE = "sample"
+
+# default time (in microseconds) between two samples
+PROFILE_SAMPLE_INTERVAL = 1000
+
+# number of hot spots reported
+PROFILE_TOP = 20
+
+
+class Profiler:
+
+    def __init__(self, base, size, sample_interval=0, *args, **kwargs):
+        self.base = base
+        self.size = size
+        # 0 counts every block execution, otherwise the PC is sampled every this many microseconds
+        self.sample_interval = sample_interval
+        self.counts = array.array("Q", bytes(8 * size))
+        self.sizes = array.array("I", bytes(4 * size))
+        self.total = 0
+        return
+
+
+    def get_mode(self):
+        return PROFILE_SAMPLE if self.sample_interval else PROFILE_COUNT
+
+
+    def hook_block(self, uc, address, size, user_data):
+        offset = address - self.base
+        self.counts[offset] += 1
+        self.sizes[offset] = size
+        return
+
+
+    def sample(self, address):
+        offset = address - self.base
+        if 0 <= offset < self.size:
+            self.counts[offset] += 1
+        self.total += 1
+        return
+
+
+    def get_blocks(self):
+        """
+        Returns the (offset, size, count) of the executed blocks, or of the sampled
+        addresses (of unknown size) in sampling mode.
+        """
+        counts, sizes = self.counts, self.sizes
+        return [(offset, sizes[offset], counts[offset]) for offset in range(self.size) if counts[offset]]
+
+
+    def report(self, vm, mode, limit=PROFILE_TOP):
+        """
+        Returns the hot spots as a dict, with the `limit` most executed (or sampled)
+        blocks and instructions annotated with their disassembly.
+        """
+        cs = get_capstone_engine(mode)
+        blocks = self.get_blocks()
+        insns = {}
+        listings = {}
+        for offset, size, count in blocks:
+            address = self.base + offset
+            # a sampled address is reported as the instruction found there
+            code = bytes(vm.mem_read(address, min(size or 16, self.size - offset)))
+            listing = []
+            for insn in cs.disasm_lite(code, address):
+                listing.append( (insn[0], "{:s} {:s}".format(insn[2], insn[3]).strip()) )
+                if not size:
+                    break
+            listings[address] = listing
+            for pc, text in listing:
+                total, _ = insns.get(pc, (0, text))
+                insns[pc] = (total + count, text)
+
+        if self.sample_interval:
+            insns_total = blocks_total = self.total
+        else:
+            insns_total = sum([count for count, text in insns.values()])
+            blocks_total = sum([count for offset, size, count in blocks])
+        def percent(count, total):
+            return 100.0 * count / total if total else 0.0
+
+        top_blocks = sorted(blocks, key=lambda b: (-b[2], b[0]))[:limit]
+        top_insns = sorted(insns.items(), key=lambda i: (-i[1][0], i[0]))[:limit]
+        return {"mode": self.get_mode(),
+                "total": insns_total,
+                "blocks": [{"address": self.base + offset, "size": size, "count": count, "percent": percent(count, blocks_total),
+                            "insns": [text for pc, text in listings[self.base + offset]]}
+                           for offset, size, count in top_blocks],
+                "insns": [{"address": pc, "count": count, "percent": percent(count, insns_total), "insn": text}
+                          for pc, (count, text) in top_insns],}
+
+
+def format_report(report):
+    """
+    Returns the hot spot table of a report as lines of text, for the log.
+    """
+    unit = "samples" if report["mode"] == PROFILE_SAMPLE else "instructions executed"
+    lines = [">>> Hot spots (%d %s)" % (report["total"], unit)]
+    for insn in report["insns"]:
+        lines.append(">>> %#10x %12d %6.2f%%  %s" % (insn["address"], insn["count"], insn["percent"], insn["insn"]))
+    lines.append(">>> Hot blocks")
+    for block in report["blocks"]:
+        lines.append(">>> %#10x %12d %6.2f%%  %s" % (block["address"], block["count"], block["percent"], " ; ".join(block["insns"])))
+    return lines
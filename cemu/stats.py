@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""
+Instrumentation of the emulator: wall time of each phase (`compile_code`, `populate_memory`,
+`map_code`, `run`...), calls of and time spent in each hook, and the instruction, block,
+interrupt and memory access counts of the last run.
+
+When disabled, phases cost a no-op context manager and the hooks are installed as is.
+When enabled, the emulator also installs a block hook and a memory hook over the whole
+address space, so that the counts do not depend on the trace level (at the cost of a
+slower run with `--trace none`).
+"""
+
+import time
+import functools
+import contextlib
+
+import unicorn
+
+
+# a phase that is not measured
+_NULL_PHASE = contextlib.nullcontext()
+
+# hooks counting the memory accesses and the blocks, the first one installed being
+# reported (they all see the same accesses, but for the trace range)
+MEMORY_HOOKS = ("mem_budget", "memory", "bintrace_memory")
+BLOCK_HOOKS = ("stats_block", "block")
+
+
+def measured_phase(name):
+    """
+    Decorates an `Emulator` method to account for its time in the phase `name`.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.stats.phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class EmulatorStats:
+
+    def __init__(self, enabled=False, *args, **kwargs):
+        self.enabled = enabled
+        self.phases = {}
+        self.hook_calls = {}
+        self.hook_time = {}
+        self.hook_writes = {}
+        # names of the hooks installed for the run, see `Emulator.get_wanted_hooks`
+        self.installed_hooks = set()
+        self.run_insns = 0
+        return
+
+
+    def reset(self):
+        """
+        Forgets everything measured; the dicts are cleared rather than replaced, as the
+        installed hook wrappers hold them.
+        """
+        self.phases.clear()
+        self.begin_run()
+        return
+
+
+    def begin_run(self):
+        self.phases.pop("run", None)
+        self.hook_calls.clear()
+        self.hook_time.clear()
+        self.hook_writes.clear()
+        self.run_insns = 0
+        return
+
+
+    def end_run(self, insns, elapsed):
+        """
+        Records the instruction count and the time spent in unicorn (hooks included) by
+        the run that just ended.
+        """
+        if self.enabled:
+            self.run_insns = insns
+            self.phases["run"] = elapsed
+        return
+
+
+    def phase(self, name):
+        """
+        Returns a context manager adding the time spent in it to the phase `name`.
+        """
+        if not self.enabled:
+            return _NULL_PHASE
+        return self.measure(name)
+
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - t0
+        return
+
+
+    def wrap_hook(self, name, callback, memory=False):
+        """
+        Returns a hook calling `callback` and accounting for its calls and time (and for
+        the memory writes, with `memory`, the other accesses being reads).
+        """
+        perf_counter = time.perf_counter
+        calls, spent, writes = self.hook_calls, self.hook_time, self.hook_writes
+
+        if memory:
+            def hook(uc, access, *args):
+                t0 = perf_counter()
+                ret = callback(uc, access, *args)
+                spent[name] = spent.get(name, 0.0) + perf_counter() - t0
+                calls[name] = calls.get(name, 0) + 1
+                if access == unicorn.UC_MEM_WRITE:
+                    writes[name] = writes.get(name, 0) + 1
+                return ret
+            return hook
+
+        def hook(*args):
+            t0 = perf_counter()
+            ret = callback(*args)
+            spent[name] = spent.get(name, 0.0) + perf_counter() - t0
+            calls[name] = calls.get(name, 0) + 1
+            return ret
+        return hook
+
+
+    def get_counters(self):
+        """
+        Returns the counts of the last run, None for those no installed hook could see
+        (a hook installed but never called counting 0).
+        """
+        counters = {"instructions": self.run_insns,
+                    "blocks": None,
+                    "interrupts": self.hook_calls.get("interrupt", 0),
+                    "memory_reads": None,
+                    "memory_writes": None,}
+        for name in BLOCK_HOOKS:
+            if name in self.installed_hooks:
+                counters["blocks"] = self.hook_calls.get(name, 0)
+                break
+        for name in MEMORY_HOOKS:
+            if name in self.installed_hooks:
+                writes = self.hook_writes.get(name, 0)
+                counters["memory_reads"] = self.hook_calls.get(name, 0) - writes
+                counters["memory_writes"] = writes
+                break
+        return counters
+
+
+    def as_dict(self):
+        run = self.phases.get("run", 0.0)
+        hooks = sum(self.hook_time.values())
+        return {"phases": dict(self.phases),
+                "hooks": dict([(name, {"calls": self.hook_calls[name], "time": self.hook_time[name]})
+                               for name in self.hook_calls]),
+                "unicorn_time": max(0.0, run - hooks),
+                "counters": self.get_counters(),}
+
+
+    def format(self):
+        """
+        Returns the stats as lines of text, for the log.
+        """
+        stats = self.as_dict()
+        lines = [">>> Phases: " + ", ".join(["%s %.3fs" % (name, elapsed) for name, elapsed in sorted(stats["phases"].items())])]
+        if "run" in stats["phases"]:
+            lines.append(">>> Run: %.3fs in unicorn, %.3fs in hooks" % (stats["unicorn_time"], sum(self.hook_time.values())))
+        for name, hook in sorted(stats["hooks"].items()):
+            lines.append(">>> Hook %s: %d calls, %.3fs" % (name, hook["calls"], hook["time"]))
+        counters = stats["counters"]
+        lines.append(">>> Counters: " + ", ".join(["%s %s" % (name.replace("_", " "), "n/a" if counters[name] is None else counters[name])
+                                                   for name in ("instructions", "blocks", "interrupts", "memory_reads", "memory_writes")]))
+        return lines
@@ -0,0 +1,636 @@
+# -*- coding: utf-8 -*-
+
+"""
+Linux system call emulation, behind the interrupt hook of the emulator.
+
+Each architecture has a dispatch table mapping the interrupt (or instruction) raised by
+its system call instruction to an ABI: the registers holding the syscall number, the
+arguments and the result, and the table of the syscall numbers handled:
+
+    x86-32      int 0x80        EAX, (EBX, ECX, EDX, ESI, EDI, EBP)
+    x86-64      syscall         RAX, (RDI, RSI, RDX, R10, R8, R9), and int 0x80 as x86-32
+    ARM         svc 0           R7, (R0-R5), EABI
+    AArch64     svc 0           X8, (X0-X5)
+    MIPS        syscall         $v0, ($a0-$a3 then the stack for o32), $a3 set on errors
+    SPARC       t 0x10/t 0x6d   %g1, (%o0-%o5)
+
+open/openat, read, write, close, execve, exit/exit_group, mmap/mmap2 and munmap are
+emulated against a sandboxed in-memory filesystem: nothing on the host is ever read or
+written. The other syscalls fail with ENOSYS. Every call is logged with its arguments
+and result, and the log is summed up in behaviours (spawns a shell, reads a file, ...)
+so that batch runs can tell what a payload does.
+
+Handlers are looked up by name, other syscalls can be plugged in with
+`SyscallLayer.register`.
+"""
+
+import posixpath
+import collections
+
+import unicorn
+
+from .arch import Architecture
+
+
+# key of the x86-64 `syscall` instruction in the dispatch tables, interrupts being numbers
+SYSCALL_INSN = "syscall"
+
+# number of calls kept in the log
+SYSCALL_LOG_SIZE = 1000
+
+# longest path, and most argv/envp entries, read from the guest memory
+PATH_MAX = 4096
+MAX_ARGS = 64
+
+# bytes of the data read or written shown in the log
+DATA_PREVIEW_SIZE = 64
+
+# reasons for which a syscall stops the emulation
+STOP_EXIT = "exit"
+STOP_EXECVE = "execve"
+
+# lowest address where `mmap` places the mappings it chooses
+MMAP_BASE = 0x10000000
+MMAP_PAGE_SIZE = 0x1000
+
+ENOENT = 2
+EBADF = 9
+ENOMEM = 12
+EFAULT = 14
+EINVAL = 22
+ENOSYS = 38
+
+O_ACCMODE = 3
+O_RDONLY = 0
+O_WRONLY = 1
+O_RDWR = 2
+AT_FDCWD = -100
+MAP_FIXED = 0x10
+
+SHELLS = ("sh", "bash", "dash", "zsh", "ksh", "csh", "tcsh", "ash", "busybox")
+
+# number of arguments of each emulated syscall
+SYSCALL_ARGS = {"exit": 1, "exit_group": 1, "read": 3, "write": 3, "open": 3, "openat": 4, "close": 1,
+                "execve": 3, "execv": 2, "mmap": 6, "mmap2": 6, "old_mmap": 1, "munmap": 2,}
+
+X86_32_SYSCALLS = {1: "exit", 3: "read", 4: "write", 5: "open", 6: "close", 11: "execve", 90: "old_mmap",
+                   91: "munmap", 192: "mmap2", 252: "exit_group", 295: "openat",}
+X86_64_SYSCALLS = {0: "read", 1: "write", 2: "open", 3: "close", 9: "mmap", 11: "munmap", 59: "execve",
+                   60: "exit", 231: "exit_group", 257: "openat",}
+ARM_SYSCALLS = {1: "exit", 3: "read", 4: "write", 5: "open", 6: "close", 11: "execve", 91: "munmap",
+                192: "mmap2", 248: "exit_group", 322: "openat",}
+AARCH64_SYSCALLS = {56: "openat", 57: "close", 63: "read", 64: "write", 93: "exit", 94: "exit_group",
+                    215: "munmap", 221: "execve", 222: "mmap",}
+MIPS_O32_SYSCALLS = {4001: "exit", 4003: "read", 4004: "write", 4005: "open", 4006: "close", 4011: "execve",
+                     4090: "mmap", 4091: "munmap", 4210: "mmap2", 4246: "exit_group", 4288: "openat",}
+MIPS_N64_SYSCALLS = {5000: "read", 5001: "write", 5002: "open", 5003: "close", 5009: "mmap", 5011: "munmap",
+                     5057: "execve", 5058: "exit", 5205: "exit_group", 5247: "openat",}
+SPARC_SYSCALLS = {1: "exit", 3: "read", 4: "write", 5: "open", 6: "close", 11: "execv", 59: "execve",
+                  71: "mmap", 73: "munmap", 188: "exit_group", 284: "openat",}
+
+
+class SyscallABI:
+    """
+    Calling convention of the system calls of an architecture. `open_flags` holds the
+    values of O_CREAT, O_TRUNC and O_APPEND, which differ from one architecture to another.
+    """
+
+    def __init__(self, name, number_reg, arg_regs, ret_reg, table, word_size, *args, **kwargs):
+        self.name = name
+        self.number_reg = number_reg
+        self.arg_regs = arg_regs
+        self.ret_reg = ret_reg
+        self.table = table
+        self.word_size = word_size
+        # offset from the stack pointer of the arguments not held by registers (MIPS o32)
+        self.stack_args = kwargs.get("stack_args", None)
+        # register set on errors, the result then being the positive errno (MIPS)
+        self.error_flag = kwargs.get("error_flag", None)
+        self.map_anonymous = kwargs.get("map_anonymous", 0x20)
+        self.open_flags = kwargs.get("open_flags", (0x40, 0x200, 0x400))
+        return
+
+
+    def __str__(self):
+        return self.name
+
+
+X86_32_ABI = SyscallABI("x86_32", "EAX", ("EBX", "ECX", "EDX", "ESI", "EDI", "EBP"), "EAX", X86_32_SYSCALLS, 32)
+X86_64_ABI = SyscallABI("x86_64", "RAX", ("RDI", "RSI", "RDX", "R10", "R8", "R9"), "RAX", X86_64_SYSCALLS, 64)
+ARM_ABI = SyscallABI("arm", "R7", ("R0", "R1", "R2", "R3", "R4", "R5"), "R0", ARM_SYSCALLS, 32)
+AARCH64_ABI = SyscallABI("aarch64", "X8", ("X0", "X1", "X2", "X3", "X4", "X5"), "X0", AARCH64_SYSCALLS, 64)
+MIPS_O32_ABI = SyscallABI("mips_o32", "V0", ("A0", "A1", "A2", "A3"), "V0", MIPS_O32_SYSCALLS, 32,
+                          stack_args=16, error_flag="A3", map_anonymous=0x800, open_flags=(0x100, 0x200, 0x8))
+MIPS_N64_ABI = SyscallABI("mips_n64", "V0", ("A0", "A1", "A2", "A3", "T0", "T1"), "V0", MIPS_N64_SYSCALLS, 64,
+                          error_flag="A3", map_anonymous=0x800, open_flags=(0x100, 0x200, 0x8))
+# the kernel reports errors with the carry flag, which unicorn cannot set: the result
+# is the negated errno instead
+SPARC_ABI = SyscallABI("sparc", "G1", ("O0", "O1", "O2", "O3", "O4", "O5"), "O0", SPARC_SYSCALLS, 32,
+                       open_flags=(0x200, 0x400, 0x8))
+SPARC64_ABI = SyscallABI("sparc64", "G1", ("O0", "O1", "O2", "O3", "O4", "O5"), "O0", SPARC_SYSCALLS, 64,
+                         open_flags=(0x200, 0x400, 0x8))
+
+# architecture -> {interrupt number, or SYSCALL_INSN: ABI}; unicorn raises the SPARC
+# software traps as 0x80 + trap number
+SYSCALL_ABIS = {
+    Architecture.X86_32_INTEL: {0x80: X86_32_ABI},
+    Architecture.X86_32_ATT:   {0x80: X86_32_ABI},
+    Architecture.X86_64_INTEL: {0x80: X86_32_ABI, SYSCALL_INSN: X86_64_ABI},
+    Architecture.X86_64_ATT:   {0x80: X86_32_ABI, SYSCALL_INSN: X86_64_ABI},
+    Architecture.ARM_LE:       {2: ARM_ABI},
+    Architecture.ARM_BE:       {2: ARM_ABI},
+    Architecture.ARM_THUMB_LE: {2: ARM_ABI},
+    Architecture.ARM_THUMB_BE: {2: ARM_ABI},
+    Architecture.ARM_AARCH64:  {2: AARCH64_ABI},
+    Architecture.MIPS:         {17: MIPS_O32_ABI},
+    Architecture.MIPS_BE:      {17: MIPS_O32_ABI},
+    Architecture.MIPS64:       {17: MIPS_N64_ABI},
+    Architecture.MIPS64_BE:    {17: MIPS_N64_ABI},
+    Architecture.SPARC:        {0x90: SPARC_ABI},
+    Architecture.SPARC_BE:     {0x90: SPARC_ABI},
+    Architecture.SPARC64:      {0xed: SPARC64_ABI},
+    Architecture.SPARC64_BE:   {0xed: SPARC64_ABI},
+}
+
+
+def get_syscall_abis(arch):
+    """
+    Returns the dispatch table of an `Architecture`, empty when its syscalls are not emulated.
+    """
+    return SYSCALL_ABIS.get(arch, {})
+
+
+class SyscallError(Exception):
+    """
+    Raised by the handlers to fail a syscall with an errno.
+    """
+
+    def __init__(self, errno, *args, **kwargs):
+        super(SyscallError, self).__init__("errno %d" % errno)
+        self.errno = errno
+        return
+
+
+class OpenFile:
+
+    def __init__(self, path, flags, *args, **kwargs):
+        self.path = path
+        self.flags = flags
+        self.offset = 0
+        return
+
+
+    def readable(self):
+        return self.flags & O_ACCMODE in (O_RDONLY, O_RDWR)
+
+
+    def writable(self):
+        return self.flags & O_ACCMODE in (O_WRONLY, O_RDWR)
+
+
+class SandboxFS:
+    """
+    In-memory filesystem seen by the guest: `files` maps absolute paths to their content,
+    the guest reads an empty stdin and its stdout and stderr are captured.
+    """
+
+    def __init__(self, files=None, *args, **kwargs):
+        self.initial_files = dict(files or {})
+        self.reset()
+        return
+
+
+    def reset(self):
+        self.files = dict([(path, bytearray(data)) for path, data in self.initial_files.items()])
+        self.fds = {0: OpenFile("<stdin>", O_RDONLY), 1: OpenFile("<stdout>", O_WRONLY), 2: OpenFile("<stderr>", O_WRONLY)}
+        self.stdout = bytearray()
+        self.stderr = bytearray()
+        return
+
+
+    def add_file(self, path, data):
+        path = self.resolve(path)
+        self.initial_files[path] = bytes(data)
+        self.files[path] = bytearray(data)
+        return
+
+
+    def resolve(self, path):
+        return posixpath.normpath(posixpath.join("/", path))
+
+
+    def open(self, path, flags, creat, trunc):
+        path = self.resolve(path)
+        if path not in self.files:
+            if not flags & creat:
+                raise SyscallError(ENOENT)
+            self.files[path] = bytearray()
+        elif flags & trunc and flags & O_ACCMODE != O_RDONLY:
+            del self.files[path][:]
+
+        fd = 3
+        while fd in self.fds:
+            fd += 1
+        self.fds[fd] = OpenFile(path, flags)
+        return fd
+
+
+    def get(self, fd):
+        f = self.fds.get(fd)
+        if f is None:
+            raise SyscallError(EBADF)
+        return f
+
+
+    def close(self, fd):
+        self.get(fd)
+        del self.fds[fd]
+        return
+
+
+    def read(self, fd, count):
+        f = self.get(fd)
+        if not f.readable():
+            raise SyscallError(EBADF)
+        if fd == 0:
+            return b""
+        data = self.files[f.path][f.offset:f.offset + count]
+        f.offset += len(data)
+        return bytes(data)
+
+
+    def write(self, fd, data, append):
+        f = self.get(fd)
+        if not f.writable():
+            raise SyscallError(EBADF)
+        if fd == 1:
+            self.stdout += data
+        elif fd == 2:
+            self.stderr += data
+        else:
+            content = self.files[f.path]
+            if f.flags & append:
+                f.offset = len(content)
+            content[f.offset:f.offset + len(data)] = data
+            f.offset += len(data)
+        return len(data)
+
+
+class SyscallLayer:
+    """
+    Dispatches the system calls of the guest (see `Emulator.hook_interrupt`) to the
+    handlers, and logs them.
+    """
+
+    def __init__(self, files=None, *args, **kwargs):
+        self.fs = SandboxFS(files)
+        # syscall name -> handler(emu, abi, args, info), returning the result
+        self.handlers = {"exit": self.sys_exit, "exit_group": self.sys_exit,
+                         "read": self.sys_read, "write": self.sys_write, "close": self.sys_close,
+                         "open": self.sys_open, "openat": self.sys_openat,
+                         "execve": self.sys_execve, "execv": self.sys_execve,
+                         "mmap": self.sys_mmap, "mmap2": self.sys_mmap2, "old_mmap": self.sys_old_mmap,
+                         "munmap": self.sys_munmap,}
+        # (abi name, number) -> name of the syscalls plugged in
+        self.numbers = {}
+        self.nargs = dict(SYSCALL_ARGS)
+        self.calls = collections.deque(maxlen=SYSCALL_LOG_SIZE)
+        self.mappings = []
+        self.exit_status = None
+        # set by the syscalls ending the process, see `Emulator.handle_syscall`
+        self.stop_reason = None
+        return
+
+
+    def register(self, name, handler, nargs=6, numbers=None):
+        """
+        Plugs a handler in for the syscall `name`, `numbers` mapping the names of the ABIs
+        (e.g. "x86_32") to its number when it is not in their table.
+        """
+        self.handlers[name] = handler
+        self.nargs[name] = nargs
+        for abi, number in (numbers or {}).items():
+            self.numbers[(abi, number)] = name
+        return
+
+
+    def reset(self, vm=None):
+        """
+        Forgets the calls, the open files and the content written, and unmaps the memory
+        mapped by the guest from `vm`.
+        """
+        if vm is not None:
+            for address, size in self.mappings:
+                try:
+                    vm.mem_unmap(address, size)
+                except unicorn.UcError:
+                    pass
+        del self.mappings[:]
+        self.fs.reset()
+        self.calls.clear()
+        self.exit_status = None
+        self.stop_reason = None
+        return
+
+
+    def dispatch(self, emu, abi):
+        """
+        Runs the syscall requested by the registers and writes its result back. Returns
+        the call, as logged.
+        """
+        vm = emu.vm
+        reg = emu.unicorn_register
+        self.stop_reason = None
+        number = vm.reg_read(reg(abi.number_reg))
+        name = self.numbers.get((abi.name, number)) or abi.table.get(number)
+        handler = self.handlers.get(name)
+        args = self.read_args(emu, abi, self.nargs.get(name, len(abi.arg_regs)) if handler else len(abi.arg_regs))
+
+        info = {}
+        try:
+            if handler is None:
+                raise SyscallError(ENOSYS)
+            ret = handler(emu, abi, args, info)
+        except SyscallError as e:
+            ret = -e.errno
+
+        value = ret
+        if abi.error_flag is not None:
+            vm.reg_write(reg(abi.error_flag), 1 if ret < 0 else 0)
+            value = abs(ret)
+        vm.reg_write(reg(abi.ret_reg), value & ((1 << abi.word_size) - 1))
+
+        call = {"pc": emu.get_pc_value(), "abi": abi.name, "number": number,
+                "name": name or "syscall_%d" % number, "args": args, "ret": ret}
+        call.update(info)
+        self.calls.append(call)
+        return call
+
+
+    def read_args(self, emu, abi, count):
+        vm = emu.vm
+        args = [vm.reg_read(emu.unicorn_register(r)) for r in abi.arg_regs[:count]]
+        if count > len(abi.arg_regs) and abi.stack_args is not None:
+            sp = vm.reg_read(emu.mode.get_descriptor().sp_id)
+            for i in range(len(abi.arg_regs), count):
+                try:
+                    args.append(read_word(emu, abi, sp + abi.stack_args + 4 * i))
+                except SyscallError:
+                    args.append(0)
+        return args
+
+
+    def sys_exit(self, emu, abi, args, info):
+        # the parent of a Linux process only sees the low 8 bits of its status
+        self.exit_status = args[0] & 0xff
+        self.stop_reason = STOP_EXIT
+        return 0
+
+
+    def sys_open(self, emu, abi, args, info):
+        info["path"] = self.fs.resolve(read_string(emu, args[0]).decode("utf-8", "replace"))
+        creat, trunc, append = abi.open_flags
+        return self.fs.open(info["path"], args[1], creat, trunc)
+
+
+    def sys_openat(self, emu, abi, args, info):
+        path = read_string(emu, args[1]).decode("utf-8", "replace")
+        info["path"] = self.fs.resolve(path)
+        # the sandbox has no directory to be relative to but the root
+        if not path.startswith("/") and signed(args[0], abi.word_size) != AT_FDCWD:
+            raise SyscallError(EBADF)
+        creat, trunc, append = abi.open_flags
+        return self.fs.open(info["path"], args[2], creat, trunc)
+
+
+    def sys_close(self, emu, abi, args, info):
+        fd = signed(args[0], 32)
+        info["path"] = self.fs.get(fd).path
+        self.fs.close(fd)
+        return 0
+
+
+    def sys_read(self, emu, abi, args, info):
+        fd, address, count = signed(args[0], 32), args[1], args[2]
+        info["path"] = self.fs.get(fd).path
+        data = self.fs.read(fd, count)
+        write_memory(emu, address, data)
+        info["data"] = preview(data)
+        return len(data)
+
+
+    def sys_write(self, emu, abi, args, info):
+        fd, address, count = signed(args[0], 32), args[1], args[2]
+        info["path"] = self.fs.get(fd).path
+        data = read_memory(emu, address, count)
+        info["data"] = preview(data)
+        creat, trunc, append = abi.open_flags
+        return self.fs.write(fd, data, append)
+
+
+    def sys_execve(self, emu, abi, args, info):
+        info["path"] = read_string(emu, args[0]).decode("utf-8", "replace")
+        info["argv"] = read_string_array(emu, abi, args[1])
+        if len(args) > 2:
+            info["envp"] = read_string_array(emu, abi, args[2])
+        # the process image is replaced, there is nothing left to emulate
+        self.stop_reason = STOP_EXECVE
+        return 0
+
+
+    def sys_mmap(self, emu, abi, args, info):
+        return self.mmap(emu, abi, args[0], args[1], args[2], args[3], signed(args[4], 32), args[5], info)
+
+
+    def sys_mmap2(self, emu, abi, args, info):
+        # the offset is given in pages
+        return self.mmap(emu, abi, args[0], args[1], args[2], args[3], signed(args[4], 32), args[5] * MMAP_PAGE_SIZE, info)
+
+
+    def sys_old_mmap(self, emu, abi, args, info):
+        # the arguments are in a structure
+        fields = [read_word(emu, abi, args[0] + 4 * i) for i in range(6)]
+        return self.mmap(emu, abi, fields[0], fields[1], fields[2], fields[3], signed(fields[4], 32), fields[5], info)
+
+
+    def mmap(self, emu, abi, address, length, prot, flags, fd, offset, info):
+        if length == 0 or offset % MMAP_PAGE_SIZE:
+            raise SyscallError(EINVAL)
+        size = align_page(length)
+        data = b""
+        if not flags & abi.map_anonymous:
+            f = self.fs.get(fd)
+            if not f.readable() or fd <= 2:
+                raise SyscallError(EBADF)
+            info["path"] = f.path
+            data = bytes(self.fs.files[f.path][offset:offset + length])
+
+        if flags & MAP_FIXED:
+            if address % MMAP_PAGE_SIZE:
+                raise SyscallError(EINVAL)
+        elif address == 0 or address % MMAP_PAGE_SIZE or not self.is_free(emu, address, size):
+            address = self.find_free(emu, size, abi.word_size)
+
+        try:
+            emu.vm.mem_map(address, size, prot & (unicorn.UC_PROT_READ | unicorn.UC_PROT_WRITE | unicorn.UC_PROT_EXEC))
+        except unicorn.UcError:
+            raise SyscallError(ENOMEM)
+        if len(data):
+            emu.vm.mem_write(address, data)
+        self.mappings.append( (address, size) )
+        return address
+
+
+    def sys_munmap(self, emu, abi, args, info):
+        address, size = args[0], align_page(args[1])
+        if address % MMAP_PAGE_SIZE or size == 0:
+            raise SyscallError(EINVAL)
+        # only the memory mapped by the guest can be unmapped
+        for i, (start, length) in enumerate(self.mappings):
+            if start <= address and address + size <= start + length:
+                break
+        else:
+            raise SyscallError(EINVAL)
+
+        emu.vm.mem_unmap(address, size)
+        del self.mappings[i]
+        if start < address:
+            self.mappings.append( (start, address - start) )
+        if address + size < start + length:
+            self.mappings.append( (address + size, start + length - address - size) )
+        return 0
+
+
+    def is_free(self, emu, address, size):
+        for begin, end, perms in emu.vm.mem_regions():
+            if begin < address + size and address <= end:
+                return False
+        return True
+
+
+    def find_free(self, emu, size, word_size):
+        address = MMAP_BASE
+        for begin, end, perms in sorted(emu.vm.mem_regions()):
+            if end < address:
+                continue
+            if address + size <= begin:
+                break
+            address = align_page(end + 1)
+        if address + size > 1 << word_size:
+            raise SyscallError(ENOMEM)
+        return address
+
+
+    def get_behaviours(self):
+        return classify(self.calls)
+
+
+    def as_dict(self):
+        result = {"calls": list(self.calls), "behaviours": self.get_behaviours()}
+        if self.exit_status is not None:
+            result["exit_status"] = self.exit_status
+        for name in ("stdout", "stderr"):
+            data = getattr(self.fs, name)
+            if len(data):
+                result[name] = data.decode("utf-8", "replace")
+        return result
+
+
+def signed(value, bits):
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+
+def align_page(value):
+    return (value + MMAP_PAGE_SIZE - 1) & ~(MMAP_PAGE_SIZE - 1)
+
+
+def preview(data):
+    return bytes(data[:DATA_PREVIEW_SIZE]).decode("latin-1")
+
+
+def read_memory(emu, address, size):
+    try:
+        return bytes(emu.vm.mem_read(address, size))
+    except unicorn.UcError:
+        raise SyscallError(EFAULT)
+
+
+def write_memory(emu, address, data):
+    try:
+        emu.write_memory(address, data)
+    except unicorn.UcError:
+        raise SyscallError(EFAULT)
+    return
+
+
+def read_word(emu, abi, address):
+    size = abi.word_size // 8
+    return int.from_bytes(read_memory(emu, address, size), emu.mode.get_descriptor().endianness)
+
+
+def read_string(emu, address, limit=PATH_MAX):
+    """
+    Reads a NUL terminated string, without reading past the page holding its end.
+    """
+    data = b""
+    while len(data) < limit:
+        chunk = read_memory(emu, address, min(MMAP_PAGE_SIZE - address % MMAP_PAGE_SIZE, limit - len(data)))
+        end = chunk.find(b"\x00")
+        if end >= 0:
+            return data + chunk[:end]
+        data += chunk
+        address += len(chunk)
+    raise SyscallError(EFAULT)
+
+
+def read_string_array(emu, abi, address):
+    """
+    Reads a NULL terminated array of strings (argv, envp), NULL itself standing for an
+    empty one.
+    """
+    strings = []
+    if address == 0:
+        return strings
+    for i in range(MAX_ARGS):
+        pointer = read_word(emu, abi, address + i * abi.word_size // 8)
+        if pointer == 0:
+            break
+        strings.append(read_string(emu, pointer).decode("utf-8", "replace"))
+    return strings
+
+
+def classify(calls):
+    """
+    Returns the behaviours shown by the logged calls, successful or not, sorted.
+    """
+    behaviours = set()
+    for call in calls:
+        name, path = call["name"], call.get("path", "")
+        if name in ("execve", "execv"):
+            if posixpath.basename(path) in SHELLS:
+                behaviours.add("spawns_shell")
+            else:
+                behaviours.add("executes_program")
+        elif name in ("open", "openat"):
+            behaviours.add("opens_file")
+        elif name == "read":
+            behaviours.add("reads_input" if path == "<stdin>" else "reads_file")
+        elif name == "write":
+            behaviours.add("writes_output" if path in ("<stdout>", "<stderr>") else "writes_file")
+        elif name in ("mmap", "mmap2", "old_mmap"):
+            behaviours.add("maps_memory")
+        elif name in ("exit", "exit_group"):
+            behaviours.add("exits")
+        elif name.startswith("syscall_"):
+            behaviours.add("unknown_syscall")
+    return sorted(behaviours)
+
+
+def format_call(call):
+    args = ", ".join(["%#x" % arg for arg in call["args"]])
+    line = ">>> syscall %s(%s) = %d" % (call["name"], args, call["ret"])
+    details = ["%s=%r" % (key, call[key]) for key in ("path", "argv", "data") if key in call]
+    if len(details):
+        line += "  ; " + " ".join(details)
+    return line
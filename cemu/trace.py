@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import itertools
+
+
+TRACE_INSN = 0
+TRACE_BLOCK = 1
+TRACE_INTERRUPT = 2
+TRACE_MEM_READ = 3
+TRACE_MEM_WRITE = 4
+
+# number of trace records kept in memory
+TRACE_BUFFER_SIZE = 100000
+
+# trace levels, each one including the previous ones
+TRACE_LEVEL_NONE = 0
+TRACE_LEVEL_BLOCKS = 1
+TRACE_LEVEL_INSTRUCTIONS = 2
+TRACE_LEVEL_MEMORY = 3
+
+TRACE_LEVELS = {"none": TRACE_LEVEL_NONE,
+                "blocks": TRACE_LEVEL_BLOCKS,
+                "instructions": TRACE_LEVEL_INSTRUCTIONS,
+                "memory": TRACE_LEVEL_MEMORY,}
+
+
+def parse_trace_range(text):
+    """
+    Parses an address range `start-end` (hexadecimal, end included) to a tuple, or
+    returns None for an empty string (whole address space).
+    """
+    text = text.strip()
+    if len(text)==0:
+        return None
+    start, end = text.split("-", 1)
+    start, end = int(start, 0x10), int(end, 0x10)
+    if end < start:
+        raise Exception("Invalid trace range '%s'" % text)
+    return (start, end)
+
+
+def format_record(record):
+    kind = record[0]
+    if kind == TRACE_INSN:
+        return ">>> 0x{:x}: {:s} {:s}".format(record[1], record[2], record[3])
+    if kind == TRACE_BLOCK:
+        return ">>> Entering new block at 0x{:x}".format(record[1])
+    if kind == TRACE_INTERRUPT:
+        return ">>> Triggering interrupt #{:d}".format(record[1])
+    if kind == TRACE_MEM_WRITE:
+        return ">>> MEM_WRITE : *%#x = %#x (size = %u)" % (record[1], record[2], record[3])
+    if kind == TRACE_MEM_READ:
+        return ">>> MEM_READ : reg = *%#x (size = %u)" % (record[1], record[2])
+    return str(record)
+
+
+class TraceSink:
+    """
+    Bounded ring buffer of compact trace records (tuples), filled by the emulator hooks
+    and consumed in batches by whoever displays or saves the trace.
+    """
+
+    def __init__(self, maxlen=TRACE_BUFFER_SIZE, *args, **kwargs):
+        self.records = collections.deque(maxlen=maxlen)
+        self.clear()
+        return
+
+    def clear(self):
+        self.records.clear()
+        self.total = 0
+        self.flushed = 0
+        return
+
+    def push(self, *record):
+        self.records.append(record)
+        self.total += 1
+        return
+
+    def dropped(self):
+        """
+        Returns the number of records evicted from the ring buffer.
+        """
+        return self.total - len(self.records)
+
+    def pending(self):
+        """
+        Returns the number of records pushed since the last call to `drain`.
+        """
+        return self.total - self.flushed
+
+    def drain(self, limit=None):
+        """
+        Marks all pending records as flushed, and returns how many there were along with
+        the last `limit` of them (all the ones still buffered if `limit` is None).
+        """
+        count = self.pending()
+        self.flushed = self.total
+        keep = min(count, len(self.records))
+        if limit is not None:
+            keep = min(keep, limit)
+        return count, self.tail(keep)
+
+    def tail(self, n):
+        if n <= 0:
+            return []
+        return list(itertools.islice(reversed(self.records), n))[::-1]
+
+    def lines(self):
+        for record in list(self.records):
+            yield format_record(record)
+
+    def dump(self, fpath):
+        """
+        Writes every buffered record to a file, and returns the number of lines written.
+        """
+        count = 0
+        with open(fpath, "w") as f:
+            if self.dropped():
+                f.write(">>> %d older records were dropped from the trace buffer\n" % self.dropped())
+            for line in self.lines():
+                f.write(line + "\n")
+                count += 1
+        return count
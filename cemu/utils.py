@@ -1,25 +1,204 @@
 # -*- coding: utf-8 -*-
 
-import capstone
-import keystone
-import unicorn
+import binascii
+import collections
+import struct
 
-from .arch import Architecture
+from .arch import Mode, get_arch_descriptor
+
+
+DEFAULT_MEMORY_LAYOUT = [".text   0x40000   0x1000   READ|EXEC",
+                         ".data   0x60000   0x1000   READ|WRITE",
+                         ".stack  0x800000  0x4000   READ|WRITE",
+                         ".misc   0x1000000 0x1000   ALL"]
+
+COMMENT_TAGS = [b"#", b";", b"--",]
+
+# maximum number of assembled (mode, source) pairs remembered by `assemble`
+ASSEMBLY_CACHE_SIZE = 1024
+
+# number of bytes converted at once by `hexdump_lines`
+HEXDUMP_CHUNK_SIZE = 0x10000
+
+_capstone_engines = {}
+_keystone_engines = {}
+_printable_tables = {}
+
+
+class LRUCache:
+    """
+    Bounded mapping evicting the least recently used entry, and counting hits and misses.
+    """
+
+    def __init__(self, maxsize=4096, *args, **kwargs):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return
+
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
+        return
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return 100.0 * self.hits / total
+
+
+
+def hexify(source, separator=' '):
+    """
+    Returns the uppercase hexadecimal representation of a buffer, bytes being separated by
+    `separator` (e.g. `hexify(b"AB")` returns `41 42`).
+    """
+    if len(separator) == 0:
+        return binascii.hexlify(source).upper().decode("ascii")
+    return binascii.hexlify(source, separator).upper().decode("ascii")
+
+
+def is_byte_separator(separator):
+    """
+    Returns True if `separator` fits in the translation tables (a single latin-1 character);
+    the others are handled line by line, as any string can stand for a non printable byte.
+    """
+    return len(separator) == 1 and ord(separator) < 0x100
+
+
+def get_printable_table(separator='.'):
+    """
+    Returns the `bytes.translate` table replacing non printable characters with `separator`,
+    which must be a single latin-1 character (see `is_byte_separator`).
+    """
+    table = _printable_tables.get(separator)
+    if table is None:
+        sep = ord(separator)
+        table = bytes([c if 0x20 <= c < 0x7F else sep for c in range(0x100)])
+        _printable_tables[separator] = table
+    return table
+
+
+def format_hexdump_line(line, address, length=0x10, separator='.', show_raw=False):
+    hexa = hexify(line)
+    if show_raw:
+        return hexa
+    if is_byte_separator(separator):
+        text = line.translate(get_printable_table(separator)).decode("latin-1")
+    else:
+        text = ''.join( [chr(c) if 0x20 <= c < 0x7F else separator for c in line] )
+    return "%#-.*x   %-*s  %s" % (16, address, 3*length, hexa, text)
 
-def hexdump(source, length=0x10, separator='.', show_raw=False, base=0x00):
-    result = []
-    for i in range(0, len(source), length):
-        s = source[i:i+length]
 
-        hexa = ' '.join(["%02X" % c for c in s])
-        text = ''.join( [chr(c) if 0x20 <= c < 0x7F else separator for c in s] )
+def format_hexdump_block(block, address, length=0x10, separator='.', show_raw=False):
+    """
+    Formats a block of complete lines at once: every column of the output is filled for
+    all the lines in a single strided copy, instead of formatting the lines one by one.
+    """
+    count = len(block) // length
+    width = 3*length
+    if show_raw:
+        out = bytearray(binascii.hexlify(block, b' ').upper() + b' ')
+        out[width-1::width] = b'\n' * count
+        return out[:-1].decode("ascii")
 
-        if show_raw:
-            result.append(hexa)
+    # address, 3 spaces, hexadecimal bytes padded to `width`, 2 spaces, text and a newline
+    hexpos = 21
+    textpos = hexpos + width + 2
+    linesize = textpos + length + 1
+    out = bytearray(b' ' * (linesize*count))
+    out[0::linesize] = b'0' * count
+    out[1::linesize] = b'x' * count
+    addresses = binascii.hexlify(struct.pack(">%dQ" % count, *range(address, address+count*length, length)))
+    for i in range(16):
+        out[2+i::linesize] = addresses[i::16]
+    hexa = binascii.hexlify(block).upper()
+    for i in range(length):
+        out[hexpos+3*i::linesize] = hexa[2*i::2*length]
+        out[hexpos+3*i+1::linesize] = hexa[2*i+1::2*length]
+    text = block.translate(get_printable_table(separator))
+    for i in range(length):
+        out[textpos+i::linesize] = text[i::length]
+    out[linesize-1::linesize] = b'\n' * count
+    return out[:-1].decode("latin-1")
+
+
+def hexdump_blocks(source, length=0x10, separator='.', show_raw=False, base=0x00):
+    """
+    Yields the hexdump of `source` as blocks of lines (joined by newlines), converting
+    `HEXDUMP_CHUNK_SIZE` bytes at a time so that large buffers can be streamed.
+    """
+    view = memoryview(source).cast("B")
+    chunk_size = HEXDUMP_CHUNK_SIZE - HEXDUMP_CHUNK_SIZE % length
+    # the block formatter packs the addresses as 64-bit integers, and writes one byte
+    # per character of text
+    vectorize = 0 <= base and base + len(view) < 1<<64 and is_byte_separator(separator)
+
+    for offset in range(0, len(view), chunk_size):
+        chunk = bytes(view[offset:offset+chunk_size])
+        address = base + offset
+        full = len(chunk) - len(chunk) % length
+        lines = []
+        if vectorize and full > 0:
+            lines.append( format_hexdump_block(chunk[:full], address, length, separator, show_raw) )
         else:
-            result.append( "%#-.*x   %-*s  %s" % (16, base+i, 3*length, hexa, text) )
+            full = 0
+        for i in range(full, len(chunk), length):
+            lines.append( format_hexdump_line(chunk[i:i+length], address+i, length, separator, show_raw) )
+        yield '\n'.join(lines)
+    return
+
 
-    return '\n'.join(result)
+def hexdump_lines(source, length=0x10, separator='.', show_raw=False, base=0x00):
+    """
+    Yields the lines of the hexdump of `source` one by one.
+    """
+    for block in hexdump_blocks(source, length, separator, show_raw, base):
+        for line in block.split('\n'):
+            yield line
+    return
+
+
+def hexdump(source, length=0x10, separator='.', show_raw=False, base=0x00):
+    return '\n'.join(hexdump_blocks(source, length, separator, show_raw, base))
+
+
+def hexdump_to_file(source, fd, length=0x10, separator='.', show_raw=False, base=0x00):
+    """
+    Streams the hexdump of `source` to the file object `fd`, and returns the number of
+    bytes dumped.
+    """
+    for block in hexdump_blocks(source, length, separator, show_raw, base):
+        fd.write(block + '\n')
+    return len(source)
 
 
 
@@ -34,123 +213,75 @@ def format_address(addr, mode):
 
 
 def get_arch_mode(lib, m):
-    arch = mode = endian = None
-
-    # x86
-    if m in (Architecture.X86_16_INTEL, Architecture.X86_16_ATT):
-        if lib=="keystone":      arch, mode, endian = keystone.KS_ARCH_X86, keystone.KS_MODE_16, keystone.KS_MODE_LITTLE_ENDIAN
-        elif lib=="capstone":    arch, mode, endian = capstone.CS_ARCH_X86, capstone.CS_MODE_16, capstone.CS_MODE_LITTLE_ENDIAN
-        else:                    arch, mode, endian = unicorn.UC_ARCH_X86, unicorn.UC_MODE_16, unicorn.UC_MODE_LITTLE_ENDIAN
-
-    elif m in (Architecture.X86_32_INTEL, Architecture.X86_32_ATT):
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_X86, keystone.KS_MODE_32, keystone.KS_MODE_LITTLE_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_X86, capstone.CS_MODE_32, capstone.CS_MODE_LITTLE_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_X86, unicorn.UC_MODE_32, unicorn.UC_MODE_LITTLE_ENDIAN
-
-    elif m in (Architecture.X86_64_INTEL, Architecture.X86_64_ATT):
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_X86, keystone.KS_MODE_64, keystone.KS_MODE_LITTLE_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_X86, capstone.CS_MODE_64, capstone.CS_MODE_LITTLE_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_X86, unicorn.UC_MODE_64, unicorn.UC_MODE_LITTLE_ENDIAN
-
-    # arm
-    elif m==Architecture.ARM_LE:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_ARM, keystone.KS_MODE_ARM, keystone.KS_MODE_LITTLE_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_ARM, capstone.CS_MODE_ARM, capstone.CS_MODE_LITTLE_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_ARM, unicorn.UC_MODE_ARM, unicorn.UC_MODE_LITTLE_ENDIAN
-    elif m==Architecture.ARM_BE:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_ARM, keystone.KS_MODE_ARM, keystone.KS_MODE_BIG_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_ARM, capstone.CS_MODE_ARM, capstone.CS_MODE_BIG_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_ARM, unicorn.UC_MODE_ARM, unicorn.UC_MODE_BIG_ENDIAN
-    elif m==Architecture.ARM_THUMB_LE:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_ARM, keystone.KS_MODE_THUMB, keystone.KS_MODE_LITTLE_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_ARM, capstone.CS_MODE_THUMB, capstone.CS_MODE_LITTLE_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_ARM, unicorn.UC_MODE_THUMB, unicorn.UC_MODE_LITTLE_ENDIAN
-    elif m==Architecture.ARM_THUMB_BE:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_ARM, keystone.KS_MODE_THUMB, keystone.KS_MODE_BIG_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_ARM, capstone.CS_MODE_THUMB, capstone.CS_MODE_BIG_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_ARM, unicorn.UC_MODE_THUMB, unicorn.UC_MODE_BIG_ENDIAN
-
-    # aarch64
-    elif m==Architecture.ARM_AARCH64:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_ARM64, 0, keystone.KS_MODE_LITTLE_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_ARM64, capstone.CS_MODE_ARM, capstone.CS_MODE_LITTLE_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_ARM64, unicorn.UC_MODE_ARM, unicorn.UC_MODE_LITTLE_ENDIAN
-
-    # powerpc
-    elif m==Architecture.PPC:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_PPC, keystone.KS_MODE_PPC32, keystone.KS_MODE_BIG_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_PPC, 0, capstone.CS_MODE_BIG_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_PPC, unicorn.UC_MODE_PPC32, unicorn.UC_MODE_BIG_ENDIAN
-    elif m==Architecture.PPC64:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_PPC, keystone.KS_MODE_PPC64, keystone.KS_MODE_BIG_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_PPC, 0, capstone.CS_MODE_BIG_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_PPC, unicorn.UC_MODE_PPC64, unicorn.UC_MODE_BIG_ENDIAN
-
-    # mips/mips64
-    elif m==Architecture.MIPS:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_MIPS, keystone.KS_MODE_MIPS32, keystone.KS_MODE_LITTLE_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_MIPS, capstone.CS_MODE_MIPS32, capstone.CS_MODE_LITTLE_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_MIPS, unicorn.UC_MODE_MIPS32, unicorn.UC_MODE_LITTLE_ENDIAN
-    elif m==Architecture.MIPS_BE:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_MIPS, keystone.KS_MODE_MIPS32, keystone.KS_MODE_BIG_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_MIPS, capstone.CS_MODE_MIPS32, capstone.CS_MODE_BIG_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_MIPS, unicorn.UC_MODE_MIPS32, unicorn.UC_MODE_BIG_ENDIAN
-    elif m==Architecture.MIPS64:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_MIPS, keystone.KS_MODE_MIPS64, keystone.KS_MODE_LITTLE_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_MIPS, capstone.CS_MODE_MIPS64, capstone.CS_MODE_LITTLE_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_MIPS, unicorn.UC_MODE_MIPS64, unicorn.UC_MODE_LITTLE_ENDIAN
-    elif m==Architecture.MIPS64_BE:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_MIPS, keystone.KS_MODE_MIPS64, keystone.KS_MODE_BIG_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_MIPS, capstone.CS_MODE_MIPS64, capstone.CS_MODE_BIG_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_MIPS, unicorn.UC_MODE_MIPS64, unicorn.UC_MODE_BIG_ENDIAN
-
-    # sparc/sparc64
-    elif m==Architecture.SPARC:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_SPARC, keystone.KS_MODE_SPARC32, keystone.KS_MODE_LITTLE_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_SPARC, 0, capstone.CS_MODE_LITTLE_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_SPARC, unicorn.UC_MODE_SPARC32, unicorn.UC_MODE_LITTLE_ENDIAN
-    elif m==Architecture.SPARC_BE:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_SPARC, keystone.KS_MODE_SPARC32, keystone.KS_MODE_BIG_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_SPARC, 0, capstone.CS_MODE_BIG_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_SPARC, unicorn.UC_MODE_SPARC32, unicorn.UC_MODE_BIG_ENDIAN
-    elif m==Architecture.SPARC64:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_SPARC, keystone.KS_MODE_SPARC64, keystone.KS_MODE_LITTLE_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_SPARC, 0, capstone.CS_MODE_LITTLE_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_SPARC, unicorn.UC_MODE_SPARC64, unicorn.UC_MODE_LITTLE_ENDIAN
-    elif m==Architecture.SPARC64_BE:
-        if lib=="keystone":     arch, mode, endian = keystone.KS_ARCH_SPARC, keystone.KS_MODE_SPARC64, keystone.KS_MODE_BIG_ENDIAN
-        elif lib=="capstone":   arch, mode, endian = capstone.CS_ARCH_SPARC, 0, capstone.CS_MODE_BIG_ENDIAN
-        else:                   arch, mode, endian = unicorn.UC_ARCH_SPARC, unicorn.UC_MODE_SPARC64, unicorn.UC_MODE_BIG_ENDIAN
-
-    if arch is None and mode is None and endian is None:
+    """
+    Returns the (arch, mode, endian) constants of `lib` (keystone, capstone or unicorn)
+    for the mode or architecture.
+    """
+    if lib not in ("keystone", "capstone", "unicorn"):
         raise Exception("Failed to get architecture parameter from mode")
+    return getattr(get_arch_descriptor(m), lib)
 
-    return arch, mode, endian
 
+def get_capstone_engine(m):
+    """
+    Returns the capstone decoder for the mode, created once and reused afterwards.
+    """
+    key = m.get_id() if isinstance(m, Mode) else m
+    cs = _capstone_engines.get(key)
+    if cs is None:
+        import capstone
+        descriptor = get_arch_descriptor(key)
+        arch, mode, endian = descriptor.capstone
+        cs = capstone.Cs(arch, mode | endian)
+        if descriptor.syntax == "att":
+            cs.syntax = capstone.CS_OPT_SYNTAX_ATT
+        _capstone_engines[key] = cs
+    return cs
 
-def disassemble(raw_data, mode):
-    arch, mode, endian = get_arch_mode("capstone", mode)
-    cs = capstone.Cs(arch, mode | endian)
-    if mode in (Architecture.X86_16_ATT, Architecture.X86_32_ATT, Architecture.X86_64_ATT):
-        cs.syntax = capstone.CS_OPT_SYNTAX_ATT
 
-    insns = ["{:s} {:s}".format(i.mnemonic, i.op_str) for i in cs.disasm(bytes(raw_data), 0x4000)]
-    return "\n".join(insns)
+def disassemble(raw_data, mode):
+    from .disasm import disasm_lines
+    return "\n".join(disasm_lines(raw_data, mode))
 
 
 def disassemble_file(fpath, mode):
+    from .disasm import disasm_lines
     with open(fpath, 'rb') as f:
-        raw_data = f.read()
+        return "\n".join(disasm_lines(f, mode))
+
+
+def get_keystone_engine(m):
+    """
+    Returns the keystone assembler for the mode, created once and reused afterwards.
+    """
+    key = m.get_id() if isinstance(m, Mode) else m
+    ks = _keystone_engines.get(key)
+    if ks is None:
+        import keystone
+        descriptor = get_arch_descriptor(key)
+        arch, mode, endian = descriptor.keystone
+        ks = keystone.Ks(arch, mode | endian)
+        if descriptor.syntax == "att":
+            ks.syntax = keystone.KS_OPT_SYNTAX_ATT
+        _keystone_engines[key] = ks
+    return ks
 
-    return disassemble(raw_data, mode)
+
+_assembly_cache = LRUCache(ASSEMBLY_CACHE_SIZE)
 
 
 def assemble(asm_code, cmode):
-    arch, mode, endian = get_arch_mode("keystone", cmode)
-    ks = keystone.Ks(arch, mode | endian)
-    if cmode in (Architecture.X86_16_ATT, Architecture.X86_32_ATT, Architecture.X86_64_ATT):
-        ks.syntax = keystone.KS_OPT_SYNTAX_ATT
+    """
+    Assembles the code for the mode, and returns a tuple (bytes, number_of_instructions),
+    the number of instructions being -1 on failure. Results are memoized by (mode, source).
+    """
+    key = (cmode.get_id() if isinstance(cmode, Mode) else cmode, asm_code)
+    cached = _assembly_cache.get(key)
+    if cached is not None:
+        return cached
 
+    import keystone
+    ks = get_keystone_engine(cmode)
     try:
         code, cnt = ks.asm(asm_code)
         if cnt==0:
@@ -159,4 +290,79 @@ def assemble(asm_code, cmode):
     except keystone.keystone.KsError:
         code, cnt = (b"", -1)
 
+    _assembly_cache.put(key, (code, cnt))
     return (code, cnt)
+
+
+def parse_mappings(lines):
+    """
+    Parses memory mapping lines of the form `name address size permission [input_file [offset]]`,
+    with address, size and offset (in the input file) in hexadecimal, into a list of areas
+    for `Emulator.populate_memory`.
+    """
+    maps = []
+    for line in lines:
+        line = str(line).strip()
+        if len(line)==0 or line.startswith("#"):
+            continue
+
+        parts = line.split()
+        read_from_file = None
+        offset = 0
+        if len(parts)>=5:
+            read_from_file = parts[4]
+        if len(parts)>=6:
+            offset = int(parts[5], 0x10)
+
+        name, address, size, permission = parts[0:4]
+        address = int(address, 0x10)
+        size = int(size, 0x10)
+        maps.append( [name, address, size, permission, read_from_file, offset] )
+    return maps
+
+
+def get_clean_code(code):
+    """
+    Returns the lines of assembly (as bytes) stripped of empty lines and comments.
+    """
+    clean = []
+    for line in code:
+        line = line.strip()
+        if len(line)==0:
+            continue
+        if line.startswith(tuple(COMMENT_TAGS)):
+            continue
+        clean.append(line)
+    return clean
+
+
+def parse_string_in_code(code, mode):
+    """
+    Searches every line of assembly for a quoted string the size of a word for the
+    given mode, and converts it to its hexadecimal value.
+    """
+    parsed = []
+    for line in code:
+        i = line.find(b'"')
+        if i==-1:
+            # no string
+            parsed.append(line)
+            continue
+
+        j = line[i+1:].find(b'"')
+        if j==-1:
+            # unfinished string
+            parsed.append(line)
+            continue
+
+        if (j*8) != mode.get_memory_alignment():
+            # incorrect size
+            parsed.append(line)
+            continue
+
+        origstr = line[i+1:i+j+1]
+        hexstr  = binascii.hexlify(origstr)
+        newline = line.replace(b'"%s"'%origstr, b'0x%s'%hexstr)
+        parsed.append(newline)
+
+    return parsed
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+"""
+Watchpoints, and aggregated memory access statistics.
+
+The watched ranges are cut in elementary segments at every watchpoint boundary, each
+segment holding the watchpoints covering it: an access is matched with a binary search
+on the segment starts. The emulator registers its read and write hooks on the (merged)
+ranges watched for reads and for writes only, so that unicorn never calls back for the
+other accesses.
+
+Aggregated statistics count the reads and writes per page instead of recording each
+access, and can be reported per page or per mapped area.
+"""
+
+import bisect
+import collections
+
+
+# granularity of the aggregated statistics
+ACCESS_STATS_PAGE = "page"
+ACCESS_STATS_AREA = "area"
+ACCESS_STATS_PAGE_SHIFT = 12
+
+# number of watchpoint hits kept for the log and the results
+WATCH_HITS_SIZE = 1000
+
+
+class Watchpoint:
+    """
+    Watches the accesses of the kinds in `access` ("r", "w" or "rw") to the addresses
+    from `start` to `end` (included), stopping the emulation on a hit with `stop`.
+    """
+
+    def __init__(self, start, end, access="rw", stop=False, *args, **kwargs):
+        if end < start or len(access) == 0 or not set(access) <= set("rw"):
+            raise Exception("Invalid watchpoint %#x-%#x:%s" % (start, end, access))
+        self.start = start
+        self.end = end
+        self.access = access
+        self.stop = stop
+        self.hits = 0
+        return
+
+
+    def __str__(self):
+        return "%#x-%#x:%s%s" % (self.start, self.end, self.access, ":stop" if self.stop else "")
+
+
+    def as_dict(self):
+        return {"start": self.start, "end": self.end, "access": self.access, "stop": self.stop, "hits": self.hits}
+
+
+def parse_watchpoint(text):
+    """
+    Parses a watchpoint of the form `start-end[:access][:stop]` (hexadecimal addresses,
+    end included, access being r, w or rw).
+    """
+    parts = text.strip().split(":")
+    if "-" not in parts[0]:
+        raise Exception("Invalid watchpoint '%s'" % text)
+    start, end = parts[0].split("-", 1)
+    access = parts[1] if len(parts) > 1 and parts[1] != "stop" else "rw"
+    stop = parts[-1] == "stop"
+    return Watchpoint(int(start, 0x10), int(end, 0x10), access, stop)
+
+
+class WatchIndex:
+
+    def __init__(self, *args, **kwargs):
+        self.watchpoints = []
+        self.rebuild()
+        return
+
+
+    def __len__(self):
+        return len(self.watchpoints)
+
+
+    def add(self, watchpoint):
+        self.watchpoints.append(watchpoint)
+        self.rebuild()
+        return watchpoint
+
+
+    def remove(self, watchpoint):
+        self.watchpoints.remove(watchpoint)
+        self.rebuild()
+        return
+
+
+    def clear(self):
+        del self.watchpoints[:]
+        self.rebuild()
+        return
+
+
+    def rebuild(self):
+        """
+        Cuts the watched ranges in segments, `starts` holding their sorted start addresses
+        and `segments` the watchpoints covering each one (none between two ranges).
+        """
+        bounds = set()
+        for wp in self.watchpoints:
+            bounds.add(wp.start)
+            bounds.add(wp.end + 1)
+        self.starts = sorted(bounds)
+        self.segments = [[wp for wp in self.watchpoints if wp.start <= start <= wp.end] for start in self.starts]
+        return
+
+
+    def lookup(self, address, size=1):
+        """
+        Returns the watchpoints overlapping the `size` bytes at `address`.
+        """
+        starts, segments = self.starts, self.segments
+        i = max(0, bisect.bisect_right(starts, address) - 1)
+        found = []
+        while i < len(starts) and starts[i] < address + size:
+            for wp in segments[i]:
+                if wp not in found and wp.start < address + size and address <= wp.end:
+                    found.append(wp)
+            i += 1
+        return found
+
+
+    def get_ranges(self, kind="rw"):
+        """
+        Returns the ranges watched for any of the accesses in `kind` merged, as sorted
+        (start, end) tuples (end included).
+        """
+        ranges = []
+        watchpoints = [wp for wp in self.watchpoints if set(wp.access) & set(kind)]
+        for wp in sorted(watchpoints, key=lambda wp: wp.start):
+            if len(ranges) and wp.start <= ranges[-1][1] + 1:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], wp.end))
+            else:
+                ranges.append( (wp.start, wp.end) )
+        return ranges
+
+
+def format_hit(hit):
+    pc, kind, address, size, value, watchpoint = hit
+    if kind == "w":
+        return ">>> Watchpoint %s: write of %d bytes at %#x (value=%#x) by %#x" % (watchpoint, size, address, value, pc)
+    return ">>> Watchpoint %s: read of %d bytes at %#x by %#x" % (watchpoint, size, address, pc)
+
+
+def hit_as_dict(hit):
+    pc, kind, address, size, value, watchpoint = hit
+    return {"pc": pc, "access": kind, "address": address, "size": size, "value": value, "watchpoint": str(watchpoint)}
+
+
+class AccessStats:
+    """
+    Counts of the memory reads and writes per page, see `Emulator.get_wanted_hooks`.
+    """
+
+    def __init__(self, granularity=ACCESS_STATS_PAGE, *args, **kwargs):
+        if granularity not in (ACCESS_STATS_PAGE, ACCESS_STATS_AREA):
+            raise Exception("Unknown access statistics granularity '%s'" % granularity)
+        self.granularity = granularity
+        self.reads = collections.defaultdict(int)
+        self.writes = collections.defaultdict(int)
+
+        # the hooks only do a dict update, and are called for one kind of access each
+        reads, writes, shift = self.reads, self.writes, ACCESS_STATS_PAGE_SHIFT
+        def hook_read(uc, access, address, size, value, user_data):
+            reads[address >> shift] += 1
+        def hook_write(uc, access, address, size, value, user_data):
+            writes[address >> shift] += 1
+        self.hook_read = hook_read
+        self.hook_write = hook_write
+        return
+
+
+    def clear(self):
+        self.reads.clear()
+        self.writes.clear()
+        return
+
+
+    def get_pages(self):
+        """
+        Returns the (address, reads, writes) of the accessed pages, in increasing order.
+        """
+        pages = sorted(set(self.reads.keys()) | set(self.writes.keys()))
+        return [(page << ACCESS_STATS_PAGE_SHIFT, self.reads.get(page, 0), self.writes.get(page, 0)) for page in pages]
+
+
+    def report(self, areas):
+        """
+        Returns the access counts, the most accessed first, per page or per area of
+        `areas` (as `Emulator.areas`).
+        """
+        if self.granularity == ACCESS_STATS_PAGE:
+            entries = [{"page": address, "reads": reads, "writes": writes} for address, reads, writes in self.get_pages()]
+        else:
+            counts = collections.OrderedDict()
+            for address, reads, writes in self.get_pages():
+                name = "unmapped"
+                for area, (start, size, permission) in areas.items():
+                    if start <= address < start + size:
+                        name = area
+                        break
+                total = counts.setdefault(name, [0, 0])
+                total[0] += reads
+                total[1] += writes
+            entries = [{"area": name, "reads": reads, "writes": writes} for name, (reads, writes) in counts.items()]
+        return sorted(entries, key=lambda e: -(e["reads"] + e["writes"]))
+
+
+def format_report(report):
+    lines = [">>> Memory accesses"]
+    for entry in report:
+        where = entry["area"] if "area" in entry else "%#x" % entry["page"]
+        lines.append(">>> %-18s %10d reads %10d writes" % (where, entry["reads"], entry["writes"]))
+    return lines
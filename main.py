@@ -1,24 +1,43 @@
-#!/usr/bin/env python2.7
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 import sys
+import importlib.util
 
-def check_dependencies():
-    deps = ["PyQt4", "unicorn", "capstone", "keystone", "pygments"]
-    for d in deps:
-        try:
-            __import__(d)
-        except ImportError:
-            print("[-] Missing required dependency '%s'" % d)
+
+# the GUI needs either PyQt4 or PyQt5, on top of the engines needed to emulate
+GUI_DEPENDENCIES = [("PyQt5", "PyQt4"), ("pygments",)]
+ENGINE_DEPENDENCIES = [("unicorn",), ("capstone",), ("keystone",)]
+
+
+def get_dependencies(argv):
+    command = argv[0] if len(argv) else "gui"
+    if command == "gui":
+        return ENGINE_DEPENDENCIES + GUI_DEPENDENCIES
+    if command in ("run", "batch"):
+        return ENGINE_DEPENDENCIES
+    if command == "disasm":
+        return [("capstone",)]
+    return []
+
+
+def check_dependencies(deps):
+    """
+    Checks that the dependencies can be found, without importing them.
+    """
+    for alternatives in deps:
+        if not any([importlib.util.find_spec(d) is not None for d in alternatives]):
+            print("[-] Missing required dependency '%s'" % "' or '".join(alternatives))
             sys.exit(1)
     return
 
-def run():
-    from cemu.core import Cemu
-    Cemu()
-    return
+
+def run(argv):
+    from cemu.__main__ import main
+    return main(argv)
+
 
 if __name__ == '__main__':
-    check_dependencies()
-    run()
-    sys.exit(0)
+    argv = sys.argv[1:]
+    check_dependencies(get_dependencies(argv))
+    sys.exit(run(argv))
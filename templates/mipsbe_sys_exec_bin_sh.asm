@@ -7,7 +7,7 @@
     sw $v0, 0($sp)
     li $v0, 0x2f736800
     sw $v0, 4($sp)
-    li $v0, 11
+    li $v0, 4011
     move $a0, $sp
     addiu $a1, $zero, 0
     addiu $a2, $zero, 0